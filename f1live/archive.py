@@ -0,0 +1,561 @@
+#!/usr/bin/python
+"""
+Block-compressed packet archives with random access.
+
+An archive holds the records of a saved session in a single file. Records
+keep the packet log record format (see L{packetlog}) and are grouped into
+blocks compressed independently of each other, so a reader decompresses
+only the blocks a query touches:
+
+    magic         'F1LA'
+    blocks        compressed records
+    block index   one entry per block:
+        offset        uint64    file offset of the block
+        length        uint32    compressed length
+        raw_length    uint32    uncompressed length
+        codec         uint8     codec id
+        kinds         uint8     bit mask of the record kinds in the block
+        sequence      uint64    sequence number of the first record
+        count         uint32    number of records
+        first         double    timestamp of the first record
+        last          double    timestamp of the last record
+    footer
+        index offset  uint64
+        blocks        uint32
+        magic         'F1LA'
+
+Archives are converted from packet log directories, or from directories
+of .packet and .kframe files saved one record per file:
+
+    > python archive.py convert sessions/2013-monaco 2013-monaco.f1a
+    412337 records in 185 blocks: 48.2 MB -> 9.7 MB (ratio 4.97)
+    > python archive.py bench sessions/2013-monaco
+    codec        size  ratio  write MB/s   read MB/s   seek ms
+    none      48.2 MB   1.00       187.4       602.3      0.21
+    zlib       9.7 MB   4.97        41.3       212.8      0.69
+    bz2        7.9 MB   6.10         6.2        31.5      4.80
+"""
+import logging
+import os
+import glob
+import time
+import random
+import struct
+import tempfile
+import zlib
+import bz2
+import argparse
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
+from collections import namedtuple
+from packetlog import PacketLogReader
+from packetlog import HEADER
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from packetlog import Record
+from packetlog import make_record
+from packetlog import list_segments
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['ArchiveWriter', 'ArchiveReader', 'convert', 'benchmark',
+           'legacy_records', 'CODECS']
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'F1LA'
+BLOCK = struct.Struct('<QIIBBQIdd')
+FOOTER = struct.Struct('<QI4s')
+
+# uncompressed size of a block
+BLOCK_SIZE = 256 << 10
+
+NONE = 'none'
+ZLIB = 'zlib'
+BZ2 = 'bz2'
+LZMA = 'lzma'
+ZSTD = 'zstd'
+
+Codec = namedtuple('Codec', 'id compress decompress')
+BlockEntry = namedtuple('BlockEntry', 'offset length raw_length codec kinds '
+                                      'sequence count first last')
+
+# codecs by name; lzma and zstd only when their library is installed
+CODECS = OrderedDict([
+    (NONE, Codec(0, str, str)),
+    (ZLIB, Codec(1, zlib.compress, zlib.decompress)),
+    (BZ2, Codec(2, bz2.compress, bz2.decompress)),
+])
+if lzma is not None:
+    CODECS[LZMA] = Codec(3, lzma.compress, lzma.decompress)
+if zstandard is not None:
+    CODECS[ZSTD] = Codec(4, zstandard.ZstdCompressor().compress,
+                         zstandard.ZstdDecompressor().decompress)
+
+CODEC_NAMES = (NONE, ZLIB, BZ2, LZMA, ZSTD)
+CODEC_LIBRARIES = {LZMA: 'lzma (or backports.lzma)', ZSTD: 'zstandard'}
+
+def get_codec(name):
+    """return the codec of a name."""
+    if name not in CODEC_NAMES:
+        raise ValueError("Unknown value of 'codec' argument")
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ImportError('{0} archives require {1}'
+                          .format(name, CODEC_LIBRARIES[name]))
+
+def decompressor(codec_id):
+    """return the decompress function of a codec id."""
+    for codec in CODECS.itervalues():
+        if codec.id == codec_id:
+            return codec.decompress
+    raise ImportError('Codec {0} is not available'.format(codec_id))
+
+class ArchiveWriter(object):
+    """Writer grouping records into compressed blocks of an archive."""
+
+    def __init__(self, path, codec=ZLIB, block_size=BLOCK_SIZE):
+        """
+        Create an archive.
+
+        @param path: path of the archive file.
+        @type path: C{string}.
+        @param codec: 'none', 'zlib' (default), 'bz2', 'lzma' or 'zstd'.
+        @type codec: C{string}.
+        @param block_size: uncompressed size (bytes) of a block.
+        @type block_size: C{int}.
+        @raise ValueError: when value of 'codec' argument is unknown.
+        @raise ImportError: when the library of the codec is not installed.
+        """
+        self.codec = get_codec(codec)
+        self.block_size = block_size
+        self.blocks = []
+        self.sequence = 0
+        self.records = 0
+        self.raw_size = 0
+        self.pending = []
+        self.pending_size = 0
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def append(self, payload, kind=PACKET, key_frame_id=0, timestamp=None,
+               sequence=None):
+        """
+        Append a record.
+
+        @param payload: record payload.
+        @type payload: C{string}.
+        @param kind: PACKET, KEY_FRAME or CHECKPOINT.
+        @type kind: C{int}.
+        @param key_frame_id: key frame id of KEY_FRAME records.
+        @type key_frame_id: C{int}.
+        @param timestamp: record time (default: now).
+        @type timestamp: C{float}.
+        @param sequence: record sequence number (default: the next one).
+        @type sequence: C{int}.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if sequence is None:
+            sequence = self.sequence
+        if not self.pending:
+            self.first = (sequence, timestamp)
+            self.kinds = 0
+        self.pending.append(HEADER.pack(len(payload), sequence, timestamp,
+                                        kind, key_frame_id,
+                                        zlib.crc32(payload) & 0xffffffff))
+        self.pending.append(payload)
+        self.pending_size += HEADER.size + len(payload)
+        self.kinds |= 1 << kind
+        self.last = timestamp
+        self.sequence = sequence + 1
+        self.records += 1
+        if self.pending_size >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self):
+        """compress and write the pending records as a block."""
+        if not self.pending:
+            return
+        raw = ''.join(self.pending)
+        data = self.codec.compress(raw)
+        sequence, first = self.first
+        self.blocks.append(BlockEntry(self._file.tell(), len(data), len(raw),
+                                      self.codec.id, self.kinds, sequence,
+                                      len(self.pending) // 2, first,
+                                      self.last))
+        self._file.write(data)
+        self.raw_size += len(raw)
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        """write the last block and the block index, and close the file."""
+        if self._file is None:
+            return
+        self.flush_block()
+        offset = self._file.tell()
+        for entry in self.blocks:
+            self._file.write(BLOCK.pack(*entry))
+        self._file.write(FOOTER.pack(offset, len(self.blocks), MAGIC))
+        self.size = self._file.tell()
+        self._file.close()
+        self._file = None
+
+    def stats(self):
+        """
+        Return archive statistics.
+
+        @return: records, blocks, raw (packet log) size and archive size.
+        @rtype: C{dict}.
+        """
+        return {'records': self.records,
+                'blocks': len(self.blocks),
+                'raw_size': self.raw_size,
+                'size': getattr(self, 'size', None)}
+
+class ArchiveReader(object):
+    """
+    Reader of an archive, with the record queries of L{PacketLogReader}.
+    Only the blocks holding the records read are decompressed; the block
+    read last is kept, so sequential reads decompress each block once.
+    """
+    def __init__(self, path):
+        """
+        Open an archive.
+
+        @param path: path of the archive file.
+        @type path: C{string}.
+        @raise ValueError: when the file is not an archive.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        offset, count, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError('{0} is not a packet archive'.format(path))
+        self._file.seek(offset)
+        data = self._file.read(count * BLOCK.size)
+        self.blocks = [BlockEntry._make(BLOCK.unpack_from(data,
+                                                          i * BLOCK.size))
+                       for i in xrange(count)]
+        self.cached = (None, None)
+        self.decompressed = 0
+
+    def __iter__(self):
+        return self.records()
+
+    def block(self, index):
+        """return the uncompressed records of a block."""
+        if self.cached[0] == index:
+            return self.cached[1]
+        entry = self.blocks[index]
+        self._file.seek(entry.offset)
+        data = decompressor(entry.codec)(self._file.read(entry.length))
+        self.cached = (index, data)
+        self.decompressed += 1
+        return data
+
+    def block_records(self, index):
+        """
+        Yield the records of a block.
+
+        @param index: index of the block.
+        @type index: C{int}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        @raise ValueError: when a record of the block is corrupt.
+        """
+        data = self.block(index)
+        offset = 0
+        end = len(data)
+        while offset < end:
+            if offset + HEADER.size > end:
+                self.corrupt(index)
+            header = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            offset = start + header[0]
+            payload = data[start:offset]
+            if offset > end or \
+               zlib.crc32(payload) & 0xffffffff != header[5]:
+                self.corrupt(index)
+            yield make_record(header, payload)
+
+    def corrupt(self, index):
+        """drop the cached block and raise a corrupt block error."""
+        self.cached = (None, None)
+        raise ValueError('{0}: block {1} is corrupt'.format(self.path, index))
+
+    def records(self, start=0, stop=None):
+        """
+        Iterate records by sequence number.
+
+        @param start: first sequence number (default: 0).
+        @type start: C{int}.
+        @param stop: sequence number to stop before (default: end).
+        @type stop: C{int}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        """
+        sequences = [entry.sequence for entry in self.blocks]
+        first = max(bisect_right(sequences, start) - 1, 0)
+        for index in xrange(first, len(self.blocks)):
+            if stop is not None and self.blocks[index].sequence >= stop:
+                return
+            for record in self.block_records(index):
+                if stop is not None and record.sequence >= stop:
+                    return
+                if record.sequence >= start:
+                    yield record
+
+    def between(self, start=None, stop=None):
+        """
+        Iterate records by time range.
+
+        @param start: start time, inclusive (default: start of archive).
+        @type start: C{float}.
+        @param stop: stop time, exclusive (default: end of archive).
+        @type stop: C{float}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        """
+        first = 0
+        if start is not None:
+            # first block ending at or after start
+            first = bisect_left([entry.last for entry in self.blocks], start)
+        for index in xrange(first, len(self.blocks)):
+            if stop is not None and self.blocks[index].first >= stop:
+                return
+            for record in self.block_records(index):
+                if stop is not None and record.timestamp >= stop:
+                    return
+                if start is None or record.timestamp >= start:
+                    yield record
+
+    def key_frames(self):
+        """
+        Iterate key frame records, decompressing only blocks holding some.
+
+        @return: generator of key frame records.
+        @rtype: C{generator}.
+        """
+        for index, entry in enumerate(self.blocks):
+            if entry.kinds & 1 << KEY_FRAME:
+                for record in self.block_records(index):
+                    if record.kind == KEY_FRAME:
+                        yield record
+
+    def key_frame_before(self, timestamp):
+        """
+        Find the last key frame at or before a point in time.
+
+        @param timestamp: point in time.
+        @type timestamp: C{float}.
+        @return: key frame record, or None if there is none.
+        @rtype: C{Record}.
+        """
+        last = bisect_right([entry.first for entry in self.blocks], timestamp)
+        for index in reversed(xrange(last)):
+            if not self.blocks[index].kinds & 1 << KEY_FRAME:
+                continue
+            found = None
+            for record in self.block_records(index):
+                if record.timestamp > timestamp:
+                    break
+                if record.kind == KEY_FRAME:
+                    found = record
+            if found is not None:
+                return found
+        return None
+
+    def close(self):
+        """close the archive file."""
+        self._file.close()
+        self.cached = (None, None)
+
+def legacy_records(directory):
+    """
+    Iterate the records of a directory of .packet and .kframe files, one
+    file per packet (numbered) or key frame (named by key frame id). The
+    files hold no time: records are timestamped with the modification time
+    of their file, and key frames are placed before the first packet saved
+    after them.
+
+    @param directory: directory of .packet and .kframe files.
+    @type directory: C{string}.
+    @return: generator of records.
+    @rtype: C{generator}.
+    """
+    def numbered(extension):
+        files = []
+        for path in glob.glob(os.path.join(directory, '*' + extension)):
+            name = os.path.basename(path)[:-len(extension)]
+            if name.isdigit():
+                files.append((int(name), path))
+        return sorted(files)
+
+    def read(path):
+        with open(path, 'rb') as _file:
+            return _file.read()
+
+    keyframes = sorted((os.path.getmtime(path), key_frame_id, path)
+                       for key_frame_id, path in numbered('.kframe'))
+    keyframes.reverse()
+    sequence = 0
+    for _, path in numbered('.packet'):
+        timestamp = os.path.getmtime(path)
+        while keyframes and keyframes[-1][0] <= timestamp:
+            mtime, key_frame_id, kframe = keyframes.pop()
+            yield Record(sequence, mtime, KEY_FRAME, key_frame_id,
+                         read(kframe))
+            sequence += 1
+        yield Record(sequence, timestamp, PACKET, 0, read(path))
+        sequence += 1
+    while keyframes:
+        mtime, key_frame_id, kframe = keyframes.pop()
+        yield Record(sequence, mtime, KEY_FRAME, key_frame_id, read(kframe))
+        sequence += 1
+
+def source_records(source):
+    """iterate the records of a packet log or of .packet/.kframe files."""
+    if list_segments(source):
+        return iter(PacketLogReader(source))
+    return legacy_records(source)
+
+def convert(source, path, codec=ZLIB, block_size=BLOCK_SIZE):
+    """
+    Convert a saved session into an archive.
+
+    @param source: packet log directory, or directory of .packet and .kframe
+                   files.
+    @type source: C{string}.
+    @param path: path of the archive file.
+    @type path: C{string}.
+    @param codec: block codec; see L{ArchiveWriter}.
+    @type codec: C{string}.
+    @param block_size: uncompressed size (bytes) of a block.
+    @type block_size: C{int}.
+    @return: archive statistics; see L{ArchiveWriter.stats}.
+    @rtype: C{dict}.
+    """
+    writer = ArchiveWriter(path, codec, block_size)
+    try:
+        for record in source_records(source):
+            writer.append(record.payload, record.kind, record.key_frame_id,
+                          record.timestamp, record.sequence)
+    finally:
+        writer.close()
+    return writer.stats()
+
+def benchmark(source, codecs=None, block_size=BLOCK_SIZE, seeks=100,
+              directory=None):
+    """
+    Measure compression ratio and read throughput of codecs on a session.
+
+    @param source: packet log directory, or directory of .packet and .kframe
+                   files.
+    @type source: C{string}.
+    @param codecs: codec names (default: all available codecs).
+    @type codecs: C{list}.
+    @param block_size: uncompressed size (bytes) of a block.
+    @type block_size: C{int}.
+    @param seeks: number of random record lookups to time.
+    @type seeks: C{int}.
+    @param directory: directory of the temporary archives.
+    @type directory: C{string}.
+    @return: generator of results by codec: archive size, compression
+             ratio, write and sequential read throughput (raw bytes/s) and
+             average random lookup time (seconds).
+    @rtype: C{generator}.
+    """
+    for codec in codecs or CODECS.keys():
+        handle, path = tempfile.mkstemp(suffix='.f1a', dir=directory)
+        os.close(handle)
+        try:
+            start = time.time()
+            stats = convert(source, path, codec, block_size)
+            write_time = time.time() - start
+            reader = ArchiveReader(path)
+            try:
+                start = time.time()
+                for _ in reader:
+                    pass
+                read_time = time.time() - start
+                start = time.time()
+                for _ in xrange(seeks):
+                    sequence = random.randrange(max(stats['records'], 1))
+                    reader.cached = (None, None)
+                    next(reader.records(sequence), None)
+                seek_time = (time.time() - start) / max(seeks, 1)
+            finally:
+                reader.close()
+        finally:
+            os.remove(path)
+        raw_size = stats['raw_size']
+        yield {'codec': codec,
+               'size': stats['size'],
+               'ratio': raw_size / float(max(stats['size'], 1)),
+               'write_throughput': raw_size / max(write_time, 1e-9),
+               'read_throughput': raw_size / max(read_time, 1e-9),
+               'seek_time': seek_time}
+
+def main(argv=None):
+    """convert saved sessions into block-compressed archives."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    commands = parser.add_subparsers(dest='command')
+    convert_parser = commands.add_parser('convert',
+                                         help='convert a saved session')
+    convert_parser.add_argument('source', help='packet log directory or '
+                                'directory of .packet/.kframe files')
+    convert_parser.add_argument('archive', help='archive file')
+    convert_parser.add_argument('--codec', choices=CODEC_NAMES, default=ZLIB,
+                                help='block codec (default: %(default)s)')
+    bench_parser = commands.add_parser('bench',
+                                       help='compare codecs on a session')
+    bench_parser.add_argument('source', help='packet log directory or '
+                              'directory of .packet/.kframe files')
+    bench_parser.add_argument('--codec', choices=CODEC_NAMES, action='append',
+                              help='codec to compare (default: all '
+                                   'available)')
+    for command in (convert_parser, bench_parser):
+        command.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                             help='uncompressed block size '
+                                  '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    megabyte = float(1 << 20)
+    if args.command == 'convert':
+        stats = convert(args.source, args.archive, args.codec,
+                        args.block_size)
+        print '{0} records in {1} blocks: {2:.1f} MB -> {3:.1f} MB ' \
+              '(ratio {4:.2f})'.format(stats['records'], stats['blocks'],
+                                       stats['raw_size'] / megabyte,
+                                       stats['size'] / megabyte,
+                                       stats['raw_size'] /
+                                       float(max(stats['size'], 1)))
+        return
+    print '{0:<6} {1:>10} {2:>6} {3:>11} {4:>11} {5:>9}'.format(
+          'codec', 'size', 'ratio', 'write MB/s', 'read MB/s', 'seek ms')
+    for result in benchmark(args.source, args.codec, args.block_size):
+        print '{0:<6} {1:>7.1f} MB {2:>6.2f} {3:>11.1f} {4:>11.1f} ' \
+              '{5:>9.2f}'.format(result['codec'], result['size'] / megabyte,
+                                 result['ratio'],
+                                 result['write_throughput'] / megabyte,
+                                 result['read_throughput'] / megabyte,
+                                 result['seek_time'] * 1000)
+
+if __name__ == '__main__':
+    main()
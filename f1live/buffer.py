@@ -0,0 +1,109 @@
+"""
+Receive buffer for stream protocols.
+"""
+import logging
+
+__all__ = ['ReceiveBuffer']
+
+log = logging.getLogger(__name__)
+
+class ReceiveBuffer(object):
+    """
+    Growable receive buffer with a read cursor: received data is appended
+    at the end, consumed data only moves the cursor. Consumed bytes are
+    discarded once they make up more than half of the buffer, so every byte
+    is copied a bounded number of times.
+    """
+
+    # do not bother compacting below COMPACT bytes
+    COMPACT = 4096
+
+    def __init__(self):
+        self.data = bytearray()
+        self.cursor = 0
+
+        # counters (consumed excludes bytes before the cursor)
+        self.received = 0
+        self.consumed = 0
+        self.peak = 0
+
+    def __len__(self):
+        return len(self.data) - self.cursor
+
+    def append(self, data):
+        """
+        Append received data.
+
+        @param data: received data.
+        @type data: C{string}.
+        """
+        self.data.extend(data)
+        self.received += len(data)
+        self.peak = max(self.peak, len(self))
+
+    def view(self, offset=0):
+        """
+        Return a read-only view on the unconsumed data, without copying.
+
+        @param offset: offset relative to the read cursor.
+        @type offset: C{int}.
+        @return: view on the unconsumed data.
+        @rtype: C{buffer}.
+        """
+        return buffer(self.data, self.cursor + offset)
+
+    def consume(self, size):
+        """
+        Consume data at the read cursor.
+
+        @param size: number of bytes to consume.
+        @type size: C{int}.
+        """
+        self.cursor = min(self.cursor + size, len(self.data))
+        self.compact()
+
+    def compact(self):
+        """discard consumed data once it makes up half of the buffer."""
+        if self.cursor >= self.COMPACT and 2 * self.cursor >= len(self.data):
+            del self.data[:self.cursor]
+            self.consumed += self.cursor
+            self.cursor = 0
+
+    def drain(self, parse):
+        """
+        Parse and consume all complete units (e.g. packets) in the buffer.
+
+        @param parse: function called with a view on the unconsumed data,
+                      returning the number of bytes it parsed or 0 when it
+                      needs more data.
+        @type parse: C{callable}.
+        """
+        data = self.data
+        cursor = self.cursor
+        end = len(data)
+        try:
+            while cursor < end:
+                size = parse(buffer(data, cursor))
+                if not size:
+                    break
+                cursor += size
+        finally:
+            self.cursor = min(cursor, end)
+            self.compact()
+
+    @property
+    def buffered(self):
+        """number of bytes received but not consumed yet."""
+        return len(self)
+
+    def stats(self):
+        """
+        Return buffer counters.
+
+        @return: counters by name.
+        @rtype: C{dict}.
+        """
+        return {'buffered': self.buffered,
+                'peak': self.peak,
+                'received': self.received,
+                'consumed': self.consumed + self.cursor}
@@ -6,7 +6,9 @@ import sys
 import os
 from tools.cli import ask
 
-__all__ = ['get_credentials', 'remove_credentials', 'get_firebase']
+__all__ = ['get_credentials', 'remove_credentials', 'get_firebase',
+           'get_metrics_port', 'get_timing', 'get_push_port',
+           'get_push_interface', 'get_push_origin']
 
 log = logging.getLogger(__name__)
 
@@ -14,6 +16,14 @@ CONFIG_FILE = '.f1rc'
 EMAIL = 'email'
 PASSWORD = 'password'
 FIREBASE = 'firebase'
+METRICS = 'metrics'
+TIMING = 'timing'
+PUSH = 'push'
+PUSH_INTERFACE = 'push_interface'
+PUSH_ORIGIN = 'push_origin'
+
+# the push server is only reachable from this host unless configured
+DEFAULT_PUSH_INTERFACE = '127.0.0.1'
 
 def get_credentials():
     """
@@ -82,3 +92,71 @@ def get_firebase():
     except (IOError, ValueError):
         return None
 
+def get_metrics_port():
+    """
+    Retrieve the port of the metrics endpoint from .f1rc file.
+
+    @return: http port or None if not specified.
+    @rtype: C{int}.
+    """
+    try:
+        config = dict(line.strip().split('=', 1) for line in open(CONFIG_FILE))
+        return int(config[METRICS])
+    except (IOError, ValueError, KeyError):
+        return None
+
+def get_timing():
+    """
+    Retrieve from .f1rc file whether to time every packet handler, e.g. to
+    find the handler slowing the stream down.
+
+    @return: True if timing is on (1, yes or true), False otherwise.
+    @rtype: C{bool}.
+    """
+    try:
+        config = dict(line.strip().split('=', 1) for line in open(CONFIG_FILE))
+        return config[TIMING].lower() in ('1', 'yes', 'true', 'on')
+    except (IOError, ValueError, KeyError):
+        return False
+
+def get_push_port():
+    """
+    Retrieve the port of the local push server from .f1rc file.
+
+    @return: http port or None if not specified.
+    @rtype: C{int}.
+    """
+    try:
+        config = dict(line.strip().split('=', 1) for line in open(CONFIG_FILE))
+        return int(config[PUSH])
+    except (IOError, ValueError, KeyError):
+        return None
+
+def get_push_interface():
+    """
+    Retrieve the interface of the local push server from .f1rc file; set it
+    (e.g. to 0.0.0.0) to serve dashboards on other hosts.
+
+    @return: interface, the loopback interface if not specified.
+    @rtype: C{string}.
+    """
+    try:
+        config = dict(line.strip().split('=', 1) for line in open(CONFIG_FILE))
+        return config[PUSH_INTERFACE]
+    except (IOError, ValueError, KeyError):
+        return DEFAULT_PUSH_INTERFACE
+
+def get_push_origin():
+    """
+    Retrieve the origin allowed to read the push server from web pages
+    served elsewhere (CORS) from .f1rc file.
+
+    @return: origin (e.g. http://dashboard.example or *), or None if not
+             specified.
+    @rtype: C{string}.
+    """
+    try:
+        config = dict(line.strip().split('=', 1) for line in open(CONFIG_FILE))
+        return config[PUSH_ORIGIN]
+    except (IOError, ValueError, KeyError):
+        return None
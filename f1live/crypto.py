@@ -1,20 +1,543 @@
 """
 Crypto operations.
+
+The live timing stream is encrypted with a simple xor cipher: every byte is
+xor'ed with the low octet of a 32-bit salt which is shifted (and xor'ed with
+the master key) once per byte. The salt is reset to a fixed seed at every key
+frame, so for a given key the keystream only depends on the offset since the
+last reset. L{KeyStream} exploits this by computing the keystream once per key
+into a table and decrypting whole blocks with a single xor.
 """
 import logging
+import threading
+import binascii
+import time
 import http
-import struct
+import metrics
+from array import array
+from collections import OrderedDict
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-__all__ = ['Crypto']
+__all__ = ['Crypto', 'DecryptionContext', 'KeyCache', 'KeyStream']
 
 log = logging.getLogger(__name__)
 
 CRYPTO_SEED = 0x55555555
+KEY_CACHE_FILE = '.f1keys'
+
+DECRYPT_LATENCY = metrics.histogram('f1live_decrypt_seconds',
+                                    'Time spent decrypting packet data.',
+                                    ('stream',))
+
+class KeyStream(object):
+    """Keystream table of a master key, starting from the crypto seed."""
+
+    # keep a salt checkpoint every CHECKPOINT bytes of keystream
+    CHECKPOINT = 4096
+    # never cache more than MAX_SIZE bytes of keystream per key
+    MAX_SIZE = 1 << 24
+    # keystream tables kept, least recently used ones are dropped
+    CACHE_SIZE = 4
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, key, seed=CRYPTO_SEED):
+        self.key = key
+        self.seed = seed
+        self.table = bytearray()
+        self.size = 0
+        self.salts = array('L', [seed])
+        # offset and salt reached last beyond the table
+        self.tail = (0, seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, key):
+        """
+        Get the shared keystream table of a master key.
+
+        @param key: master decryption key.
+        @type key: C{int}.
+        @return: keystream table for key.
+        @rtype: C{KeyStream}.
+        """
+        with cls._cache_lock:
+            try:
+                stream = cls._cache.pop(key)
+            except KeyError:
+                stream = KeyStream(key)
+            cls._cache[key] = stream
+            while len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last=False)
+            return stream
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, size):
+        """generate the keystream table up to (at least) size bytes."""
+        size = min(-(-size // self.CHECKPOINT) * self.CHECKPOINT,
+                   self.MAX_SIZE)
+        with self.lock:
+            if self.size >= size:
+                return
+            if size > len(self.table):
+                # grow into a new table; readers keep the old one
+                table = bytearray(min(max(size, 2 * len(self.table)),
+                                      self.MAX_SIZE))
+                table[:self.size] = self.table[:self.size]
+                self.table = table
+            salt = self.salts[-1]
+            for offset in xrange(self.size, size, self.CHECKPOINT):
+                chunk, salt = genkeystream(self.key, salt, self.CHECKPOINT)
+                self.table[offset:offset + self.CHECKPOINT] = chunk
+                self.salts.append(salt)
+            self.size = size
+
+    def salt_at(self, offset):
+        """
+        Return the salt after offset bytes of keystream.
+
+        @param offset: number of bytes since the seed.
+        @type offset: C{int}.
+        @return: salt value.
+        @rtype: C{int}.
+        """
+        index = min(offset // self.CHECKPOINT, len(self.salts) - 1)
+        start, salt = index * self.CHECKPOINT, self.salts[index]
+        tail = self.tail
+        if start < tail[0] <= offset:
+            # continue from the last salt reached beyond the table
+            start, salt = tail
+        return advance(self.key, salt, offset - start)
+
+    def decrypt(self, data, offset):
+        """
+        Decrypt data located at offset bytes since the seed.
+
+        @param data: data to decrypt.
+        @type data: C{string}.
+        @param offset: number of bytes since the seed.
+        @type offset: C{int}.
+        @return: decrypted data.
+        @rtype: C{string}.
+        """
+        end = offset + len(data)
+        if end > self.size:
+            self.extend(end)
+        table = self.table
+        if end > self.size:
+            # beyond the cached table: generate on the fly
+            table, salt = genkeystream(self.key, self.salt_at(offset),
+                                       len(data))
+            self.tail = (end, salt)
+            offset = 0
+        return xor(data, table, offset)
+
+class KeyCache(object):
+    """
+    Master decryption keys by event id: an in-memory LRU in front of a
+    key cache file, so keys already known are never downloaded again.
+    """
+    def __init__(self, filename=KEY_CACHE_FILE, size=32):
+        self.filename = filename
+        self.size = size
+        self.keys = OrderedDict()
+        # keys of the key cache file, read once
+        self.saved = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, event_id):
+        """
+        Look up the key of an event in memory, then on disk.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @return: master decryption key or None if not cached.
+        @rtype: C{int}.
+        """
+        event_id = event_id.zfill(5)
+        with self.lock:
+            try:
+                key = self.keys.pop(event_id)
+            except KeyError:
+                key = self.saved_keys().get(event_id)
+                if key is None:
+                    return None
+            self.remember(event_id, key)
+            return key
+
+    def put(self, event_id, key):
+        """
+        Add the key of an event to the cache.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @param key: master decryption key.
+        @type key: C{int}.
+        """
+        event_id = event_id.zfill(5)
+        with self.lock:
+            known = self.keys.pop(event_id, None) == key
+            self.remember(event_id, key)
+            saved = self.saved_keys()
+            if known or saved.get(event_id) == key:
+                return
+            try:
+                with open(self.filename, 'a') as _file:
+                    _file.write('{0}={1:08x}\n'.format(event_id, key))
+            except IOError as err:
+                log.warning('Cannot save key: {0}'.format(err))
+            else:
+                saved[event_id] = key
+
+    def remember(self, event_id, key):
+        """insert key as most recently used; evict the least recently used."""
+        self.keys[event_id] = key
+        while len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+    def saved_keys(self):
+        """return the keys of the key cache file, reading it once."""
+        if self.saved is None:
+            self.saved = self.load()
+        return self.saved
+
+    def load(self):
+        """read all keys from the key cache file, skipping bad lines."""
+        keys = {}
+        try:
+            with open(self.filename) as _file:
+                for number, line in enumerate(_file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        event_id, key = line.strip().split('=', 1)
+                        keys[event_id] = int(key, 16)
+                    except ValueError:
+                        log.warning('Skipping bad line {0} of {1}'
+                                    .format(number, self.filename))
+        except IOError:
+            pass
+        return keys
+
+    def fetch(self, event_id, user_token):
+        """
+        Get the key of an event, downloading it if not cached.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @param user_token: user token from successful login.
+        @type user_token: C{string}.
+        @return: master decryption key.
+        @rtype: C{int}.
+        """
+        key = self.get(event_id)
+        if key is None:
+            response = http.get(key_url(event_id),
+                                params={'auth': user_token})
+            key = int(response.get_content(), 16)
+            self.put(event_id, key)
+        return key
+
+    def fetch_async(self, event_id, user_token):
+        """
+        Get the key of an event without blocking, downloading it on the
+        reactor if not cached.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @param user_token: user token from successful login.
+        @type user_token: C{string}.
+        @return: deferred firing with the master decryption key.
+        @rtype: C{Deferred}.
+        """
+        key = self.get(event_id)
+        if key is not None:
+            return succeed(key)
+        event_id = event_id.zfill(5)
+        waiter = Deferred()
+        if event_id in self.pending:
+            self.pending[event_id].append(waiter)
+            return waiter
+        self.pending[event_id] = [waiter]
+        defer = Deferred()
+        defer.addCallback(lambda content: int(content, 16))
+        # waiters are released whether the download succeeds or fails
+        defer.addCallbacks(self.fetched, self.failed,
+                           callbackArgs=(event_id,), errbackArgs=(event_id,))
+        try:
+            http.get_async(defer, key_url(event_id),
+                           params={'auth': user_token})
+        except Exception:
+            defer.errback()
+        return waiter
+
+    def fetched(self, key, event_id):
+        """callback when a key is downloaded."""
+        waiters = self.pending.pop(event_id, [])
+        self.put(event_id, key)
+        for waiter in waiters:
+            waiter.callback(key)
+
+    def failed(self, failure, event_id):
+        """errback when a key download failed."""
+        log.info('Cannot fetch key of event {0}: {1}'
+                 .format(event_id, failure.getErrorMessage()))
+        for waiter in self.pending.pop(event_id, []):
+            waiter.errback(failure)
+
+    def prefetch(self, event_id, user_token):
+        """
+        Fetch the key of an event in the background, if not cached.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @param user_token: user token from successful login.
+        @type user_token: C{string}.
+        """
+        defer = self.fetch_async(event_id, user_token)
+        defer.addErrback(lambda failure: None)
+
+def key_url(event_id):
+    """url of the master key of an event."""
+    return 'http://{0}/reg/getkey/{1}.asp'.format(http.F1_LIVE_SERVER,
+                                                  event_id.zfill(5))
+
+def genkeystream(key, salt, size):
+    """generate size bytes of keystream; return keystream and next salt."""
+    stream = bytearray(size)
+    for i in xrange(size):
+        salt = (salt >> 1) ^ (key if salt & 0x01 else 0)
+        stream[i] = salt & 0xff
+    return stream, salt
+
+def advance(key, salt, steps):
+    """advance salt by a number of steps."""
+    for _ in xrange(steps):
+        salt = (salt >> 1) ^ (key if salt & 0x01 else 0)
+    return salt
+
+def xor(data, table, offset):
+    """xor data with the keystream table at offset into a string."""
+    size = len(data)
+    if not size:
+        return ''
+    if numpy is not None:
+        dec = numpy.frombuffer(data, numpy.uint8) ^ \
+              numpy.frombuffer(table, numpy.uint8, size, offset)
+        return dec.tostring()
+    stream = memoryview(table)[offset:offset + size]
+    value = int(binascii.hexlify(data), 16) ^ \
+            int(binascii.hexlify(stream), 16)
+    return binascii.unhexlify('%0*x' % (2 * size, value))
+
+class DecryptionContext(object):
+    """
+    Decryption state of a single stream: master key and offset since the
+    last reset. Contexts are independent of each other, so many streams can
+    be decrypted concurrently; the keystream tables are shared per key.
+    """
+    def __init__(self, user_token=None, event_id=None, name=''):
+        """
+        @param user_token: user token to download keys with (default: the
+                           process-wide token).
+        @type user_token: C{string}.
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @param name: name of the stream in metrics.
+        @type name: C{string}.
+        """
+        self.user_token = user_token
+        self.event_id = event_id
+        self.name = name
+        self.key = None
+        self.stream = None
+        self.offset = 0
+
+    def __enter__(self):
+        """make this the active context of the current thread."""
+        Crypto.enter(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        Crypto.exit()
+        return False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('stream', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_key(self.key)
+
+    def load_key(self, event_id):
+        """
+        Load master decryption key of an event.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        """
+        self.event_id = event_id
+        self.set_key(Crypto.keys.fetch(event_id, self.get_user_token()))
+
+    def load_key_async(self, event_id):
+        """
+        Load master decryption key of an event without blocking.
+
+        @param event_id: event id.
+        @type event_id: C{string}.
+        @return: deferred firing with the key once it is set.
+        @rtype: C{Deferred}.
+        """
+        defer = Crypto.keys.fetch_async(event_id, self.get_user_token())
+        def set_key(key):
+            self.event_id = event_id
+            self.set_key(key)
+            return key
+        return defer.addCallback(set_key)
+
+    def get_user_token(self):
+        """user token of this context, or the process-wide one."""
+        return self.user_token or Crypto.user_token
+
+    def set_key(self, key):
+        """
+        Set master decryption key.
+
+        @param key: master decryption key (or None).
+        @type key: C{int}.
+        """
+        self.key = key
+        self.stream = KeyStream.get(key) if key is not None else None
+
+    def key_frame_context(self):
+        """
+        Return a context to decrypt a key frame with: key frames are
+        encrypted from the seed with the key of the stream, independently
+        of the offset the stream is at.
+
+        @return: new context with the key of this one.
+        @rtype: C{DecryptionContext}.
+        """
+        context = DecryptionContext(self.user_token, self.event_id,
+                                    self.name)
+        context.set_key(self.key)
+        return context
+
+    def reset(self):
+        """
+        Reset salt to initial seed, as happens on every key frame.
+        """
+        self.offset = 0
+
+    def get_salt(self):
+        """
+        Return the current salt.
+
+        @return: salt after the bytes decrypted since the last reset.
+        @rtype: C{int}.
+        """
+        return self.stream.salt_at(self.offset)
+
+    def decrypt(self, data):
+        """
+        Decrypt the given data.
+
+        @param data: data to decrypt.
+        @type data: C{string}.
+        @return: decrypted data.
+        @rtype: C{string}.
+        """
+        start = time.time()
+        dec = self.stream.decrypt(data, self.offset)
+        self.offset += len(data)
+        DECRYPT_LATENCY.observe(time.time() - start, (self.name,))
+        return dec
+
+    def checkpoint(self):
+        """
+        Take a checkpoint of the decryption state.
+
+        @return: JSON-serializable checkpoint to pass to L{restore}.
+        @rtype: C{list}.
+        """
+        return [self.event_id, self.key, self.offset]
+
+    def restore(self, checkpoint):
+        """
+        Restore the decryption state from a checkpoint.
+
+        @param checkpoint: checkpoint taken by L{checkpoint}.
+        @type checkpoint: C{list}.
+        """
+        self.event_id, key, self.offset = checkpoint
+        self.set_key(key)
 
 class Crypto(object):
-    """Basic crypto operations."""
+    """
+    Basic crypto operations on the active decryption context of the current
+    thread (a process-wide default context unless another is activated).
+    """
+
+    user_token = None
+    keys = KeyCache()
+    default = DecryptionContext()
+    _local = threading.local()
+
+    @classmethod
+    def context(cls):
+        """
+        Return the active decryption context of the current thread.
 
-    salt = CRYPTO_SEED
+        @return: active decryption context.
+        @rtype: C{DecryptionContext}.
+        """
+        return getattr(cls._local, 'context', None) or cls.default
+
+    @classmethod
+    def activate(cls, context):
+        """
+        Make a decryption context active in the current thread.
+
+        @param context: decryption context (None for the default context).
+        @type context: C{DecryptionContext}.
+        @return: previously active context.
+        @rtype: C{DecryptionContext}.
+        """
+        previous = getattr(cls._local, 'context', None)
+        cls._local.context = context
+        return previous
+
+    @classmethod
+    def enter(cls, context):
+        """
+        Make a decryption context active in the current thread until the
+        matching L{exit}; contexts may be entered again while active.
+
+        @param context: decryption context.
+        @type context: C{DecryptionContext}.
+        """
+        try:
+            stack = cls._local.stack
+        except AttributeError:
+            stack = cls._local.stack = []
+        stack.append(cls.activate(context))
+
+    @classmethod
+    def exit(cls):
+        """reactivate the context active before the last L{enter}."""
+        cls.activate(cls._local.stack.pop())
 
     @classmethod
     def set_user_token(cls, user_token):
@@ -34,17 +557,24 @@ class Crypto(object):
         @param event_id: current event id.
         @type event_id: C{int}.
         """
-        response = http.get('http://{0}/reg/getkey/{1}.asp'
-                          .format(http.F1_LIVE_SERVER, event_id.zfill(5)),
-                        params={'auth': cls.user_token})
-        cls.key = int(response.get_content(), 16)
+        cls.context().load_key(event_id)
 
     @classmethod
     def reset_decryption_key(cls):
         """
         Reset salt to initial seed.
         """
-        cls.salt = CRYPTO_SEED
+        cls.context().reset()
+
+    @classmethod
+    def get_salt(cls):
+        """
+        Return the current salt.
+
+        @return: salt after the bytes decrypted since the last reset.
+        @rtype: C{int}.
+        """
+        return cls.context().get_salt()
 
     @classmethod
     def decrypt(cls, data):
@@ -56,10 +586,4 @@ class Crypto(object):
         @return: decrypted data.
         @rtype: C{string}.
         """
-        dec = []
-        for byte in data:
-            byte = struct.unpack('B', byte)[0]
-            cls.salt = (cls.salt >> 1) ^ (cls.key if cls.salt & 0x01 else 0)
-            dec.append(struct.pack('B', byte ^ (cls.salt & 0xff)))
-        return ''.join(dec)
-
+        return cls.context().decrypt(data)
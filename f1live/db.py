@@ -2,11 +2,33 @@
 Interface to save raw key frames and raw packets.
 """
 import logging
+import threading
+import time
+import Queue
+import metrics
+from packetlog import PacketLogWriter
+from packetlog import PacketLogReader
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from packetlog import CHECKPOINT
 
-__all__ = ['save_key_frame', 'save_packet']
+__all__ = ['save_key_frame', 'save_packet', 'save_checkpoint', 'open_log',
+           'close', 'stats',
+           'PacketLogReader', 'BackgroundWriter', 'PacketStore']
 
 log = logging.getLogger(__name__)
 
+DB_DIRECTORY = '.'
+
+# backpressure policies when the write queue is full
+BLOCK = 'block'
+DROP = 'drop'
+
+WRITE_LATENCY = metrics.histogram('f1live_db_write_seconds',
+                                  'Time from queueing a record to the group '
+                                  'commit writing it, by packet log.',
+                                  ('log',))
+
 def save_key_frame(frame, key_frame_id):
     """
     Save a raw key frame with id.
@@ -24,23 +46,268 @@ def save_packet(packet):
 
     @param packet: packet to save.
     @type packet: C{string}.
+    @return: False if the packet was dropped, True otherwise.
+    @rtype: C{bool}.
+    """
+    return Database().save_packet(packet)
+
+def save_checkpoint(checkpoint):
+    """
+    Save a serialized state checkpoint.
+
+    @param checkpoint: serialized state.
+    @type checkpoint: C{string}.
+    """
+    Database().save_checkpoint(checkpoint)
+
+def open_log(directory=DB_DIRECTORY, background=True, **options):
+    """
+    Open the packet log key frames and packets are saved to.
+
+    @param directory: directory of the packet log.
+    @type directory: C{string}.
+    @param background: write from a background thread (default: True).
+    @type background: C{bool}.
+    @param **options: L{PacketLogWriter} options (segment_size, fsync,
+                      buffer_size, index_interval) and L{BackgroundWriter}
+                      options (queue_size, batch_size, backpressure).
+    @type **options: dict.
+    """
+    Database.open(directory, background, **options)
+
+def close():
+    """
+    Flush and close the packet log.
+    """
+    Database.close()
+
+def stats():
+    """
+    Return persistence metrics.
+
+    @return: metrics by name (empty when no background writer runs).
+    @rtype: C{dict}.
     """
-    Database().save_packet(packet)
+    writer = Database.writer
+    if isinstance(writer, BackgroundWriter):
+        return writer.stats()
+    return {}
+
+def make_writer(directory=DB_DIRECTORY, background=True, **options):
+    """create a packet log writer; see L{open_log}."""
+    queue_options = dict((name, options.pop(name))
+                         for name in ('queue_size', 'batch_size',
+                                      'backpressure')
+                         if name in options)
+    writer = PacketLogWriter(directory, **options)
+    if background:
+        writer = BackgroundWriter(writer, name=directory, **queue_options)
+    return writer
+
+class BackgroundWriter(object):
+    """
+    Packet log writer running in a background thread: records are queued
+    in a bounded queue and written in batches with a single flush each
+    (group commit), so the caller never waits for the disk.
+    """
+    def __init__(self, writer, queue_size=10000, batch_size=1000,
+                 backpressure=DROP, name=''):
+        """
+        Start writing to a packet log in the background.
+
+        @param writer: packet log writer, used by the background thread only.
+        @type writer: C{PacketLogWriter}.
+        @param queue_size: maximum number of queued records.
+        @type queue_size: C{int}.
+        @param batch_size: maximum number of records per group commit.
+        @type batch_size: C{int}.
+        @param backpressure: policy when the queue is full for a packet:
+                             'drop' (default) discards it without ever
+                             blocking the caller, 'block' waits, e.g. for
+                             offline use. Key frames and checkpoints are
+                             never dropped: they are queued beyond
+                             queue_size if needed.
+        @type backpressure: C{string}.
+        @param name: name of the packet log in metrics.
+        @type name: C{string}.
+        """
+        if backpressure not in (BLOCK, DROP):
+            raise ValueError("Unknown value of 'backpressure' argument")
+        self.writer = writer
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.backpressure = backpressure
+        self.labels = (name,)
+        self.closed = False
+        # dropping packets is bounded by hand, so puts never block
+        self.queue = Queue.Queue(queue_size if backpressure == BLOCK else 0)
+
+        # metrics
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+        self.thread = threading.Thread(target=self.run, name='db-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, payload, kind=PACKET, key_frame_id=0):
+        """
+        Queue a record; see L{PacketLogWriter.append}.
+
+        @return: False if the record was dropped, True if it was queued.
+        @rtype: C{bool}.
+        """
+        if self.closed:
+            return False
+        if kind == PACKET and self.backpressure == DROP and \
+           self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            return False
+        self.queue.put((payload, kind, key_frame_id, time.time()))
+        return True
+
+    def run(self):
+        """write queued records until closed."""
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            # records racing with close are queued after the sentinel
+            closing = None in batch
+            if closing:
+                batch = [record for record in batch if record is not None]
+            try:
+                self.commit(batch)
+            except Exception:
+                # the thread must outlive any error, or the queue fills up
+                self.failed += len(batch)
+                log.exception('Cannot write packet log')
+            if closing:
+                try:
+                    self.writer.close()
+                except Exception:
+                    log.exception('Cannot close packet log')
+                return
+
+    def commit(self, batch):
+        """write a batch of records with one flush."""
+        if not batch:
+            return
+        for payload, kind, key_frame_id, timestamp in batch:
+            self.writer.append(payload, kind, key_frame_id, timestamp)
+        self.writer.flush()
+        now = time.time()
+        for record in batch:
+            WRITE_LATENCY.observe(now - record[3], self.labels)
+        latency = now - batch[0][3]
+        self.written += len(batch)
+        self.batches += 1
+        self.latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def close(self):
+        """write all queued records and close the packet log."""
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        """
+        Return writer metrics.
+
+        @return: metrics by name.
+        @rtype: C{dict}.
+        """
+        return {'queue_depth': self.queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'batches': self.batches,
+                'write_latency': self.latency,
+                'max_write_latency': self.max_latency}
 
 class Database(object):
-    """Interface to save key frames and packets to file system."""
-    packet_id = 0
+    """Interface to save key frames and packets to a packet log."""
+    writer = None
+
+    @classmethod
+    def open(cls, directory=DB_DIRECTORY, background=True, **options):
+        """(re)open the packet log."""
+        cls.close()
+        cls.writer = make_writer(directory, background, **options)
+
+    @classmethod
+    def close(cls):
+        """close the packet log."""
+        if cls.writer is not None:
+            cls.writer.close()
+            cls.writer = None
+
+    @classmethod
+    def get_writer(cls):
+        """return the packet log writer, opening the default one if needed."""
+        if cls.writer is None:
+            cls.open()
+        return cls.writer
 
     @classmethod
     def save_key_frame(cls, frame, key_frame_id):
-        """save raw key frame to .kframe file."""
-        with open('{0}.kframe'.format(key_frame_id), 'w') as _file:
-            _file.write(frame)
+        """append raw key frame record to the packet log."""
+        cls.get_writer().append(frame, kind=KEY_FRAME,
+                                key_frame_id=int(key_frame_id))
 
     @classmethod
     def save_packet(cls, packet):
-        """save raw packet to .packet file."""
-        with open('{0:0>5d}.packet'.format(cls.packet_id), 'w') as _file:
-            _file.write(packet.raw)
-        cls.packet_id += 1
+        """append raw packet record to the packet log; False if dropped."""
+        return cls.get_writer().append(packet.raw, kind=PACKET) is not False
+
+    @classmethod
+    def save_checkpoint(cls, checkpoint):
+        """append state checkpoint record to the packet log."""
+        cls.get_writer().append(checkpoint, kind=CHECKPOINT)
+
+class PacketStore(object):
+    """
+    Packet log of its own, with the interface of this module, e.g. one
+    per stream when recording several streams in one process.
+    """
+    def __init__(self, directory, background=True, **options):
+        """
+        Open a packet log; see L{open_log}.
+
+        @param directory: directory of the packet log.
+        @type directory: C{string}.
+        @param background: write from a background thread (default: True).
+        @type background: C{bool}.
+        """
+        self.writer = make_writer(directory, background, **options)
+
+    def save_key_frame(self, frame, key_frame_id):
+        """append raw key frame record to the packet log."""
+        self.writer.append(frame, kind=KEY_FRAME,
+                           key_frame_id=int(key_frame_id))
+
+    def save_packet(self, packet):
+        """append raw packet record to the packet log; False if dropped."""
+        return self.writer.append(packet.raw, kind=PACKET) is not False
+
+    def save_checkpoint(self, checkpoint):
+        """append state checkpoint record to the packet log."""
+        self.writer.append(checkpoint, kind=CHECKPOINT)
+
+    def close(self):
+        """flush and close the packet log."""
+        self.writer.close()
 
+    def stats(self):
+        """return persistence metrics; see L{stats}."""
+        if isinstance(self.writer, BackgroundWriter):
+            return self.writer.stats()
+        return {}
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""
+Parallel offline decoding of saved sessions.
+
+The cipher state is reset at every key frame packet of the stream, so the
+packets between two key frame packets decrypt independently of the rest of
+the session. A packet log is split at key frame packets and the chunks are
+decoded in a process pool; results are merged back in log order.
+
+    > python decode.py sessions/2013-monaco --processes 8
+    412337 packets decoded in 9.8 s (42075 packets/s)
+"""
+import logging
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from collections import namedtuple
+import Packet
+from crypto import DecryptionContext
+from packetlog import MmapLogReader
+from packetlog import HEADER
+from packetlog import make_record
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from packetlog import CHECKPOINT
+from streaming import KeyFrameParser
+
+__all__ = ['decode_session', 'split', 'Decoded']
+
+log = logging.getLogger(__name__)
+
+# packet header: car id in bits 0-4, packet type in bits 5-8
+SYS_KEY_FRAME = 2
+
+Decoded = namedtuple('Decoded', 'sequence timestamp kind name car type value')
+
+def is_key_frame_packet(payload):
+    """tell whether a raw packet is a key frame packet (car 0, type 2)."""
+    if len(payload) < 2:
+        return False
+    header = ord(payload[0]) | ord(payload[1]) << 8
+    return header & 0x1f == 0 and (header >> 5) & 0x0f == SYS_KEY_FRAME
+
+def split(reader):
+    """
+    Split a packet log into chunks that decode independently: every chunk
+    but the first starts at a key frame packet.
+
+    @param reader: reader of the packet log.
+    @type reader: C{PacketLogReader}.
+    @return: chunks as lists of (segment path, start offset, end offset).
+    @rtype: C{list}.
+    """
+    chunks = []
+    ranges = []
+    for _, path in reader.segments():
+        start = end = 0
+        for offset, header, payload in reader.scan(path):
+            if header[3] == PACKET and is_key_frame_packet(payload) and \
+               (ranges or end > start):
+                if end > start:
+                    ranges.append((path, start, end))
+                chunks.append(ranges)
+                ranges = []
+                start = offset
+            end = offset + HEADER.size + header[0]
+        if end > start:
+            ranges.append((path, start, end))
+    if ranges:
+        chunks.append(ranges)
+    return chunks
+
+def decode_packet(packet, sequence, timestamp, kind=PACKET):
+    """return the decoded fields of a packet."""
+    return Decoded(sequence, timestamp, kind, type(packet).__name__,
+                   getattr(packet, 'car', 0), getattr(packet, 'type', None),
+                   getattr(packet, 'value', None))
+
+def decode_record(record, crypto, key_frames=False):
+    """yield the decoded packets of a record."""
+    if record.kind == CHECKPOINT:
+        return
+    if record.kind == KEY_FRAME:
+        if not key_frames:
+            return
+        context = crypto.key_frame_context()
+        for packet in KeyFrameParser(str(record.payload), context):
+            yield decode_packet(packet, record.sequence, record.timestamp,
+                                KEY_FRAME)
+        return
+    try:
+        with crypto:
+            # copied: packets must not refer to the mapped segment
+            packet = Packet.packetize(str(record.payload))
+    except (Packet.NeedMoreData, Packet.UnknownPacketType) as err:
+        log.debug('Cannot decode record {0}: {1}'
+                  .format(record.sequence, err))
+        return
+    yield decode_packet(packet, record.sequence, record.timestamp)
+
+def decode_chunk(task):
+    """
+    Decode a chunk of a packet log, in a worker process.
+
+    @param task: chunk, decryption context and whether to decode key frames.
+    @type task: C{tuple}.
+    @return: decoded packets.
+    @rtype: C{list}.
+    """
+    ranges, crypto, key_frames = task
+    crypto.reset()
+    reader = MmapLogReader()
+    decoded = []
+    try:
+        for path, start, end in ranges:
+            for offset, header, payload in reader.scan(path, start=start):
+                if offset >= end:
+                    break
+                decoded.extend(decode_record(make_record(header, payload),
+                                             crypto, key_frames))
+    finally:
+        reader.close()
+    return decoded
+
+def decode_session(directory, processes=None, key=None, key_frames=False):
+    """
+    Decode all packets of a packet log, chunk by chunk in a process pool.
+
+    @param directory: directory of the packet log.
+    @type directory: C{string}.
+    @param processes: number of worker processes (default: one per core;
+                      1 decodes in this process).
+    @type processes: C{int}.
+    @param key: master decryption key (default: the key of the event
+                announced in the first chunk).
+    @type key: C{int}.
+    @param key_frames: also decode the packets of saved key frames.
+    @type key_frames: C{bool}.
+    @return: generator of decoded packets, in log order.
+    @rtype: C{generator}.
+    @raise ValueError: when the decryption key is unknown.
+    """
+    reader = MmapLogReader(directory)
+    try:
+        chunks = split(reader)
+    finally:
+        reader.close()
+    if not chunks:
+        return
+    crypto = DecryptionContext()
+    if key is not None:
+        crypto.set_key(key)
+    # the first chunk announces the event, which loads its key
+    for decoded in decode_chunk((chunks[0], crypto, key_frames)):
+        yield decoded
+    chunks = chunks[1:]
+    if not chunks:
+        return
+    if crypto.key is None:
+        raise ValueError('Decryption key of {0} is unknown'.format(directory))
+    if processes == 1:
+        for chunk in chunks:
+            for decoded in decode_chunk((chunk, crypto, key_frames)):
+                yield decoded
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        # keep a few chunks per worker in flight, so memory stays bounded
+        window = 2 * (processes or multiprocessing.cpu_count())
+        pending = deque()
+        tasks = iter(chunks)
+        while True:
+            while len(pending) < window:
+                chunk = next(tasks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.apply_async(decode_chunk,
+                                                ((chunk, crypto, key_frames),)))
+            if not pending:
+                break
+            for decoded in pending.popleft().get():
+                yield decoded
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def main(argv=None):
+    """decode a saved session and report the decoding rate."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('directory', help='packet log directory')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--key', type=lambda value: int(value, 16),
+                        default=None, help='master decryption key (hex)')
+    args = parser.parse_args(argv)
+    start = time.time()
+    count = 0
+    for _ in decode_session(args.directory, args.processes, args.key):
+        count += 1
+    elapsed = time.time() - start
+    print '{0} packets decoded in {1:.1f} s ({2:.0f} packets/s)' \
+          .format(count, elapsed, count / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+    main()
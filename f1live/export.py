@@ -0,0 +1,289 @@
+#!/usr/bin/python
+"""
+Columnar export of decoded sessions.
+
+Decoded packets are split into one table per packet type, with the columns
+
+    sequence   int64     record sequence number in the packet log
+    timestamp  float64   seconds since the epoch
+    car        uint8     car id (0 for system packets)
+    type       int8      packet type (-1 if none)
+    value      bytes     cell text
+    number     float64   numeric cell value: seconds for times, NaN if none
+
+and written chunk by chunk, so memory stays bounded whatever the session
+length:
+
+  - npy: a directory per packet type with one .npy file per column, which
+    can be memory-mapped (numpy.load(path, mmap_mode='r')).
+  - npz: one compressed .npz file per packet type, compressed from the
+    memory-mapped .npy columns.
+  - parquet: one Parquet file per packet type, a row group per chunk
+    (requires pyarrow).
+
+    > python export.py sessions/2013-monaco exports/2013-monaco
+    CarPacket           398112 rows
+    SystemCommentary      1412 rows
+"""
+import logging
+import os
+import shutil
+import argparse
+from abc import ABCMeta
+from abc import abstractmethod
+from decode import decode_session
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__all__ = ['export_session', 'load_table', 'to_number', 'FORMATS']
+
+log = logging.getLogger(__name__)
+
+NPY = 'npy'
+NPZ = 'npz'
+PARQUET = 'parquet'
+FORMATS = (NPY, NPZ, PARQUET)
+
+COLUMNS = ('sequence', 'timestamp', 'car', 'type', 'value', 'number')
+
+# rows buffered per packet type before writing a chunk
+CHUNK_SIZE = 1 << 16
+
+def to_number(value):
+    """
+    Return the numeric value of a cell: times ([h:]m:ss.sss) in seconds,
+    gaps and other numbers as floats, NaN when not numeric.
+
+    @param value: cell text.
+    @type value: C{string}.
+    @rtype: C{float}.
+    """
+    if value is None:
+        return float('nan')
+    try:
+        number = 0.0
+        for part in str(value).strip().lstrip('+').split(':'):
+            number = number * 60 + float(part)
+        return number
+    except ValueError:
+        return float('nan')
+
+def to_row(decoded):
+    """return the column values of a decoded packet."""
+    value = decoded.value
+    return (decoded.sequence, decoded.timestamp, decoded.car or 0,
+            -1 if decoded.type is None else decoded.type,
+            '' if value is None else str(value), to_number(value))
+
+class TableWriter(object):
+    """
+    Rows of one packet type, buffered and written a chunk at a time; each
+    format implements L{write_chunk}.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.count = 0
+        self.chunks = 0
+
+    def append(self, row):
+        """buffer a row, writing a chunk when the buffer is full."""
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """write the buffered rows as a chunk."""
+        if not self.rows:
+            return
+        columns = zip(*self.rows)
+        self.write_chunk(columns)
+        self.count += len(self.rows)
+        self.chunks += 1
+        self.rows = []
+
+    @abstractmethod
+    def write_chunk(self, columns):
+        """write the columns of a chunk."""
+
+    def close(self):
+        """write the remaining rows and finish the table."""
+        self.flush()
+
+class NumpyTableWriter(TableWriter):
+    """
+    Table of .npy columns: chunks are saved to separate files, then copied
+    into one memory-mapped array per column.
+    """
+    DTYPES = ('int64', 'float64', 'uint8', 'int8', None, 'float64')
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, compress=False):
+        TableWriter.__init__(self, path, chunk_size)
+        self.compress = compress
+        self.directory = path + '.chunks' if compress else path
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def chunk_path(self, column, chunk):
+        """path of the chunk file of a column."""
+        return os.path.join(self.directory,
+                            '{0}.{1:06d}.npy'.format(column, chunk))
+
+    def write_chunk(self, columns):
+        for name, dtype, values in zip(COLUMNS, self.DTYPES, columns):
+            # values are fixed-width byte strings as wide as the widest one
+            array = numpy.array(values, dtype=dtype or 'S')
+            numpy.save(self.chunk_path(name, self.chunks), array)
+
+    def close(self):
+        self.flush()
+        arrays = {}
+        for name in COLUMNS:
+            paths = [self.chunk_path(name, chunk)
+                     for chunk in range(self.chunks)]
+            chunks = [numpy.load(path, mmap_mode='r') for path in paths]
+            if chunks:
+                dtype = max((chunk.dtype for chunk in chunks),
+                            key=lambda dtype: dtype.itemsize)
+            else:
+                dtype = 'S1' if name == 'value' else \
+                        self.DTYPES[COLUMNS.index(name)]
+            column = numpy.lib.format.open_memmap(
+                            os.path.join(self.directory, name + '.npy'),
+                            mode='w+', dtype=dtype, shape=(self.count,))
+            offset = 0
+            for chunk in chunks:
+                column[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            column.flush()
+            del chunks
+            for path in paths:
+                os.remove(path)
+            arrays[name] = column
+        if self.compress:
+            numpy.savez_compressed(self.path + '.npz', **arrays)
+            del arrays
+            shutil.rmtree(self.directory)
+
+class ParquetTableWriter(TableWriter):
+    """Parquet file with a row group per chunk."""
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        TableWriter.__init__(self, path, chunk_size)
+        self.types = (pyarrow.int64(), pyarrow.float64(), pyarrow.uint8(),
+                      pyarrow.int8(), pyarrow.binary(), pyarrow.float64())
+        self.schema = pyarrow.schema([pyarrow.field(name, kind)
+                                      for name, kind in zip(COLUMNS,
+                                                            self.types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path + '.parquet',
+                                                    self.schema)
+
+    def write_chunk(self, columns):
+        arrays = [pyarrow.array(list(values), type=kind)
+                  for values, kind in zip(columns, self.types)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                          list(COLUMNS)))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def table_writer(path, format, chunk_size):
+    """create the table writer of a format."""
+    if format == PARQUET:
+        if pyarrow is None:
+            raise ImportError('Parquet export requires pyarrow')
+        return ParquetTableWriter(path, chunk_size)
+    if numpy is None:
+        raise ImportError('NumPy export requires numpy')
+    return NumpyTableWriter(path, chunk_size, compress=format == NPZ)
+
+def export_session(directory, output, format=NPY, chunk_size=CHUNK_SIZE,
+                   processes=None, key=None):
+    """
+    Export the decoded packets of a packet log into one columnar table per
+    packet type.
+
+    @param directory: directory of the packet log.
+    @type directory: C{string}.
+    @param output: output directory.
+    @type output: C{string}.
+    @param format: 'npy' (default), 'npz' or 'parquet'.
+    @type format: C{string}.
+    @param chunk_size: rows buffered per packet type before writing.
+    @type chunk_size: C{int}.
+    @param processes: decoding processes; see L{decode_session}.
+    @type processes: C{int}.
+    @param key: master decryption key; see L{decode_session}.
+    @type key: C{int}.
+    @return: number of rows by packet type.
+    @rtype: C{dict}.
+    @raise ValueError: when value of 'format' argument is unknown.
+    @raise ImportError: when the library of the format is not installed.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown value of 'format' argument")
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    tables = {}
+    try:
+        for decoded in decode_session(directory, processes, key):
+            try:
+                table = tables[decoded.name]
+            except KeyError:
+                table = tables[decoded.name] = table_writer(
+                            os.path.join(output, decoded.name), format,
+                            chunk_size)
+            table.append(to_row(decoded))
+    finally:
+        for table in tables.values():
+            table.close()
+    return dict((name, table.count) for name, table in tables.items())
+
+def load_table(output, name):
+    """
+    Load a table exported in npy format, memory-mapped.
+
+    @param output: export directory.
+    @type output: C{string}.
+    @param name: packet type name.
+    @type name: C{string}.
+    @return: arrays by column name.
+    @rtype: C{dict}.
+    """
+    return dict((column,
+                 numpy.load(os.path.join(output, name, column + '.npy'),
+                            mmap_mode='r'))
+                for column in COLUMNS)
+
+def main(argv=None):
+    """export a saved session into columnar tables per packet type."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('directory', help='packet log directory')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--format', choices=FORMATS, default=NPY,
+                        help='table format (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='rows per chunk (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='decoding processes (default: one per core)')
+    args = parser.parse_args(argv)
+    counts = export_session(args.directory, args.output, args.format,
+                            args.chunk_size, args.processes)
+    for name in sorted(counts):
+        print '{0:<16} {1:>10} rows'.format(name, counts[name])
+
+if __name__ == '__main__':
+    main()
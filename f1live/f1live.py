@@ -3,8 +3,12 @@ F1 live timing client.
 """
 import logging
 import sys
+import time
+import argparse
 import config
 import http
+import db
+import metrics
 import streaming
 from crypto import Crypto
 from twisted.internet import reactor
@@ -15,10 +19,11 @@ class LoginError(Exception):
     """login error exception."""
     pass
 
-def login(credentials):
-    """log on to the f1 live timing web service."""
+def login(credentials, server=None):
+    """log on to the f1 live timing web service (default: the live server)."""
     email, password = credentials
-    response = http.post(url='http://{0}/reg/login'.format(http.F1_LIVE_SERVER),
+    response = http.post(url='http://{0}/reg/login'
+                             .format(server or http.F1_LIVE_SERVER),
                   data={'email': email, 'password': password},
                   headers={'User-Agent': __name__,
                            'Content-Type': 'application/x-www-form-urlencoded'})
@@ -26,6 +31,17 @@ def login(credentials):
         raise LoginError("Login failed!")
     return response.get_cookie('USER')
 
+def push_server(name):
+    """start the push server if a port is configured."""
+    port = config.get_push_port()
+    if not port:
+        return None
+    # imported here: the push server is optional
+    from push import PushServer
+    server = PushServer(name=name, origin=config.get_push_origin())
+    server.listen(port, config.get_push_interface())
+    return server
+
 def main():
     """start eventloop."""
     try:
@@ -33,8 +49,13 @@ def main():
         if not user_token:
             raise LoginError("Invalid user token cookie!")
         Crypto.set_user_token(user_token)
-        reactor.connectTCP(http.F1_LIVE_SERVER, 4321,
-                           streaming.StreamingClientFactory())
+        factory = streaming.StreamingClientFactory(
+                        push=push_server('live'), timing=config.get_timing())
+        reactor.connectTCP(http.live_host(), http.F1_LIVE_PORT, factory)
+        reactor.addSystemEventTrigger('before', 'shutdown', db.close)
+        port = config.get_metrics_port()
+        if port:
+            metrics.serve(port)
     except LoginError as err:
         print str(err) + " Please try again."
         config.remove_credentials()
@@ -45,5 +66,123 @@ def main():
     else:
         reactor.run()
 
+def read_feeds(path):
+    """
+    Read stream definitions: one stream per line as name, host[:port] and
+    optionally the email address and password of its account.
+
+    @param path: feeds file.
+    @type path: C{string}.
+    @return: (name, host, port, credentials) of every stream; credentials
+             are None when not given.
+    @rtype: C{list}.
+    """
+    feeds = []
+    with open(path) as _file:
+        for line in _file:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) not in (2, 4):
+                raise ValueError('Invalid feed: {0}'.format(line.strip()))
+            host, _, port = fields[1].partition(':')
+            credentials = tuple(fields[2:]) or None
+            feeds.append((fields[0], host, int(port or http.F1_LIVE_PORT),
+                          credentials))
+    return feeds
+
+def multi(argv=None):
+    """record several redundant streams of a session in one process."""
+    # imported here: fan-in is not needed for a single stream
+    from fanin import FanIn
+    parser = argparse.ArgumentParser(prog='f1live multi',
+                                     description=multi.__doc__)
+    parser.add_argument('feeds',
+                        help='file with one stream per line: '
+                             'name host[:port] [email password]')
+    args = parser.parse_args(argv)
+    try:
+        feeds = read_feeds(args.feeds)
+        timing = config.get_timing()
+        fanin = FanIn(streaming.StreamingClientFactory(
+                                name='merged', push=push_server('merged'),
+                                timing=timing))
+        tokens = {}
+        for name, host, port, credentials in feeds:
+            credentials = credentials or config.get_credentials()
+            # each stream logs in to and fetches key frames from its host
+            if (credentials, host) not in tokens:
+                tokens[credentials, host] = login(credentials, host)
+                if not tokens[credentials, host]:
+                    raise LoginError("Invalid user token cookie!")
+            factory = fanin.add_feed(name, tokens[credentials, host],
+                                     server=host, timing=timing)
+            reactor.connectTCP(host, port, factory)
+        reactor.addSystemEventTrigger('before', 'shutdown', fanin.close)
+        port = config.get_metrics_port()
+        if port:
+            metrics.serve(port)
+    except (IOError, ValueError, LoginError, http.ConnectionError) as err:
+        print str(err)
+        sys.exit(1)
+    else:
+        reactor.run()
+
+def replay(argv=None):
+    """replay a saved session through the streaming client."""
+    # imported here: replay is not needed for live sessions
+    from replay import Replayer
+    parser = argparse.ArgumentParser(prog='f1live replay',
+                                     description=replay.__doc__)
+    parser.add_argument('directory', nargs='?', default=db.DB_DIRECTORY,
+                        help='packet log directory (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed factor, 0 for as fast as possible '
+                             '(default: %(default)s)')
+    parser.add_argument('--start', type=float, default=None,
+                        help='start at the key frame before this time')
+    args = parser.parse_args(argv)
+    replayer = Replayer(args.directory, speed=args.speed, start=args.start)
+    if not args.speed:
+        print '{0} records replayed'.format(replayer.run())
+        return
+    defer = replayer.play()
+    defer.addCallback(lambda count: log.info('{0} records replayed'
+                                             .format(count)))
+    defer.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+def session_time(value):
+    """parse a time since the session start: [h:]m:ss or seconds."""
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def state(argv=None):
+    """print the timing state of a saved session at a point in time."""
+    # imported here: replay is not needed for live sessions
+    from replay import state_at
+    parser = argparse.ArgumentParser(prog='f1live state',
+                                     description=state.__doc__)
+    parser.add_argument('time', type=session_time,
+                        help='time since the session start ([h:]m:ss)')
+    parser.add_argument('directory', nargs='?', default=db.DB_DIRECTORY,
+                        help='packet log directory (default: %(default)s)')
+    args = parser.parse_args(argv)
+    start = time.time()
+    snapshot = state_at(args.directory, args.time, relative=True).snapshot()
+    log.info('State rebuilt in {0:.3f} s'.format(time.time() - start))
+    for car in sorted(snapshot):
+        print car, ' '.join('{0}={1}'.format(column, value) for column, value
+                            in sorted(snapshot[car].iteritems()))
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['replay']:
+        replay(sys.argv[2:])
+    elif sys.argv[1:2] == ['state']:
+        state(sys.argv[2:])
+    elif sys.argv[1:2] == ['multi']:
+        multi(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,131 @@
+"""
+Fan-in of redundant streams of the same session.
+
+Every stream of a session carries the same packets, each decrypted with the
+context of its own account. Packets are numbered by the key frame they follow
+and their index after it, so the same packet has the same sequence in every
+stream; the first stream to deliver a sequence wins and later copies are
+dropped. Streams may lag each other across key frames, so copies are tracked
+for each of the most recent key frames. Each stream still persists all its
+packets to its own packet log.
+"""
+import logging
+import os
+import db
+import metrics
+from crypto import DecryptionContext
+from streaming import StreamingClientFactory
+
+__all__ = ['FanIn']
+
+log = logging.getLogger(__name__)
+
+FANIN_PACKETS = metrics.counter('f1live_fanin_packets_total',
+                                'Packets of redundant streams by stream and '
+                                'result (accepted or duplicate).',
+                                ('stream', 'result'))
+
+# key frames whose packets are tracked
+KEY_FRAME_WINDOW = 4
+
+class FanIn(object):
+    """Merge redundant streams, handling every packet once."""
+
+    def __init__(self, output=None, window=KEY_FRAME_WINDOW):
+        """
+        @param output: factory whose state and Firebase references receive
+                       the merged packets (default: a new factory).
+        @type output: C{StreamingClientFactory}.
+        @param window: number of most recent key frames whose packets are
+                       tracked; packets of older key frames are dropped.
+        @type window: C{int}.
+        """
+        self.output = output or StreamingClientFactory(name='merged')
+        self.feeds = []
+        self.window = window
+        # next index to handle, by key frame id
+        self.next_index = {}
+
+        # statistics
+        self.accepted = {}
+        self.duplicates = {}
+
+    def add_feed(self, name, user_token=None, directory=None, **options):
+        """
+        Create the factory of a stream, with its own decryption context
+        and packet log.
+
+        @param name: name of the stream, in metrics and the packet log path.
+        @type name: C{string}.
+        @param user_token: user token of the stream's account (default: the
+                           process-wide token).
+        @type user_token: C{string}.
+        @param directory: packet log directory (default: name below the
+                          default packet log directory).
+        @type directory: C{string}.
+        @param **options: other L{StreamingClientFactory} options.
+        @type **options: dict.
+        @return: factory to connect.
+        @rtype: C{StreamingClientFactory}.
+        """
+        if directory is None:
+            directory = os.path.join(db.DB_DIRECTORY, name)
+        factory = StreamingClientFactory(DecryptionContext(user_token,
+                                                           name=name),
+                                         name=name,
+                                         store=db.PacketStore(directory),
+                                         fanin=self, **options)
+        self.feeds.append(factory)
+        self.accepted[name] = 0
+        self.duplicates[name] = 0
+        return factory
+
+    def accept(self, name, sequence):
+        """
+        Tell whether a packet is received for the first time.
+
+        @param name: name of the stream the packet was received from.
+        @type name: C{string}.
+        @param sequence: key frame id and index of the packet.
+        @type sequence: C{tuple}.
+        @return: True if the packet is to be handled.
+        @rtype: C{bool}.
+        """
+        key_frame_id, index = sequence
+        if key_frame_id not in self.next_index:
+            self.track(key_frame_id)
+        if self.next_index.get(key_frame_id) == index:
+            self.next_index[key_frame_id] += 1
+            self.accepted[name] = self.accepted.get(name, 0) + 1
+            FANIN_PACKETS.inc((name, 'accepted'))
+            return True
+        self.duplicates[name] = self.duplicates.get(name, 0) + 1
+        FANIN_PACKETS.inc((name, 'duplicate'))
+        return False
+
+    def track(self, key_frame_id):
+        """track a new key frame, unless older than every tracked one."""
+        if (len(self.next_index) >= self.window and
+            key_frame_id < min(self.next_index)):
+            return
+        self.next_index[key_frame_id] = 0
+        if len(self.next_index) > self.window:
+            del self.next_index[min(self.next_index)]
+
+    def close(self):
+        """close the packet logs of all streams."""
+        for factory in self.feeds:
+            factory.stopTrying()
+            factory.store.close()
+
+    def stats(self):
+        """
+        Return fan-in statistics.
+
+        @return: accepted and duplicate packets by stream name.
+        @rtype: C{dict}.
+        """
+        names = set(self.accepted) | set(self.duplicates)
+        return dict((name, {'accepted': self.accepted.get(name, 0),
+                            'duplicates': self.duplicates.get(name, 0)})
+                    for name in names)
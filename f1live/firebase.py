@@ -2,13 +2,19 @@
 A lightweight implementation of a Firebase REST endpoint
 mimicking the javascript APIs.
 """
+import copy
 import logging
 import http
 import json
 import urlparse
 import os
+import random
+import time
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList
 
-__all__ = ['Firebase']
+__all__ = ['Firebase', 'AsyncFirebase']
 
 log = logging.getLogger(__name__)
 
@@ -131,3 +137,248 @@ class Firebase(object):
         """append json extension to root url."""
         return '{0}.json'.format(self.root_url)
 
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+def push_id():
+    """
+    Generate a chronologically ordered unique id, like Firebase does for
+    push(): 8 characters of timestamp followed by 12 random characters.
+    """
+    now = int(time.time() * 1000)
+    stamp = []
+    for _ in range(8):
+        now, rest = divmod(now, 64)
+        stamp.append(PUSH_CHARS[rest])
+    return ''.join(reversed(stamp)) + \
+           ''.join(random.choice(PUSH_CHARS) for _ in range(12))
+
+class FirebaseError(Exception):
+    """firebase error response exception."""
+    pass
+
+class UpdateBatcher(object):
+    """
+    Coalesce writes below a Firebase root into multi-location updates:
+    writes within window seconds are sent as a single PATCH request, one
+    request at a time, retried with exponential backoff when failing.
+    """
+    def __init__(self, root_url, window=0.1, retries=5, backoff=0.5):
+        self.root_url = root_url.rstrip('/')
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = {}
+        self.waiters = []
+        self.timer = None
+        self.inflight = False
+
+        # statistics
+        self.writes = 0
+        self.requests = 0
+        self.failures = 0
+
+    def write(self, path, value):
+        """
+        Queue a write of value at a path relative to the root.
+
+        @param path: relative path.
+        @type path: C{string}.
+        @param value: value to write (None removes the location).
+        @type value: C{object}.
+        @return: deferred firing when the write is stored.
+        @rtype: C{Deferred}.
+        """
+        self.writes += 1
+        self.merge(path.strip('/'), value)
+        defer = Deferred()
+        self.waiters.append(defer)
+        self.schedule()
+        return defer
+
+    def merge(self, path, value):
+        """merge a write into the pending update."""
+        # the caller may modify its value, and writes below it nest into it
+        value = copy.deepcopy(value)
+        if not path:
+            # a write of the root replaces every pending write
+            self.pending = {'': value}
+            return
+        prefix = path + '/'
+        for pending in [key for key in self.pending if key.startswith(prefix)]:
+            del self.pending[pending]
+        parts = path.split('/')
+        for i in range(len(parts) - 1, -1, -1):
+            ancestor = '/'.join(parts[:i])
+            if ancestor in self.pending:
+                # nest the write into the value of the pending ancestor
+                node = self.pending[ancestor]
+                if not isinstance(node, dict):
+                    node = self.pending[ancestor] = {}
+                for part in parts[i:-1]:
+                    child = node.get(part)
+                    if not isinstance(child, dict):
+                        child = node[part] = {}
+                    node = child
+                node[parts[-1]] = value
+                return
+        self.pending[path] = value
+
+    def schedule(self, delay=None):
+        """flush after delay (default: the coalescing window)."""
+        if self.timer is None and not self.inflight:
+            self.timer = reactor.callLater(
+                        self.window if delay is None else delay, self.flush)
+
+    def flush(self):
+        """send the pending writes as one multi-location update."""
+        self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        waiters, self.waiters = self.waiters, []
+        self.inflight = True
+        self.send(batch, waiters, 0)
+
+    def send(self, batch, waiters, attempt):
+        """send a batch, retrying on failure."""
+        # a pending root write holds every other write: replace the root
+        if '' in batch:
+            data = batch['']
+            method = 'delete' if data in (None, {}) else 'put'
+        else:
+            method, data = 'patch', batch
+        self.requests += 1
+        defer = Deferred()
+        defer.addCallback(self.check)
+        defer.addCallbacks(self.sent, self.failed,
+                           callbackArgs=(waiters,),
+                           errbackArgs=(batch, waiters, attempt))
+        try:
+            http.request_async(defer, method,
+                               '{0}.json'.format(self.root_url),
+                               encode=json.dumps, data=data)
+        except Exception:
+            # e.g. a value JSON cannot encode: fail the batch, not the batcher
+            defer.errback()
+
+    def check(self, content):
+        """raise on a firebase error response."""
+        try:
+            result = json.loads(content)
+        except ValueError:
+            raise FirebaseError('Invalid response: {0!r}'.format(content))
+        if isinstance(result, dict) and 'error' in result:
+            raise FirebaseError(result['error'])
+        return result
+
+    def sent(self, result, waiters):
+        """callback when a batch is stored."""
+        self.done()
+        for waiter in waiters:
+            waiter.callback(result)
+
+    def failed(self, failure, batch, waiters, attempt):
+        """errback when a batch failed: retry or give up."""
+        self.failures += 1
+        if attempt < self.retries:
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            log.info('Firebase update failed ({0}), retry in {1:.1f} s'
+                     .format(failure.getErrorMessage(), delay))
+            reactor.callLater(delay, self.send, batch, waiters, attempt + 1)
+            return
+        log.error('Firebase update failed: {0}'
+                  .format(failure.getErrorMessage()))
+        self.done()
+        for waiter in waiters:
+            waiter.errback(failure)
+
+    def done(self):
+        """allow the next batch to be sent."""
+        self.inflight = False
+        if self.pending:
+            self.schedule()
+
+    def stats(self):
+        """
+        Return write statistics.
+
+        @return: number of writes, requests and failed requests.
+        @rtype: C{dict}.
+        """
+        return {'writes': self.writes,
+                'requests': self.requests,
+                'failures': self.failures}
+
+class AsyncFirebase(Firebase):
+    """
+    Firebase reference writing without blocking: writes return deferreds
+    and are batched per root into multi-location updates.
+    """
+    def __init__(self, url, batcher=None, **options):
+        """
+        @param url: Firebase location.
+        @type url: C{string}.
+        @param batcher: batcher shared with related references (default:
+                        a new batcher with this location as root).
+        @type batcher: C{UpdateBatcher}.
+        @param **options: L{UpdateBatcher} options (window, retries,
+                          backoff).
+        @type **options: dict.
+        """
+        Firebase.__init__(self, url)
+        self.batcher = batcher or UpdateBatcher(self.root_url, **options)
+
+    def child(self, path):
+        return AsyncFirebase(Firebase.child(self, path).root_url,
+                             self.batcher)
+
+    def path(self):
+        """path of this location relative to the batcher root."""
+        return self.root_url[len(self.batcher.root_url):]
+
+    def set(self, data):
+        """
+        Write or replace data at this location.
+
+        @param data: data to be written.
+        @type data: C{dict}.
+        @return: deferred firing when written.
+        @rtype: C{Deferred}.
+        """
+        return self.batcher.write(self.path(), data)
+
+    def update(self, data):
+        """
+        Update some of the keys at this location.
+
+        @param data: dict containing children and their values to be written.
+        @type data: C{dict}.
+        @return: deferred firing when written.
+        @rtype: C{Deferred}.
+        """
+        defers = [self.batcher.write('{0}/{1}'.format(self.path(), key), value)
+                  for key, value in data.items()]
+        return DeferredList(defers, fireOnOneErrback=True, consumeErrors=True)
+
+    def remove(self):
+        """
+        Remove the data at this location.
+
+        @return: deferred firing when removed.
+        @rtype: C{Deferred}.
+        """
+        return self.batcher.write(self.path(), None)
+
+    def push(self, data):
+        """
+        Add to a list of data, at a location with a generated unique id.
+
+        @param data: value to be written at the generated location.
+        @type data: C{dict}
+        @return: deferred firing with the generated location when written.
+        @rtype: C{Deferred}.
+        """
+        ref = self.child(push_id())
+        defer = ref.set(data)
+        return defer.addCallback(lambda _: ref)
@@ -4,6 +4,9 @@ Simple HTTP requests library.
 import logging
 import socket
 import httplib
+import threading
+import time
+import urlparse
 from httplib2 import Http
 from httplib2 import ServerNotFoundError
 from urllib import urlencode
@@ -12,18 +15,161 @@ from StringIO import StringIO
 from twisted.internet import reactor
 from twisted.web.client import Agent
 from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
 from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
 
-__all__ = ['get', 'get_async', 'post', 'post_async', 'request', 'request_async']
+__all__ = ['get', 'get_async', 'post', 'post_async', 'request', 'request_async',
+           'configure_pool', 'pool_stats']
 
 log = logging.getLogger(__name__)
 
 F1_LIVE_SERVER = 'live-timing.formula1.com'
+F1_LIVE_PORT = 4321
+
+def live_host():
+    """host name of the live timing server (without http port)."""
+    return F1_LIVE_SERVER.split(':')[0]
 
 class ConnectionError(Exception):
     """connection error exception."""
     pass
 
+class ConnectionPool(object):
+    """
+    Pool of persistent (keep-alive) httplib2 connections per host for
+    blocking requests. Idle connections are closed after idle_timeout.
+    """
+    def __init__(self, max_per_host=2, idle_timeout=240):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.timer = None
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, host):
+        """take an idle connection to host, or a new one."""
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(host, [])
+            while idle:
+                http, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    self.hits += 1
+                    return http
+                close(http)
+            self.misses += 1
+        return Http()
+
+    def release(self, host, http):
+        """return a connection to the pool, closing it if the pool is full."""
+        with self.lock:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < self.max_per_host:
+                idle.append((http, time.time()))
+                self.schedule(self.idle_timeout)
+                return
+        close(http)
+
+    def schedule(self, delay):
+        """expire idle connections after delay; called with the lock held."""
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        """close the connections idle for longer than idle_timeout."""
+        now = time.time()
+        expired = []
+        with self.lock:
+            self.timer = None
+            for host, idle in self.idle.items():
+                expired.extend(http for http, since in idle
+                               if now - since >= self.idle_timeout)
+                idle[:] = [(http, since) for http, since in idle
+                           if now - since < self.idle_timeout]
+                if not idle:
+                    del self.idle[host]
+            if self.idle:
+                oldest = min(since for idle in self.idle.values()
+                             for _, since in idle)
+                self.schedule(oldest + self.idle_timeout - now)
+        for http in expired:
+            close(http)
+
+    def stats(self):
+        """return hit/miss counters and the number of idle connections."""
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'idle': sum(len(idle) for idle in self.idle.values())}
+
+class CountingEndpoint(object):
+    """client endpoint counting the new connections made through it."""
+    def __init__(self, pool, endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+
+    def connect(self, factory):
+        self.pool.misses += 1
+        return self.endpoint.connect(factory)
+
+class AgentConnectionPool(HTTPConnectionPool):
+    """
+    Twisted connection pool counting reused connections: a request that
+    does not connect its endpoint got a cached connection. The pool closes
+    idle connections after cachedConnectionTimeout itself.
+    """
+    requests = 0
+    misses = 0
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        endpoint = CountingEndpoint(self, endpoint)
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def stats(self):
+        """return hit/miss counters."""
+        return {'hits': self.requests - self.misses,
+                'misses': self.misses}
+
+def close(http):
+    """close all connections of an httplib2 object."""
+    for conn in http.connections.values():
+        conn.close()
+
+def configure_pool(max_per_host=2, idle_timeout=240):
+    """
+    Configure the connection pools of blocking and asynchronous requests.
+
+    @param max_per_host: maximum number of persistent connections per host.
+    @type max_per_host: C{int}.
+    @param idle_timeout: seconds before an idle connection is closed.
+    @type idle_timeout: C{int}.
+    """
+    global POOL, AGENT_POOL, AGENT
+    POOL = ConnectionPool(max_per_host, idle_timeout)
+    AGENT_POOL = AgentConnectionPool(reactor, persistent=True)
+    AGENT_POOL.maxPersistentPerHost = max_per_host
+    AGENT_POOL.cachedConnectionTimeout = idle_timeout
+    AGENT = Agent(reactor, pool=AGENT_POOL)
+
+def pool_stats():
+    """
+    Return connection pool statistics.
+
+    @return: hit/miss statistics of the blocking and asynchronous pools.
+    @rtype: C{dict}.
+    """
+    return {'blocking': POOL.stats(), 'async': AGENT_POOL.stats()}
+
+configure_pool()
+
 def request(method, url,
         encode=urlencode,
     	params=None,
@@ -36,8 +182,13 @@ def request(method, url,
         if data:
             data = encode(data)
         log.debug("[{0}] {1}".format(method.upper(), url))
-        response, content = Http().request(url, method.upper(),
-                                     data, headers)
+        host = urlparse.urlparse(url).netloc
+        http = POOL.acquire(host)
+        try:
+            response, content = http.request(url, method.upper(),
+                                         data, headers)
+        finally:
+            POOL.release(host, http)
     except (ServerNotFoundError, socket.error) as err:
         raise ConnectionError(str(err))
     return Response(response, content)
@@ -46,19 +197,31 @@ def request_async(defer, method, url,
              encode=urlencode,
              params=None,
              data=None,
-             headers=None):
-    """do an asynchronous http request."""
+             headers=None,
+             on_chunk=None,
+             on_progress=None,
+             collect=True):
+    """
+    Do an asynchronous http request; defer fires with the response body
+    (empty if not collected) or errs back on failure.
+    on_chunk(data) is called with every chunk of the body as it arrives,
+    on_progress(received, length) with the download progress (length is
+    None when unknown).
+    """
     if params:
         url = "{0}?{1}".format(url, urlencode(params))
     if data:
         data = FileBodyProducer(StringIO(encode(data)))
     log.debug("[async {0}] {1}".format(method.upper(), url))
-    _defer = Agent(reactor).request(method.upper(), url, headers, data)
-    _defer.addCallback(on_http_response, defer)
+    _defer = AGENT.request(method.upper(), url, headers, data)
+    consumer = HttpBodyConsumer(defer, on_chunk, on_progress, collect)
+    _defer.addCallbacks(on_http_response, defer.errback,
+                        callbackArgs=(consumer,))
 
-def on_http_response(response, defer):
+def on_http_response(response, consumer):
     """callback function when http response is received."""
-    return response.deliverBody(HttpBodyConsumer(response.length, defer))
+    consumer.length = response.length
+    return response.deliverBody(consumer)
 
 def get(url, **kwargs):
     """
@@ -182,17 +345,59 @@ class Response(object):
         return self.content
 
 class HttpBodyConsumer(Protocol):
-    """asynchronous http response consumer."""
-    def __init__(self, length, finished):
-        self.remaining = length
+    """
+    Asynchronous http response consumer collecting the body in a list of
+    chunks and/or streaming the chunks to a callback as they arrive.
+    """
+    def __init__(self, finished, on_chunk=None, on_progress=None,
+                 collect=True):
         self.finished = finished
-        self.body = ''
+        self.on_chunk = on_chunk
+        self.on_progress = on_progress
+        self.collect = collect
+        self.length = UNKNOWN_LENGTH
+        self.chunks = []
+        self.received = 0
+        self.started = time.time()
 
     def dataReceived(self, data):
-        if self.remaining:
-            self.body += data[:self.remaining]
-            self.remaining -= len(data)
+        if self.length != UNKNOWN_LENGTH:
+            data = data[:self.length - self.received]
+        if not data:
+            return
+        self.received += len(data)
+        if self.collect:
+            self.chunks.append(data)
+        if self.on_chunk:
+            self.on_chunk(data)
+        if self.on_progress:
+            self.on_progress(self.received, self.get_length())
 
     def connectionLost(self, reason):
-        self.finished.callback(self.body)
+        log.debug('Received {0} bytes in {1:.3f} s ({2:.0f} bytes/s)'
+                  .format(self.received, time.time() - self.started,
+                          self.rate()))
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+    def get_length(self):
+        """
+        Returns the body length.
+
+        @return: body length, or None if unknown.
+        @rtype: C{int}.
+        """
+        if self.length == UNKNOWN_LENGTH:
+            return None
+        return self.length
 
+    def rate(self):
+        """
+        Returns the download rate.
+
+        @return: bytes received per second.
+        @rtype: C{float}.
+        """
+        return self.received / max(time.time() - self.started, 1e-6)
@@ -0,0 +1,233 @@
+"""
+Metrics of the streaming client, served in Prometheus text format.
+
+    > curl http://127.0.0.1:9100/metrics
+    # HELP f1live_polls_total Poll requests sent to the server.
+    # TYPE f1live_polls_total counter
+    f1live_polls_total 12
+"""
+import logging
+from bisect import bisect_left
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+__all__ = ['counter', 'gauge', 'histogram', 'render', 'serve']
+
+log = logging.getLogger(__name__)
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1.0, 5.0)
+
+def format_labels(names, values, extra=''):
+    """format label pairs as {name="value",...}."""
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{{{0}}}'.format(','.join(pairs)) if pairs else ''
+
+class Metric(object):
+    """base class of metrics with optional labels."""
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        """return the metric in Prometheus text format."""
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+    def samples(self):
+        """yield sample lines."""
+        for values, value in sorted(self.values.items()):
+            yield '{0}{1} {2}'.format(self.name,
+                                      format_labels(self.labels, values),
+                                      value)
+
+class Counter(Metric):
+    """monotonically increasing counter."""
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        Metric.__init__(self, name, doc, labels)
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increment the counter.
+
+        @param labels: label values.
+        @type labels: C{tuple}.
+        @param amount: increment (default: 1).
+        @type amount: C{int}.
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """value that goes up and down, set directly or read from functions."""
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=()):
+        Metric.__init__(self, name, doc, labels)
+        self.functions = {}
+
+    def set(self, value, labels=()):
+        """
+        Set the gauge.
+
+        @param value: value.
+        @type value: C{float}.
+        @param labels: label values.
+        @type labels: C{tuple}.
+        """
+        self.values[labels] = value
+
+    def set_function(self, function, labels=()):
+        """
+        Read the gauge from a function when rendered.
+
+        @param function: function returning the value (None to remove).
+        @type function: C{callable}.
+        @param labels: label values.
+        @type labels: C{tuple}.
+        """
+        if function is None:
+            self.functions.pop(labels, None)
+        else:
+            self.functions[labels] = function
+
+    def samples(self):
+        for labels, function in self.functions.items():
+            try:
+                self.values[labels] = function()
+            except Exception as err:
+                log.debug('Cannot read gauge {0}: {1}'.format(self.name, err))
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    """distribution of observed values over buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """
+        Observe a value.
+
+        @param value: value.
+        @type value: C{float}.
+        @param labels: label values.
+        @type labels: C{tuple}.
+        """
+        try:
+            counts = self.values[labels]
+        except KeyError:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for values, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '{0}_bucket{1} {2}'.format(
+                        self.name,
+                        format_labels(self.labels, values,
+                                      'le="{0}"'.format(bound)),
+                        total)
+            labels = format_labels(self.labels, values)
+            yield '{0}_sum{1} {2}'.format(self.name, labels, counts[-1])
+            yield '{0}_count{1} {2}'.format(self.name, labels, total)
+
+REGISTRY = []
+
+def register(metric):
+    """add a metric to the registry."""
+    REGISTRY.append(metric)
+    return metric
+
+def counter(name, doc, labels=()):
+    """
+    Create and register a counter.
+
+    @param name: metric name.
+    @type name: C{string}.
+    @param doc: help text.
+    @type doc: C{string}.
+    @param labels: label names.
+    @type labels: C{tuple}.
+    @rtype: C{Counter}.
+    """
+    return register(Counter(name, doc, labels))
+
+def gauge(name, doc, labels=()):
+    """
+    Create and register a gauge.
+
+    @param name: metric name.
+    @type name: C{string}.
+    @param doc: help text.
+    @type doc: C{string}.
+    @param labels: label names.
+    @type labels: C{tuple}.
+    @rtype: C{Gauge}.
+    """
+    return register(Gauge(name, doc, labels))
+
+def histogram(name, doc, labels=(), buckets=LATENCY_BUCKETS):
+    """
+    Create and register a histogram.
+
+    @param name: metric name.
+    @type name: C{string}.
+    @param doc: help text.
+    @type doc: C{string}.
+    @param labels: label names.
+    @type labels: C{tuple}.
+    @param buckets: upper bounds of the buckets.
+    @type buckets: C{tuple}.
+    @rtype: C{Histogram}.
+    """
+    return register(Histogram(name, doc, labels, buckets))
+
+def render():
+    """
+    Render all registered metrics.
+
+    @return: metrics in Prometheus text format.
+    @rtype: C{string}.
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+class MetricsResource(Resource):
+    """http resource serving the registered metrics."""
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return render()
+
+def serve(port=9100, interface='127.0.0.1'):
+    """
+    Serve the metrics over http on the reactor.
+
+    @param port: http port.
+    @type port: C{int}.
+    @param interface: interface to listen on (default: local only).
+    @type interface: C{string}.
+    """
+    log.info('Serving metrics on {0}:{1}'.format(interface, port))
+    return reactor.listenTCP(port, Site(MetricsResource()),
+                             interface=interface)
@@ -0,0 +1,498 @@
+"""
+Append-only segmented packet log.
+
+A packet log is a directory of segment files, each named after the sequence
+number of its first record. Segments hold length-prefixed records, every
+record being a fixed header followed by its payload:
+
+    length        uint32    payload length
+    sequence      uint64    record sequence number
+    timestamp     double    seconds since the epoch
+    kind          uint8     PACKET, KEY_FRAME or CHECKPOINT
+    key_frame_id  uint32    key frame id (key frames only)
+    crc           uint32    crc32 of the payload
+
+A CHECKPOINT record holds a serialized state of the session at that point
+of the log, from which the following records can be replayed.
+
+A torn record at the end of the last segment (e.g. after a crash) is
+truncated when the log is opened for writing again.
+
+A sparse index file lists the position of every key frame and checkpoint
+record, and of a record at least every index_interval seconds, so records
+can be found by time without scanning the segments:
+
+    timestamp     double    record timestamp
+    sequence      uint64    record sequence number
+    segment       uint64    sequence number of the record's segment
+    offset        uint64    offset of the record in its segment
+    kind          uint8     record kind
+"""
+import logging
+import os
+import glob
+import time
+import struct
+import zlib
+import mmap
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import namedtuple
+
+__all__ = ['PacketLogWriter', 'PacketLogReader', 'MmapLogReader', 'Record',
+           'IndexEntry', 'PACKET', 'KEY_FRAME', 'CHECKPOINT']
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<IQdBII')
+INDEX = struct.Struct('<dQQQB')
+
+PACKET = 0
+KEY_FRAME = 1
+CHECKPOINT = 2
+
+SEGMENT_EXT = '.log'
+INDEX_FILE = 'index'
+
+# fsync policies; a number means fsync at most every that many seconds
+FSYNC_NEVER = 'never'
+FSYNC_SEGMENT = 'segment'
+FSYNC_ALWAYS = 'always'
+
+Record = namedtuple('Record', 'sequence timestamp kind key_frame_id payload')
+IndexEntry = namedtuple('IndexEntry', 'timestamp sequence segment offset kind')
+
+def segment_path(directory, sequence):
+    """path of the segment starting at sequence."""
+    return os.path.join(directory, '{0:020d}{1}'.format(sequence, SEGMENT_EXT))
+
+def list_segments(directory):
+    """return sorted (first sequence, path) pairs of all segments."""
+    segments = []
+    for path in glob.glob(os.path.join(directory, '*' + SEGMENT_EXT)):
+        name = os.path.basename(path)[:-len(SEGMENT_EXT)]
+        if name.isdigit():
+            segments.append((int(name), path))
+    return sorted(segments)
+
+def read_records(_file, payloads=True):
+    """
+    Yield (offset, header, payload) for every valid record of a segment;
+    payload is None when payloads are not requested. Stop at a torn record.
+    """
+    offset = _file.tell()
+    while True:
+        head = _file.read(HEADER.size)
+        if len(head) < HEADER.size:
+            return
+        header = HEADER.unpack(head)
+        length = header[0]
+        if payloads or header[3] != PACKET:
+            payload = _file.read(length)
+            if len(payload) < length or \
+               zlib.crc32(payload) & 0xffffffff != header[5]:
+                return
+        else:
+            payload = None
+            _file.seek(length, os.SEEK_CUR)
+        yield offset, header, payload
+        offset += HEADER.size + length
+
+def make_record(header, payload):
+    """build a record from a header tuple and payload."""
+    return Record(header[1], header[2], header[3], header[4], payload)
+
+def read_index(path):
+    """return the complete entries of an index file (none if missing)."""
+    try:
+        with open(path, 'rb') as _file:
+            data = _file.read()
+    except IOError:
+        return []
+    return [IndexEntry._make(INDEX.unpack_from(data, offset))
+            for offset in xrange(0, len(data) - INDEX.size + 1, INDEX.size)]
+
+class PacketLogWriter(object):
+    """Buffered writer appending records to a packet log."""
+
+    def __init__(self, directory='.', segment_size=64 << 20,
+                 fsync=FSYNC_SEGMENT, buffer_size=1 << 20, index_interval=1.0):
+        """
+        Open a packet log for appending, creating it if needed.
+
+        @param directory: directory of the packet log.
+        @type directory: C{string}.
+        @param segment_size: segment size (bytes) before rotating.
+        @type segment_size: C{int}.
+        @param fsync: fsync policy: 'never', 'segment' (default) on rotate
+                      and close, 'always' after each record, or a number of
+                      seconds between fsyncs.
+        @type fsync: C{string} or C{float}.
+        @param buffer_size: write buffer size in bytes.
+        @type buffer_size: C{int}.
+        @param index_interval: longest time (seconds) between two records
+                               of the index.
+        @type index_interval: C{float}.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self.index_interval = index_interval
+        self.indexed = None
+        self.synced = time.time()
+        self._file = None
+        self._index = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.recover()
+
+    def recover(self):
+        """find the next sequence number and drop a torn tail record."""
+        self.sequence = 0
+        segments = list_segments(self.directory)
+        if not segments:
+            self.open_index()
+            self.open(segment_path(self.directory, 0))
+            return
+        first, path = segments[-1]
+        self.sequence = first
+        end = 0
+        with open(path, 'rb') as _file:
+            for offset, header, _ in read_records(_file):
+                self.sequence = header[1] + 1
+                end = offset + HEADER.size + header[0]
+        if end < os.path.getsize(path):
+            log.warning('Truncating torn record in {0}'.format(path))
+            with open(path, 'r+b') as _file:
+                _file.truncate(end)
+        self.open_index()
+        self.open(path)
+
+    def open_index(self):
+        """open the index for appending, dropping entries of lost records."""
+        path = os.path.join(self.directory, INDEX_FILE)
+        entries = read_index(path)
+        valid = len(entries)
+        while valid and entries[valid - 1].sequence >= self.sequence:
+            valid -= 1
+        if os.path.exists(path) and \
+           os.path.getsize(path) != valid * INDEX.size:
+            log.warning('Truncating index of {0}'.format(self.directory))
+            with open(path, 'r+b') as _file:
+                _file.truncate(valid * INDEX.size)
+        if valid:
+            self.indexed = entries[valid - 1].timestamp
+        self._index = open(path, 'ab')
+
+    def open(self, path):
+        """open a segment for appending."""
+        self.path = path
+        self.first = int(os.path.basename(path)[:-len(SEGMENT_EXT)])
+        self._file = open(path, 'ab', self.buffer_size)
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+
+    def append(self, payload, kind=PACKET, key_frame_id=0, timestamp=None):
+        """
+        Append a record.
+
+        @param payload: record payload.
+        @type payload: C{string}.
+        @param kind: PACKET (default) or KEY_FRAME.
+        @type kind: C{int}.
+        @param key_frame_id: key frame id of KEY_FRAME records.
+        @type key_frame_id: C{int}.
+        @param timestamp: record time (default: now).
+        @type timestamp: C{float}.
+        @return: sequence number of the record.
+        @rtype: C{int}.
+        """
+        if self.size >= self.segment_size:
+            self.rotate()
+        if timestamp is None:
+            timestamp = time.time()
+        sequence = self.sequence
+        if kind != PACKET or self.indexed is None or \
+           timestamp - self.indexed >= self.index_interval:
+            self._index.write(INDEX.pack(timestamp, sequence, self.first,
+                                         self.size, kind))
+            self.indexed = timestamp
+        self._file.write(HEADER.pack(len(payload), sequence, timestamp, kind,
+                                     key_frame_id,
+                                     zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+        self.size += HEADER.size + len(payload)
+        self.sequence += 1
+        if self.fsync == FSYNC_ALWAYS:
+            self.sync()
+        elif self.fsync not in (FSYNC_NEVER, FSYNC_SEGMENT) and \
+             time.time() - self.synced >= self.fsync:
+            self.sync()
+        return sequence
+
+    def rotate(self):
+        """close the current segment and start a new one."""
+        self.close_segment()
+        self.open(segment_path(self.directory, self.sequence))
+
+    def flush(self):
+        """write buffered records to the operating system."""
+        self._file.flush()
+        self._index.flush()
+
+    def sync(self):
+        """write buffered records to disk."""
+        self.flush()
+        os.fsync(self._file.fileno())
+        os.fsync(self._index.fileno())
+        self.synced = time.time()
+
+    def close_segment(self):
+        """flush and close the current segment."""
+        if self.fsync == FSYNC_NEVER:
+            self.flush()
+        else:
+            self.sync()
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        """flush and close the current segment and the index."""
+        if self._file is None:
+            return
+        self.close_segment()
+        self._index.close()
+        self._index = None
+
+class PacketLogReader(object):
+    """Reader iterating the records of a packet log."""
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+
+    def __iter__(self):
+        return self.records()
+
+    def segments(self):
+        """return sorted (first sequence, path) pairs of all segments."""
+        return list_segments(self.directory)
+
+    def index(self):
+        """
+        Return the sparse index of the log.
+
+        @return: index entries, in log order (empty if there is no index).
+        @rtype: C{list} of C{IndexEntry}.
+        """
+        return read_index(os.path.join(self.directory, INDEX_FILE))
+
+    def entry_before(self, timestamp, kinds=None):
+        """
+        Find the last index entry at or before a point in time.
+
+        @param timestamp: point in time.
+        @type timestamp: C{float}.
+        @param kinds: record kinds to consider (default: all).
+        @type kinds: C{tuple}.
+        @return: index entry, or None if there is none.
+        @rtype: C{IndexEntry}.
+        """
+        entries = self.index()
+        last = bisect_right([entry.timestamp for entry in entries], timestamp)
+        for entry in reversed(entries[:last]):
+            if kinds is None or entry.kind in kinds:
+                return entry
+        return None
+
+    def records_from(self, entry):
+        """
+        Iterate records from the position of an index entry to the end of
+        the log.
+
+        @param entry: index entry of the first record.
+        @type entry: C{IndexEntry}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        """
+        for first, path in self.segments():
+            if first < entry.segment:
+                continue
+            start = entry.offset if first == entry.segment else 0
+            for _, header, payload in self.scan(path, start=start):
+                yield make_record(header, payload)
+
+    def record_at(self, entry):
+        """return the record of an index entry."""
+        return next(self.records_from(entry), None)
+
+    def scan(self, path, payloads=True, start=0):
+        """
+        yield (offset, header, payload) for the records of a segment, from
+        the record at offset start.
+        """
+        with open(path, 'rb') as _file:
+            _file.seek(start)
+            for record in read_records(_file, payloads):
+                yield record
+
+    def records(self, start=0, stop=None):
+        """
+        Iterate records by sequence number.
+
+        @param start: first sequence number (default: 0).
+        @type start: C{int}.
+        @param stop: sequence number to stop before (default: end of log).
+        @type stop: C{int}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        """
+        segments = self.segments()
+        first = max(bisect_right([seq for seq, _ in segments], start) - 1, 0)
+        for _, path in segments[first:]:
+            for _, header, payload in self.scan(path):
+                sequence = header[1]
+                if stop is not None and sequence >= stop:
+                    return
+                if sequence >= start:
+                    yield make_record(header, payload)
+
+    def between(self, start=None, stop=None):
+        """
+        Iterate records by time range.
+
+        @param start: start time, inclusive (default: start of log).
+        @type start: C{float}.
+        @param stop: stop time, exclusive (default: end of log).
+        @type stop: C{float}.
+        @return: generator of records.
+        @rtype: C{generator}.
+        """
+        entry = None if start is None else self.entry_before(start)
+        if entry is not None:
+            for record in self.records_from(entry):
+                if stop is not None and record.timestamp >= stop:
+                    return
+                if record.timestamp >= start:
+                    yield record
+            return
+        segments = self.segments()
+        if start is not None:
+            # start at the last segment beginning before start
+            times = [self.first_timestamp(path) for _, path in segments]
+            first = max(bisect_left(times, start) - 1, 0)
+            segments = segments[first:]
+        for _, path in segments:
+            for _, header, payload in self.scan(path):
+                timestamp = header[2]
+                if stop is not None and timestamp >= stop:
+                    return
+                if start is None or timestamp >= start:
+                    yield make_record(header, payload)
+
+    def checkpoint_before(self, timestamp):
+        """
+        Find the last checkpoint at or before a point in time.
+
+        @param timestamp: point in time.
+        @type timestamp: C{float}.
+        @return: checkpoint record, or None if there is none.
+        @rtype: C{Record}.
+        """
+        entry = self.entry_before(timestamp, (CHECKPOINT,))
+        return entry and self.record_at(entry)
+
+    def key_frames(self):
+        """
+        Iterate key frame records, skipping over packet payloads.
+
+        @return: generator of key frame records.
+        @rtype: C{generator}.
+        """
+        for _, path in self.segments():
+            for _, header, payload in self.scan(path, payloads=False):
+                if header[3] == KEY_FRAME:
+                    yield make_record(header, payload)
+
+    def key_frame_before(self, timestamp):
+        """
+        Find the last key frame at or before a point in time.
+
+        @param timestamp: point in time.
+        @type timestamp: C{float}.
+        @return: key frame record, or None if there is none.
+        @rtype: C{Record}.
+        """
+        if self.index():
+            entry = self.entry_before(timestamp, (KEY_FRAME,))
+            return entry and self.record_at(entry)
+        found = None
+        for record in self.key_frames():
+            if record.timestamp > timestamp:
+                break
+            found = record
+        return found
+
+    def first_timestamp(self, path):
+        """timestamp of the first record of a segment."""
+        for _, header, _ in self.scan(path, payloads=False):
+            return header[2]
+        return float('inf')
+
+    def close(self):
+        """release resources held by the reader."""
+        pass
+
+class MmapLogReader(PacketLogReader):
+    """
+    Packet log reader on memory-mapped segments: payloads are read-only
+    views on the mapped segment, so records are never copied. Segments stay
+    mapped until the reader is closed.
+    """
+    def __init__(self, directory='.'):
+        super(MmapLogReader, self).__init__(directory)
+        self.maps = {}
+
+    def map(self, path):
+        """return the memory map of a segment (None if empty)."""
+        try:
+            return self.maps[path]
+        except KeyError:
+            pass
+        with open(path, 'rb') as _file:
+            size = os.fstat(_file.fileno()).st_size
+            data = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) \
+                   if size else None
+        self.maps[path] = data
+        return data
+
+    def scan(self, path, payloads=True, start=0):
+        """
+        yield (offset, header, payload) for the records of a segment, from
+        the record at offset start.
+        """
+        data = self.map(path)
+        if data is None:
+            return
+        offset = start
+        end = len(data)
+        while offset + HEADER.size <= end:
+            header = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            length = header[0]
+            if start + length > end:
+                return
+            payload = None
+            if payloads or header[3] != PACKET:
+                payload = buffer(data, start, length)
+                if zlib.crc32(payload) & 0xffffffff != header[5]:
+                    return
+            yield offset, header, payload
+            offset = start + length
+
+    def close(self):
+        """unmap all segments."""
+        for data in self.maps.values():
+            if data is not None:
+                data.close()
+        self.maps.clear()
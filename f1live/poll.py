@@ -0,0 +1,126 @@
+"""
+Adaptive poll scheduling for stream protocols.
+"""
+import logging
+import time
+
+__all__ = ['PollScheduler']
+
+log = logging.getLogger(__name__)
+
+class PollScheduler(object):
+    """
+    Decide how long a stream may stay silent before the server is polled.
+    The interval follows a moving average of the time between arrivals of
+    data, bounded by min_interval and max_interval. Every poll that goes
+    unanswered multiplies the interval by backoff, so idle sessions are
+    polled less and less; a key frame restarts at the minimum interval,
+    since data usually follows it closely.
+    """
+    def __init__(self, min_interval=0.1, max_interval=5.0, factor=2.0,
+                 backoff=2.0, smoothing=0.2):
+        """
+        @param min_interval: shortest silence before polling (seconds).
+        @type min_interval: C{float}.
+        @param max_interval: longest silence before polling (seconds).
+        @type max_interval: C{float}.
+        @param factor: silence tolerated, in average inter-arrival times.
+        @type factor: C{float}.
+        @param backoff: interval multiplier per unanswered poll.
+        @type backoff: C{float}.
+        @param smoothing: weight of the latest inter-arrival time in the
+                          moving average.
+        @type smoothing: C{float}.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.gap = None
+        self.last_data = None
+        self.poll_sent = None
+        self.idle_polls = 0
+
+        # statistics
+        self.polls = 0
+        self.answered = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def interval(self):
+        """
+        Return the silence after which the server should be polled.
+
+        @return: interval in seconds.
+        @rtype: C{float}.
+        """
+        if self.gap is None:
+            interval = self.max_interval
+        else:
+            interval = self.gap * self.factor
+        interval *= self.backoff ** self.idle_polls
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def data_received(self, now=None):
+        """
+        Account for data received from the server.
+
+        @param now: arrival time (default: now).
+        @type now: C{float}.
+        @return: seconds since the latest poll this data answers, or None.
+        @rtype: C{float}.
+        """
+        if now is None:
+            now = time.time()
+        if self.last_data is not None:
+            gap = now - self.last_data
+            if self.gap is None:
+                self.gap = gap
+            else:
+                self.gap += self.smoothing * (gap - self.gap)
+        self.last_data = now
+        self.idle_polls = 0
+        if self.poll_sent is None:
+            return None
+        latency = now - self.poll_sent
+        self.poll_sent = None
+        self.answered += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return latency
+
+    def polled(self, now=None):
+        """
+        Account for a poll request sent to the server.
+
+        @param now: time of the poll (default: now).
+        @type now: C{float}.
+        """
+        if now is None:
+            now = time.time()
+        self.polls += 1
+        if self.poll_sent is not None:
+            # the previous poll went unanswered
+            self.idle_polls += 1
+        self.poll_sent = now
+
+    def key_frame(self):
+        """poll at the minimum interval after a key frame."""
+        self.gap = self.min_interval / self.factor
+        self.idle_polls = 0
+
+    def stats(self):
+        """
+        Return poll statistics.
+
+        @return: polls sent, polls answered, and average and maximum
+                 poll-to-data latency in seconds.
+        @rtype: C{dict}.
+        """
+        return {'polls': self.polls,
+                'answered': self.answered,
+                'latency': self.latency / self.answered
+                           if self.answered else 0.0,
+                'max_latency': self.max_latency,
+                'interval': self.interval()}
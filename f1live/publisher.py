@@ -0,0 +1,106 @@
+"""
+Publish the timing state of a session to Firebase.
+"""
+import logging
+import json
+import time
+from collections import deque
+from twisted.internet import reactor
+
+__all__ = ['TimingPublisher']
+
+log = logging.getLogger(__name__)
+
+class TimingPublisher(object):
+    """
+    Mirror a session state to a Firebase location: a full snapshot is set
+    on (re)connect and key frames, in between only the cells changed since
+    the last publish are sent as one update, at most max_rate times per
+    second.
+    """
+    def __init__(self, ref, state, max_rate=2.0):
+        """
+        @param ref: Firebase location of the timing tower.
+        @type ref: C{AsyncFirebase}.
+        @param state: session state to publish.
+        @type state: C{SessionState}.
+        @param max_rate: maximum number of publishes per second.
+        @type max_rate: C{float}.
+        """
+        self.ref = ref
+        self.state = state
+        self.interval = 1.0 / max_rate
+        self.version = 0
+        self.published = 0
+        self.timer = None
+
+        # statistics: the JSON size of the data published, before the
+        # batcher merges it into requests
+        self.json_bytes = 0
+        self.requests = deque()
+
+    def snapshot(self):
+        """
+        Publish the complete state, replacing the published timing tower.
+        Nothing is sent while the state is empty, e.g. on connect before
+        the first key frame.
+        """
+        self.cancel()
+        data = dict((str(car), cells)
+                    for car, cells in self.state.snapshot().iteritems())
+        self.version = self.state.version
+        if data:
+            self.send(self.ref.set, data)
+
+    def changed(self):
+        """
+        Notify the publisher that the state changed; the changes are sent
+        once the publish interval has elapsed.
+        """
+        if self.timer is not None:
+            return
+        delay = max(self.published + self.interval - time.time(), 0)
+        self.timer = reactor.callLater(delay, self.publish)
+
+    def publish(self):
+        """send the cells changed since the last publish as one update."""
+        self.timer = None
+        cells = self.state.changed_since(self.version)
+        self.version = self.state.version
+        if not cells:
+            return
+        data = dict(('{0}/{1}'.format(car, column), value)
+                    for car, column, value in cells)
+        self.send(self.ref.update, data)
+
+    def send(self, write, data):
+        """write data and account for it."""
+        now = time.time()
+        self.published = now
+        self.json_bytes += len(json.dumps(data))
+        self.requests.append(now)
+        self.trim(now)
+        write(data).addErrback(lambda failure: None)
+
+    def trim(self, now):
+        """forget publishes older than a minute."""
+        while self.requests and self.requests[0] < now - 60:
+            self.requests.popleft()
+
+    def cancel(self):
+        """cancel a scheduled publish."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def stats(self):
+        """
+        Return publish statistics.
+
+        @return: JSON size of the data published and publishes during the
+                 last minute.
+        @rtype: C{dict}.
+        """
+        self.trim(time.time())
+        return {'json_bytes': self.json_bytes,
+                'requests_per_minute': len(self.requests)}
@@ -0,0 +1,359 @@
+"""
+Local fan-out of timing updates to dashboards, as Server-Sent Events.
+
+Every dashboard subscribes with a single long-lived http request instead
+of polling Firebase. Updates are encoded once and the same bytes are
+written to every subscriber:
+
+    event: snapshot     complete timing tower, on connect and key frames
+    event: timing       cells changed since the previous update
+    event: commentary   a complete comment
+
+A subscriber first receives a snapshot of the current state and the recent
+commentary. Subscribers whose connection cannot keep up are paused by
+their transport; while paused, their timing updates are coalesced cell by
+cell and only the latest commentary is kept. When coalescing grows too
+large they get a fresh snapshot instead when they resume, and subscribers
+stalled for too long are disconnected.
+
+    > curl -N http://127.0.0.1:8081/
+    event: snapshot
+    data: {"event": "race", "cars": {"1": {"driver": "S. VETTEL", ...}}}
+"""
+import logging
+import json
+import time
+from collections import deque
+import metrics
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.server import Site
+from zope.interface import implementer
+
+__all__ = ['PushServer', 'PushResource', 'encode']
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT = 'snapshot'
+TIMING = 'timing'
+COMMENTARY = 'commentary'
+
+# keeps idle connections open through proxies; sent every HEARTBEAT seconds
+HEARTBEAT = 15.0
+HEARTBEAT_MESSAGE = ':\n\n'
+
+SUBSCRIBERS = metrics.gauge('f1live_push_subscribers',
+                            'Dashboards subscribed by push server.',
+                            ('server',))
+PUSH_MESSAGES = metrics.counter('f1live_push_messages_total',
+                                'Messages broadcast by event.', ('event',))
+PUSH_DEFERRED = metrics.counter('f1live_push_deferred_total',
+                                'Messages held back from slow subscribers '
+                                'by outcome (coalesced, dropped or '
+                                'resynced).', ('outcome',))
+
+def encode(event, data):
+    """
+    Encode a message as a server-sent event.
+
+    @param event: event name.
+    @type event: C{string}.
+    @param data: JSON-serializable message; strings are latin-1, as
+                 received from the live timing server.
+    @type data: C{object}.
+    @return: encoded event.
+    @rtype: C{string}.
+    """
+    return 'event: {0}\ndata: {1}\n\n'.format(
+        event, json.dumps(data, encoding='latin-1'))
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    A subscribed dashboard, written to directly while its connection keeps
+    up and holding back bounded, coalesced updates while it is paused.
+    """
+    def __init__(self, server, request, max_cells=2000, max_comments=16):
+        """
+        @param server: push server.
+        @type server: C{PushServer}.
+        @param request: open http request of the subscriber.
+        @type request: C{Request}.
+        @param max_cells: changed cells coalesced while paused before
+                          resyncing with a snapshot.
+        @type max_cells: C{int}.
+        @param max_comments: comments kept while paused; older ones are
+                             dropped.
+        @type max_comments: C{int}.
+        """
+        self.server = server
+        self.request = request
+        self.max_cells = max_cells
+        self.paused = None
+        self.stale = False
+        self.cells = {}
+        self.comments = deque(maxlen=max_comments)
+
+    def send(self, message, event=None, data=None):
+        """
+        Send an encoded message, or hold it back while paused.
+
+        @param message: encoded message.
+        @type message: C{string}.
+        @param event: event of the message.
+        @type event: C{string}.
+        @param data: message before encoding, to coalesce timing updates.
+        @type data: C{object}.
+        """
+        if self.paused is None:
+            self.request.write(message)
+        elif event == SNAPSHOT:
+            self.stale = True
+            self.cells.clear()
+        elif event == TIMING:
+            if self.stale:
+                return
+            PUSH_DEFERRED.inc(('coalesced',))
+            self.cells.update(data)
+            if len(self.cells) > self.max_cells:
+                PUSH_DEFERRED.inc(('resynced',))
+                self.stale = True
+                self.cells.clear()
+        elif event == COMMENTARY:
+            if len(self.comments) == self.comments.maxlen:
+                PUSH_DEFERRED.inc(('dropped',))
+            self.comments.append(message)
+
+    def pauseProducing(self):
+        """the connection is not keeping up: hold back messages."""
+        if self.paused is None:
+            self.paused = time.time()
+
+    def resumeProducing(self):
+        """the connection caught up: send what was held back."""
+        if self.paused is None:
+            return
+        self.paused = None
+        if self.stale:
+            self.request.write(self.server.snapshot_message())
+        elif self.cells:
+            self.request.write(encode(TIMING, self.cells))
+        for message in self.comments:
+            self.request.write(message)
+        self.stale = False
+        self.cells = {}
+        self.comments.clear()
+
+    def stopProducing(self):
+        """the connection is lost."""
+        self.server.unsubscribe(self)
+
+    def disconnect(self):
+        """
+        Close the connection of the subscriber at once: a stalled connection
+        would never flush its pending writes.
+        """
+        self.request.transport.abortConnection()
+
+class PushServer(object):
+    """
+    Broadcast the timing state and commentary of a session to subscribers.
+    Timing updates are sent at most max_rate times per second, so a burst
+    of packets costs the stream one scheduled call.
+    """
+    def __init__(self, max_rate=10.0, history=16, max_cells=2000,
+                 max_stall=60.0, name='live', origin=None):
+        """
+        @param max_rate: maximum number of timing updates per second.
+        @type max_rate: C{float}.
+        @param history: recent comments sent to new subscribers, and kept
+                        for paused ones.
+        @type history: C{int}.
+        @param max_cells: changed cells coalesced for a paused subscriber
+                          before resyncing it with a snapshot.
+        @type max_cells: C{int}.
+        @param max_stall: time (seconds) a subscriber may stay paused
+                          before being disconnected.
+        @type max_stall: C{float}.
+        @param name: name of the server in metrics.
+        @type name: C{string}.
+        @param origin: origin allowed to subscribe from web pages served
+                       elsewhere (default: none, same origin only).
+        @type origin: C{string}.
+        """
+        self.interval = 1.0 / max_rate
+        self.history = history
+        self.max_cells = max_cells
+        self.max_stall = max_stall
+        self.name = name
+        self.origin = origin
+        self.state = None
+        self.version = 0
+        self.published = 0
+        self.timer = None
+        self.snapshot_cache = (None, None)
+        self.comments = deque(maxlen=history)
+        self.subscribers = set()
+        SUBSCRIBERS.set_function(lambda: len(self.subscribers), (name,))
+        self.heartbeat = LoopingCall(self.beat)
+
+    def attach(self, state):
+        """
+        Publish a session state.
+
+        @param state: session state to publish.
+        @type state: C{SessionState}.
+        """
+        self.state = state
+        self.version = state.version
+        self.snapshot_cache = (None, None)
+
+    def subscribe(self, request):
+        """
+        Subscribe the client of an http request, sending it the current
+        snapshot and recent commentary.
+
+        @param request: open http request.
+        @type request: C{Request}.
+        @return: subscriber.
+        @rtype: C{Subscriber}.
+        """
+        subscriber = Subscriber(self, request, self.max_cells, self.history)
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda _:
+                                       self.unsubscribe(subscriber))
+        self.subscribers.add(subscriber)
+        if self.state is not None:
+            request.write(self.snapshot_message())
+        for message in self.comments:
+            request.write(message)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """forget a subscriber whose connection is lost."""
+        self.subscribers.discard(subscriber)
+
+    def broadcast(self, message, event, data=None):
+        """send an encoded message to all subscribers."""
+        PUSH_MESSAGES.inc((event,))
+        for subscriber in list(self.subscribers):
+            subscriber.send(message, event, data)
+
+    def snapshot_message(self):
+        """return the encoded snapshot of the current state."""
+        version, message = self.snapshot_cache
+        if message is None or version != self.state.version:
+            cars = dict((str(car), cells)
+                        for car, cells in self.state.snapshot().iteritems())
+            message = encode(SNAPSHOT, {'event': self.state.event_type,
+                                        'cars': cars})
+            self.snapshot_cache = (self.state.version, message)
+        return message
+
+    def snapshot(self):
+        """broadcast the complete state, e.g. after a key frame."""
+        if self.state is None:
+            return
+        self.cancel()
+        self.version = self.state.version
+        self.broadcast(self.snapshot_message(), SNAPSHOT)
+
+    def changed(self):
+        """
+        Notify the server that the state changed; the changes are sent
+        once the update interval has elapsed.
+        """
+        if self.timer is not None:
+            return
+        delay = max(self.published + self.interval - time.time(), 0)
+        self.timer = reactor.callLater(delay, self.publish)
+
+    def publish(self):
+        """broadcast the cells changed since the last update."""
+        self.timer = None
+        self.published = time.time()
+        cells = self.state.changed_since(self.version)
+        self.version = self.state.version
+        if not cells:
+            return
+        data = dict(('{0}/{1}'.format(car, column), value)
+                    for car, column, value in cells)
+        self.broadcast(encode(TIMING, data), TIMING, data)
+
+    def comment(self, comment):
+        """
+        Broadcast a complete comment.
+
+        @param comment: comment text.
+        @type comment: C{string}.
+        """
+        message = encode(COMMENTARY, comment)
+        self.comments.append(message)
+        self.broadcast(message, COMMENTARY)
+
+    def beat(self):
+        """keep connections open and disconnect stalled subscribers."""
+        now = time.time()
+        for subscriber in list(self.subscribers):
+            if subscriber.paused is None:
+                subscriber.request.write(HEARTBEAT_MESSAGE)
+            elif now - subscriber.paused > self.max_stall:
+                log.info('Disconnecting subscriber stalled for {0:.0f} s'
+                         .format(now - subscriber.paused))
+                self.unsubscribe(subscriber)
+                subscriber.disconnect()
+
+    def cancel(self):
+        """cancel a scheduled update."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def listen(self, port=8081, interface='127.0.0.1'):
+        """
+        Serve subscribers over http on the reactor.
+
+        @param port: http port.
+        @type port: C{int}.
+        @param interface: interface to listen on (default: loopback only;
+                          '' for all, so dashboards on other hosts can
+                          subscribe).
+        @type interface: C{string}.
+        """
+        log.info('Serving timing updates on {0}:{1}'
+                 .format(interface or '*', port))
+        if not self.heartbeat.running:
+            self.heartbeat.start(HEARTBEAT, now=False)
+        return reactor.listenTCP(port, Site(PushResource(self)),
+                                 interface=interface)
+
+    def stats(self):
+        """
+        Return push statistics.
+
+        @return: subscribers, of which paused.
+        @rtype: C{dict}.
+        """
+        return {'subscribers': len(self.subscribers),
+                'paused': sum(1 for subscriber in self.subscribers
+                              if subscriber.paused is not None)}
+
+class PushResource(Resource):
+    """http resource subscribing clients to a push server."""
+    isLeaf = True
+
+    def __init__(self, server):
+        Resource.__init__(self)
+        self.server = server
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        if self.server.origin:
+            request.setHeader('access-control-allow-origin',
+                              self.server.origin)
+        self.server.subscribe(request)
+        return NOT_DONE_YET
@@ -0,0 +1,256 @@
+"""
+Offline replay of saved sessions through the streaming client protocol.
+
+The state of a session at any point in time is rebuilt from the last state
+checkpoint saved before it, replaying only the records that follow it.
+"""
+import logging
+import time
+from packetlog import MmapLogReader
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from packetlog import CHECKPOINT
+from crypto import DecryptionContext
+from streaming import KeyFrameParser
+from streaming import StreamingClientProtocol
+from streaming import StreamingClientFactory
+from streaming import decode_checkpoint
+from streaming import key_frame_id_of
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+__all__ = ['Replayer', 'ReplayProtocol', 'state_at']
+
+log = logging.getLogger(__name__)
+
+# records replayed per reactor iteration when replaying as fast as possible
+BATCH = 1000
+
+class ReplayProtocol(StreamingClientProtocol):
+    """
+    Streaming client protocol fed from a packet log: key frames come from
+    the log instead of the server, nothing is persisted again and the
+    server is never polled.
+    """
+    def init_state(self, packet):
+        """the key frame record follows in the log."""
+        pass
+
+    def wait_for_key(self, data):
+        """records are fed one after the other, with or without the
+           reactor: keys are loaded as event packets are parsed."""
+        return False
+
+    def save_key_frame(self, keyframe, key_frame_id):
+        pass
+
+    def save_packet(self, packet):
+        pass
+
+class Replayer(object):
+    """Replay the records of a packet log at a given speed."""
+
+    def __init__(self, directory='.', factory=None, speed=1.0, start=None):
+        """
+        Prepare a replay.
+
+        @param directory: directory of the packet log.
+        @type directory: C{string}.
+        @param factory: streaming client factory (default: a new one).
+        @type factory: C{StreamingClientFactory}.
+        @param speed: speed factor relative to real time; 0 replays as
+                      fast as possible.
+        @type speed: C{float}.
+        @param start: time to start from; the replay starts at the packet
+                      of the nearest key frame before it (default: start
+                      of the log).
+        @type start: C{float}.
+        """
+        self.reader = MmapLogReader(directory)
+        self.factory = factory or StreamingClientFactory()
+        self.protocol = ReplayProtocol(self.factory)
+        self.speed = speed
+        self.start = start
+        self.replayed = 0
+
+    def records(self):
+        """iterate the records to replay."""
+        sequence = 0
+        if self.start is not None:
+            keyframe = self.reader.key_frame_before(self.start)
+            if keyframe is None:
+                log.info('No key frame before {0}'.format(self.start))
+            elif self.restore_key(keyframe):
+                sequence = self.key_frame_packet(keyframe)
+            else:
+                log.info('No key of key frame {0}: replaying from the start'
+                         .format(keyframe.key_frame_id))
+        return self.reader.records(sequence)
+
+    def key_frame_packet(self, keyframe):
+        """
+        Return the sequence of the packet announcing a key frame record: the
+        cipher is reset there, and the packets streamed until the key frame
+        was downloaded follow it.
+        """
+        first = 0
+        for entry in self.reader.index():
+            if entry.sequence >= keyframe.sequence:
+                break
+            if entry.kind == KEY_FRAME:
+                first = entry.sequence
+        found = keyframe.sequence
+        for record in self.reader.records(first, keyframe.sequence):
+            if record.kind == PACKET and \
+               key_frame_id_of(record.payload) == keyframe.key_frame_id:
+                found = record.sequence
+        return found
+
+    def restore_key(self, keyframe):
+        """
+        Restore the event and key of the stream replayed from a key frame,
+        whose event packet is not replayed: from the last checkpoint before
+        it, or from the event packet of the key frame itself.
+
+        @return: whether the key is known.
+        @rtype: C{bool}.
+        """
+        checkpoint = self.reader.checkpoint_before(keyframe.timestamp)
+        if checkpoint is not None:
+            checkpoint = decode_checkpoint(str(checkpoint.payload))
+            event_id, key, _ = checkpoint['crypto']
+        else:
+            context = DecryptionContext(self.factory.crypto.user_token)
+            for _ in KeyFrameParser(str(keyframe.payload), context):
+                if context.key is not None:
+                    break
+            event_id, key = context.event_id, context.key
+        if key is None:
+            return False
+        self.factory.crypto.event_id = event_id
+        self.factory.crypto.set_key(key)
+        return True
+
+    def feed(self, record):
+        """feed a single record to the protocol."""
+        if record.kind == KEY_FRAME:
+            self.protocol.keyframeReceived(record.payload,
+                                           '{0:0>5d}'.format(record.key_frame_id))
+        elif record.kind == PACKET:
+            self.protocol.dataReceived(record.payload)
+        self.replayed += 1
+
+    def restore(self, record):
+        """restore the session from a checkpoint record."""
+        checkpoint = decode_checkpoint(str(record.payload))
+        sink = self.factory.sink
+        sink.state.restore(checkpoint['state'])
+        sink.comment = checkpoint['comment']
+        self.factory.crypto.restore(checkpoint['crypto'])
+
+    def seek(self, timestamp):
+        """
+        Bring the session to a point in time: restore the last checkpoint
+        before it and replay the records after the checkpoint, or replay
+        from the start of the log when there is no checkpoint.
+
+        @param timestamp: point in time.
+        @type timestamp: C{float}.
+        @return: number of replayed records.
+        @rtype: C{int}.
+        """
+        entry = self.reader.entry_before(timestamp, (CHECKPOINT,))
+        if entry is None:
+            log.info('No checkpoint before {0}'.format(timestamp))
+            records = self.reader.records()
+        else:
+            records = self.reader.records_from(entry)
+            self.restore(next(records))
+        for record in records:
+            if record.timestamp > timestamp:
+                break
+            self.feed(record)
+        return self.replayed
+
+    def run(self):
+        """
+        Replay all records without the reactor, as fast as possible.
+
+        @return: number of replayed records.
+        @rtype: C{int}.
+        """
+        for record in self.records():
+            self.feed(record)
+        self.reader.close()
+        return self.replayed
+
+    def play(self):
+        """
+        Replay on the reactor, paced by the record timestamps.
+
+        @return: deferred firing with the number of replayed records.
+        @rtype: C{Deferred}.
+        """
+        self.done = Deferred()
+        self.pending = self.records()
+        self.next = next(self.pending, None)
+        self.origin = None
+        reactor.callLater(0, self.step)
+        return self.done
+
+    def step(self):
+        """replay all records that are due, then wait for the next one."""
+        now = time.time()
+        count = 0
+        while self.next is not None:
+            record = self.next
+            if self.speed:
+                if self.origin is None:
+                    self.origin = (now, record.timestamp)
+                due = self.origin[0] + \
+                      (record.timestamp - self.origin[1]) / self.speed
+                if due > now:
+                    reactor.callLater(due - now, self.step)
+                    return
+            elif count == BATCH:
+                reactor.callLater(0, self.step)
+                return
+            self.feed(record)
+            count += 1
+            self.next = next(self.pending, None)
+        self.reader.close()
+        self.done.callback(self.replayed)
+
+class SeekFactory(StreamingClientFactory):
+    """streaming client factory rebuilding state offline, publishing
+       nothing."""
+    def create_firebase_ref(self, event):
+        pass
+
+def state_at(directory, timestamp, relative=False):
+    """
+    Rebuild the timing state of a saved session at a point in time.
+
+    @param directory: directory of the packet log.
+    @type directory: C{string}.
+    @param timestamp: point in time, in seconds since the epoch or, when
+                      relative, since the first record of the log.
+    @type timestamp: C{float}.
+    @param relative: whether timestamp is relative to the session start.
+    @type relative: C{bool}.
+    @return: timing state at that time.
+    @rtype: C{SessionState}.
+    """
+    factory = SeekFactory(DecryptionContext(name='seek'), name='seek',
+                          checkpoint_interval=0)
+    replayer = Replayer(directory, factory, speed=0)
+    try:
+        if relative:
+            first = next(replayer.reader.records(), None)
+            if first is None:
+                return factory.state
+            timestamp += first.timestamp
+        replayer.seek(timestamp)
+    finally:
+        replayer.reader.close()
+    return factory.state
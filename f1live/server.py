@@ -0,0 +1,417 @@
+"""
+Local stand-in for the live timing server, for load and soak testing.
+
+The server answers the http requests of the client (login, decryption key,
+key frames) and streams encrypted packets on the stream port, either
+replayed from a packet log or generated synthetically. LoadTest connects
+many streaming clients to it and measures packets/s and end-to-end latency.
+
+    > python server.py --clients 100 --rate 1000 --duration 30
+"""
+import logging
+import random
+import struct
+import time
+import zlib
+import argparse
+import http
+import Packet
+from crypto import Crypto
+from crypto import DecryptionContext
+from packetlog import PacketLogReader
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from streaming import StreamingClientProtocol
+from streaming import StreamingClientFactory
+from streaming import POLL_REQUEST
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+__all__ = ['LiveTimingServer', 'LoadTest', 'recorded_packets',
+           'synthetic_packets']
+
+log = logging.getLogger(__name__)
+
+USER_TOKEN = 'f1live-test-user'
+EVENT_ID = '09999'
+KEY = 0x5ec7e7a1
+
+# poll behaviour: push packets as they are generated, or only when polled
+PUSH = 'push'
+POLL = 'poll'
+
+# system packet types of the stream
+SYS_EVENT_ID = 1
+SYS_KEY_FRAME = 2
+
+def header(car, kind, data):
+    """pack a packet header."""
+    return struct.pack('<H', car | (kind << 5) | (data << 9))
+
+def packet_key(key_frame_id, packet):
+    """
+    Identify a raw packet in the stream by the key frame it follows and its
+    checksum, the same for the server and every client whatever packets
+    they skip.
+    """
+    return (key_frame_id, zlib.crc32(packet) & 0xffffffff)
+
+def recorded_packets(directory, keyframes):
+    """
+    Yield the raw packets of a packet log, as recorded from the stream.
+
+    @param directory: directory of the packet log.
+    @type directory: C{string}.
+    @param keyframes: dictionary filled with key frames by key frame id.
+    @type keyframes: C{dict}.
+    @return: generator of raw packets.
+    @rtype: C{generator}.
+    """
+    for record in PacketLogReader(directory):
+        if record.kind == KEY_FRAME:
+            keyframes[record.key_frame_id] = record.payload
+        elif record.kind == PACKET:
+            yield record.payload
+
+def synthetic_packets(keyframes, key=KEY, event_id=EVENT_ID, cars=24,
+                      keyframe_interval=5000):
+    """
+    Yield an endless synthetic stream: an event id packet, then car timing
+    packets with a key frame packet every keyframe_interval packets.
+
+    @param keyframes: dictionary filled with key frames by key frame id.
+    @type keyframes: C{dict}.
+    @param key: master key to encrypt with.
+    @type key: C{int}.
+    @param event_id: event id announced in the stream.
+    @type event_id: C{string}.
+    @param cars: number of cars.
+    @type cars: C{int}.
+    @param keyframe_interval: number of packets between key frames.
+    @type keyframe_interval: C{int}.
+    @return: generator of raw packets.
+    @rtype: C{generator}.
+    """
+    crypto = DecryptionContext()
+    crypto.set_key(key)
+    payload = '\x01' + event_id
+    yield header(0, SYS_EVENT_ID, len(payload)) + payload
+    keyframe_id = 0
+    count = 0
+    latest = {}
+    while True:
+        if count % keyframe_interval == 0:
+            keyframe_id += 1
+            keyframes[keyframe_id] = encrypt_key_frame(latest.values(), key)
+            yield header(0, SYS_KEY_FRAME, 2) + struct.pack('<H', keyframe_id)
+            crypto.reset()
+        car = random.randint(1, cars)
+        kind = random.randint(1, 12)
+        plain = '{0:.3f}'.format(random.uniform(60, 120))
+        latest[car, kind] = header(car, kind, len(plain) << 3) + plain
+        yield header(car, kind, len(plain) << 3) + crypto.decrypt(plain)
+        count += 1
+
+def encrypt_key_frame(packets, key):
+    """
+    Encrypt plain packets into a key frame: from the seed, with a context
+    of its own, as L{DecryptionContext.key_frame_context} decrypts it.
+    """
+    crypto = DecryptionContext()
+    crypto.set_key(key)
+    return ''.join(packet[:2] + crypto.decrypt(packet[2:])
+                   for packet in packets)
+
+class LiveTimingResource(Resource):
+    """http side of the server: login, decryption key and key frames."""
+    isLeaf = True
+
+    def __init__(self, server):
+        Resource.__init__(self)
+        self.server = server
+
+    def render_POST(self, request):
+        if request.path == '/reg/login':
+            request.setResponseCode(302)
+            request.addCookie('USER', self.server.user_token)
+            request.setHeader('location', '/')
+            return ''
+        request.setResponseCode(404)
+        return ''
+
+    def render_GET(self, request):
+        path = request.path
+        if path.startswith('/reg/getkey/'):
+            return '{0:08x}'.format(self.server.key)
+        if path.startswith('/keyframe_') and path.endswith('.bin'):
+            keyframe_id = int(path[len('/keyframe_'):-len('.bin')])
+            try:
+                return self.server.keyframes[keyframe_id]
+            except KeyError:
+                pass
+        request.setResponseCode(404)
+        return ''
+
+class StreamServerProtocol(Protocol):
+    """stream side of the server: sends packets to one client."""
+    def connectionMade(self):
+        self.pending = []
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.clients.remove(self)
+
+    def dataReceived(self, data):
+        if POLL_REQUEST in data:
+            self.factory.polls += 1
+            if self.factory.poll == POLL:
+                self.flush()
+
+    def send(self, data):
+        """send or queue data, depending on the poll behaviour."""
+        if self.factory.poll == POLL:
+            self.pending.append(data)
+        else:
+            self.write(data)
+
+    def flush(self):
+        """send queued data."""
+        if self.pending:
+            self.write(''.join(self.pending))
+            self.pending = []
+
+    def write(self, data):
+        """write data, fragmented if configured."""
+        size = self.factory.fragment
+        if not size:
+            self.transport.write(data)
+            return
+        for offset in xrange(0, len(data), size):
+            self.transport.write(data[offset:offset + size])
+
+class LiveTimingServer(ServerFactory):
+    """Stand-in live timing server streaming packets to all clients."""
+    protocol = StreamServerProtocol
+
+    def __init__(self, packets, keyframes, key=KEY, event_id=EVENT_ID,
+                 user_token=USER_TOKEN, rate=100.0, burst=1, fragment=0,
+                 poll=PUSH, loop=False):
+        """
+        Create a stand-in server.
+
+        @param packets: iterable of raw packets to stream.
+        @type packets: C{iterable}.
+        @param keyframes: key frames by key frame id.
+        @type keyframes: C{dict}.
+        @param key: master decryption key served to clients.
+        @type key: C{int}.
+        @param event_id: event id of the streamed packets.
+        @type event_id: C{string}.
+        @param user_token: USER cookie value set on login.
+        @type user_token: C{string}.
+        @param rate: packets per second.
+        @type rate: C{float}.
+        @param burst: packets sent per write.
+        @type burst: C{int}.
+        @param fragment: maximum bytes per transport write (0: no limit).
+        @type fragment: C{int}.
+        @param poll: 'push' (default) or 'poll', to send only when polled.
+        @type poll: C{string}.
+        @param loop: restart the packets when exhausted (lists only).
+        @type loop: C{bool}.
+        """
+        if poll not in (PUSH, POLL):
+            raise ValueError("Unknown value of 'poll' argument")
+        self.source = packets
+        self.packets = iter(packets)
+        self.keyframes = keyframes
+        self.key = key
+        self.event_id = event_id
+        self.user_token = user_token
+        self.rate = rate
+        self.burst = burst
+        self.fragment = fragment
+        self.poll = poll
+        self.loop = loop
+        self.clients = []
+        self.ticker = LoopingCall(self.tick)
+
+        # statistics: send time of every packet by packet key
+        self.sent = {}
+        self.count = 0
+        self.key_frame_id = -1
+        self.polls = 0
+
+    def listen(self, http_port=8080, stream_port=http.F1_LIVE_PORT,
+               interface='127.0.0.1'):
+        """
+        Start serving http and stream requests.
+
+        @param http_port: http port.
+        @type http_port: C{int}.
+        @param stream_port: stream port.
+        @type stream_port: C{int}.
+        @param interface: interface to listen on.
+        @type interface: C{string}.
+        """
+        reactor.listenTCP(http_port, Site(LiveTimingResource(self)),
+                          interface=interface)
+        reactor.listenTCP(stream_port, self, interface=interface)
+        self.ticker.start(self.burst / float(self.rate), now=False)
+
+    def tick(self):
+        """send the next burst of packets to all clients."""
+        burst = []
+        for _ in xrange(self.burst):
+            packet = next(self.packets, None)
+            if packet is None and self.loop:
+                self.packets = iter(self.source)
+                packet = next(self.packets, None)
+            if packet is None:
+                break
+            burst.append(packet)
+        if not burst:
+            self.ticker.stop()
+            return
+        now = time.time()
+        for packet in burst:
+            if struct.unpack('<H', packet[:2])[0] & 0x1ff == \
+               SYS_KEY_FRAME << 5:
+                self.key_frame_id = struct.unpack('<H', packet[2:4])[0]
+            self.sent[packet_key(self.key_frame_id, packet)] = now
+        self.count += len(burst)
+        data = ''.join(burst)
+        for client in self.clients:
+            client.send(data)
+
+class MeasuringProtocol(StreamingClientProtocol):
+    """streaming client measuring the latency of the packets it gets."""
+    def connectionMade(self):
+        # packets before the next key frame packet follow the current one
+        self.key_frame_id = self.factory.stand_in.key_frame_id
+
+    def init_state(self, packet):
+        """fetch key frames, but never poll during a load test."""
+        StreamingClientProtocol.init_state(self, packet)
+        self.setTimeout(None)
+
+    def save_key_frame(self, keyframe, key_frame_id):
+        pass
+
+    def save_packet(self, packet):
+        if isinstance(packet, Packet.SystemKeyFrame):
+            self.key_frame_id = packet.key_frame_id
+        sent = self.factory.stand_in.sent.get(packet_key(self.key_frame_id,
+                                                         packet.raw))
+        if sent is not None:
+            self.factory.latencies.append(time.time() - sent)
+
+class MeasuringFactory(StreamingClientFactory):
+    """streaming client factory collecting packet latencies."""
+    def __init__(self, stand_in, name, server):
+        """
+        @param stand_in: stand-in server streaming to the client.
+        @type stand_in: C{LiveTimingServer}.
+        @param name: name of the client in metrics.
+        @type name: C{string}.
+        @param server: http host:port of the stand-in server.
+        @type server: C{string}.
+        """
+        StreamingClientFactory.__init__(self, name=name, server=server)
+        self.stand_in = stand_in
+        self.latencies = []
+
+    def buildProtocol(self, addr):
+        return MeasuringProtocol(self)
+
+class LoadTest(object):
+    """Drive many streaming clients against a stand-in server."""
+
+    def __init__(self, server, clients=10, http_port=8080,
+                 stream_port=http.F1_LIVE_PORT):
+        self.server = server
+        self.clients = clients
+        self.http_port = http_port
+        self.stream_port = stream_port
+        self.factories = []
+
+    def start(self):
+        """start the server and connect the clients."""
+        self.server.listen(self.http_port, self.stream_port)
+        http.F1_LIVE_SERVER = '127.0.0.1:{0}'.format(self.http_port)
+        Crypto.set_user_token(self.server.user_token)
+        # the key is known: never fetch it with a blocking request to the
+        # server running on this very reactor
+        Crypto.keys.remember(self.server.event_id.zfill(5), self.server.key)
+        self.started = time.time()
+        for client in xrange(self.clients):
+            factory = self.make_factory(client)
+            self.factories.append(factory)
+            reactor.connectTCP('127.0.0.1', self.stream_port, factory)
+
+    def make_factory(self, client):
+        """create the streaming client factory of a client."""
+        return MeasuringFactory(self.server, 'load{0}'.format(client),
+                                '127.0.0.1:{0}'.format(self.http_port))
+
+    def report(self):
+        """print packets/s and latency percentiles."""
+        elapsed = time.time() - self.started
+        latencies = sorted(latency for factory in self.factories
+                           for latency in factory.latencies)
+        print '{0} clients, {1} packets sent, {2} received in {3:.1f} s' \
+              .format(self.clients, self.server.count, len(latencies),
+                      elapsed)
+        print '{0:.0f} packets/s received, {1} polls' \
+              .format(len(latencies) / elapsed, self.server.polls)
+        if latencies:
+            for percentile in (50, 90, 99):
+                index = min(len(latencies) * percentile // 100,
+                            len(latencies) - 1)
+                print 'p{0} latency: {1:.2f} ms'.format(
+                                        percentile, latencies[index] * 1000)
+
+def main(argv=None):
+    """run a load test against a stand-in server."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--log', help='replay this packet log directory '
+                                      '(default: synthetic packets)')
+    parser.add_argument('--key', default='{0:08x}'.format(KEY),
+                        help='master key of the packet log (hex)')
+    parser.add_argument('--event', default=EVENT_ID,
+                        help='event id of the packet log')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='packets per second')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='packets per write')
+    parser.add_argument('--fragment', type=int, default=0,
+                        help='maximum bytes per write (0: no limit)')
+    parser.add_argument('--poll', choices=(PUSH, POLL), default=PUSH)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run')
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--stream-port', type=int, default=http.F1_LIVE_PORT)
+    args = parser.parse_args(argv)
+
+    keyframes = {}
+    if args.log:
+        packets = list(recorded_packets(args.log, keyframes))
+    else:
+        packets = synthetic_packets(keyframes)
+    server = LiveTimingServer(packets, keyframes, key=int(args.key, 16),
+                              event_id=args.event, rate=args.rate, burst=args.burst,
+                              fragment=args.fragment, poll=args.poll,
+                              loop=bool(args.log))
+    test = LoadTest(server, args.clients, args.http_port, args.stream_port)
+    reactor.callWhenRunning(test.start)
+    reactor.callLater(args.duration, reactor.stop)
+    reactor.run()
+    test.report()
+
+if __name__ == '__main__':
+    main()
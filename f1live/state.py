@@ -0,0 +1,237 @@
+"""
+In-memory timing state of a session.
+
+The state holds one row per car with the columns of the timing screen.
+Key frames initialise it and every car packet updates a single cell in
+place. Every change bumps a version counter and is appended to a change
+log, so consumers can pull just the cells changed since the version they
+saw last instead of diffing snapshots.
+
+Car packets are expected to carry the car id in C{car}, the packet type
+(the timing screen column) in C{type} and the decoded cell text in C{value}.
+"""
+import logging
+
+__all__ = ['SessionState', 'CarRow', 'COLUMNS']
+
+log = logging.getLogger(__name__)
+
+RACE = 'race'
+PRACTICE = 'practice'
+QUALIFYING = 'qualifying'
+
+# timing screen columns by packet type (0 is a position update) per event
+LAYOUTS = {
+    RACE: ('position', 'position', 'number', 'driver', 'gap', 'interval',
+           'lap_time', 'sector_1', 'pit_lap_1', 'sector_2', 'pit_lap_2',
+           'sector_3', 'pit_lap_3', 'pits'),
+    PRACTICE: ('position', 'position', 'number', 'driver', 'best', 'gap',
+               'sector_1', 'sector_2', 'sector_3', 'lap'),
+    QUALIFYING: ('position', 'position', 'number', 'driver', 'period_1',
+                 'period_2', 'period_3', 'sector_1', 'sector_2', 'sector_3',
+                 'lap'),
+}
+
+COLUMNS = ('position', 'number', 'driver', 'gap', 'interval', 'lap_time',
+           'sector_1', 'sector_2', 'sector_3', 'pit_lap_1', 'pit_lap_2',
+           'pit_lap_3', 'pits', 'best', 'period_1', 'period_2', 'period_3',
+           'lap')
+
+class CarRow(object):
+    """Timing screen row of a car."""
+    __slots__ = COLUMNS
+
+    def __init__(self):
+        for column in COLUMNS:
+            setattr(self, column, None)
+
+    def as_dict(self):
+        """return the non-empty cells of this row by column."""
+        return dict((column, getattr(self, column)) for column in COLUMNS
+                    if getattr(self, column) is not None)
+
+class SessionState(object):
+    """Timing state of a session, updated in place packet by packet."""
+
+    def __init__(self, event_type=RACE, max_log=10000):
+        """
+        @param event_type: 'race', 'practice' or 'qualifying'.
+        @type event_type: C{string}.
+        @param max_log: changes kept in the change log; consumers further
+                        behind get every cell changed since instead.
+        @type max_log: C{int}.
+        """
+        self.event_type = event_type
+        self.layout = LAYOUTS[event_type]
+        self.max_log = max_log
+        self.cars = {}
+        self.version = 0
+        self.versions = {}
+        self.dirty = set()
+        # (car, column) changed by each version after log_version
+        self.log = []
+        self.log_version = 0
+
+    def clear(self):
+        """
+        Remove every cell, e.g. before applying a key frame that holds the
+        complete state. The version is bumped, so consumers pulling changes
+        see the cells set after as changed.
+        """
+        self.cars = {}
+        self.versions = {}
+        self.dirty = set()
+        self.version += 1
+        self.log = []
+        self.log_version = self.version
+
+    def set_event_type(self, event_type):
+        """
+        Set the event type, which defines the meaning of car packets.
+
+        @param event_type: 'race', 'practice' or 'qualifying'.
+        @type event_type: C{string}.
+        """
+        event_type = str(event_type).lower()
+        if event_type not in LAYOUTS:
+            log.info('Unknown event type {0}'.format(event_type))
+            return
+        self.event_type = event_type
+        self.layout = LAYOUTS[event_type]
+
+    def apply(self, packet):
+        """
+        Update the state with a packet; other than car packets are ignored.
+
+        @param packet: received packet.
+        @type packet: C{Packet}.
+        @return: True if a cell changed.
+        @rtype: C{bool}.
+        """
+        car = getattr(packet, 'car', 0)
+        if not car:
+            return False
+        try:
+            column = self.layout[packet.type]
+        except (AttributeError, IndexError, TypeError):
+            return False
+        return self.set(car, column, getattr(packet, 'value', None))
+
+    def set(self, car, column, value):
+        """
+        Set a cell.
+
+        @param car: car id.
+        @type car: C{int}.
+        @param column: column name.
+        @type column: C{string}.
+        @param value: cell value.
+        @type value: C{string}.
+        @return: True if the cell changed.
+        @rtype: C{bool}.
+        """
+        try:
+            row = self.cars[car]
+        except KeyError:
+            row = self.cars[car] = CarRow()
+        if getattr(row, column) == value:
+            return False
+        setattr(row, column, value)
+        self.version += 1
+        self.versions[car, column] = self.version
+        self.dirty.add((car, column))
+        self.log.append((car, column))
+        if len(self.log) > 2 * self.max_log:
+            del self.log[:-self.max_log]
+            self.log_version = self.version - self.max_log
+        return True
+
+    def get(self, car, column):
+        """
+        Get a cell.
+
+        @param car: car id.
+        @type car: C{int}.
+        @param column: column name.
+        @type column: C{string}.
+        @return: cell value, or None if not set.
+        @rtype: C{string}.
+        """
+        row = self.cars.get(car)
+        if row is None:
+            return None
+        return getattr(row, column)
+
+    def changed_since(self, version):
+        """
+        Return the cells changed after a version.
+
+        @param version: version seen last by the consumer.
+        @type version: C{int}.
+        @return: (car, column, value) of every changed cell.
+        @rtype: C{list}.
+        """
+        if version >= self.version:
+            return []
+        if version < self.log_version:
+            # older than the change log: every cell changed since
+            cells = [cell for cell, changed in self.versions.iteritems()
+                     if changed > version]
+        else:
+            cells = set(self.log[version - self.log_version:])
+        return [(car, column, getattr(self.cars[car], column))
+                for car, column in cells]
+
+    def pop_dirty(self):
+        """
+        Return and clear the set of cells changed since the last call.
+
+        @return: (car, column) of every changed cell.
+        @rtype: C{set}.
+        """
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def snapshot(self):
+        """
+        Return the complete state.
+
+        @return: non-empty cells by column by car id.
+        @rtype: C{dict}.
+        """
+        return dict((car, row.as_dict()) for car, row in self.cars.iteritems())
+
+    def checkpoint(self):
+        """
+        Take a checkpoint of the state, including cell versions.
+
+        @return: JSON-serializable checkpoint to pass to L{restore}.
+        @rtype: C{dict}.
+        """
+        return {'event_type': self.event_type,
+                'version': self.version,
+                'cars': dict((str(car), cells)
+                             for car, cells in self.snapshot().iteritems()),
+                'versions': [[car, column, version] for (car, column), version
+                             in self.versions.iteritems()]}
+
+    def restore(self, checkpoint):
+        """
+        Restore the state from a checkpoint; no cell is left dirty.
+
+        @param checkpoint: checkpoint taken by L{checkpoint}.
+        @type checkpoint: C{dict}.
+        """
+        self.set_event_type(checkpoint['event_type'])
+        self.version = checkpoint['version']
+        self.cars = {}
+        for car, cells in checkpoint['cars'].iteritems():
+            row = self.cars[int(car)] = CarRow()
+            for column, value in cells.iteritems():
+                setattr(row, column, value)
+        self.versions = dict(((car, column), version)
+                             for car, column, version
+                             in checkpoint['versions'])
+        self.dirty = set()
+        self.log = []
+        self.log_version = self.version
@@ -2,15 +2,27 @@
 F1 Live streaming client.
 """
 import logging
+import time
+import zlib
+import json
 import Packet
 import http
 import db
 import firebase
 import config
+import metrics
+from crypto import Crypto
+from crypto import DecryptionContext
+from buffer import ReceiveBuffer
+from state import SessionState
+from publisher import TimingPublisher
+from dispatch import Dispatcher
+from poll import PollScheduler
 from twisted.internet.protocol import Protocol
 from twisted.protocols.policies import TimeoutMixin
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.internet.defer import Deferred
+from array import array
 from tools.dump import hexdump
 
 __all__ = ['StreamingClientFactory']
@@ -19,116 +31,622 @@ log = logging.getLogger(__name__)
 
 POLL_REQUEST = '\x10'
 
+# packet header: car id in bits 0-4, packet type in bits 5-8 and data in
+# bits 9-15, the payload length of event packets
+SYS_EVENT_ID = 1
+SYS_KEY_FRAME = 2
+
+# metrics are labelled with the name of the stream
+PACKETS = metrics.counter('f1live_packets_total',
+                          'Packets received by packet type.',
+                          ('stream', 'type'))
+BYTES = metrics.counter('f1live_received_bytes_total',
+                        'Bytes received from the stream.', ('stream',))
+PARSE_LATENCY = metrics.histogram('f1live_parse_seconds',
+                                  'Time spent parsing (and decrypting) '
+                                  'a packet.', ('stream',))
+POLLS = metrics.counter('f1live_polls_total',
+                        'Poll requests sent to the server.', ('stream',))
+POLL_LATENCY = metrics.histogram('f1live_poll_latency_seconds',
+                                 'Time from a poll request to the data '
+                                 'answering it.', ('stream',),
+                                 buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                          1.0, 2.5, 5.0))
+POLL_INTERVAL = metrics.gauge('f1live_poll_interval_seconds',
+                              'Silence after which the server is polled.',
+                              ('stream',))
+KEY_FRAME_FETCH = metrics.histogram('f1live_key_frame_fetch_seconds',
+                                    'Time to download a key frame.',
+                                    ('stream',),
+                                    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                                             5.0, 10.0, 30.0))
+DB_QUEUE = metrics.gauge('f1live_db_queue_depth',
+                         'Records queued for the packet log.', ('stream',))
+FIREBASE_QUEUE = metrics.gauge('f1live_firebase_queue_depth',
+                               'Firebase writes waiting to be sent.',
+                               ('stream',))
+
+def packetize(data, offset=0):
+    """
+    Packetize data at an offset without copying the remainder of the data.
+
+    @param data: data to packetize.
+    @type data: C{string}.
+    @param offset: offset of the packet in data.
+    @type offset: C{int}.
+    @return: packet at offset.
+    @rtype: C{Packet}.
+    @raise Packet.NeedMoreData: when data holds an incomplete packet.
+    @raise Packet.UnknownPacketType: when the packet type is unknown.
+    """
+    return Packet.packetize(buffer(data, offset) if offset else data)
+
+def event_id_of(data):
+    """
+    Return the event id announced by an event packet (car 0, type 1) at the
+    start of data.
+
+    @param data: raw stream data.
+    @type data: C{string}.
+    @return: event id, or None if data does not start with a complete
+             event packet.
+    @rtype: C{string}.
+    """
+    if len(data) < 2:
+        return None
+    header = ord(data[0]) | ord(data[1]) << 8
+    length = header >> 9
+    if header & 0x1ff != SYS_EVENT_ID << 5 or len(data) < 2 + length:
+        return None
+    return str(data[3:2 + length])
+
+def key_frame_id_of(data):
+    """
+    Return the key frame id of a raw key frame packet (car 0, type 2).
+
+    @param data: raw packet.
+    @type data: C{string}.
+    @return: key frame id, or None if data is not a key frame packet.
+    @rtype: C{int}.
+    """
+    if len(data) < 4:
+        return None
+    header = ord(data[0]) | ord(data[1]) << 8
+    if header & 0x1ff != SYS_KEY_FRAME << 5:
+        return None
+    return ord(data[2]) | ord(data[3]) << 8
+
+def encode_checkpoint(checkpoint):
+    """
+    Serialize a checkpoint as JSON: data only, so a packet log never runs
+    code when read. Byte strings of any encoding are kept as latin-1.
+
+    @param checkpoint: checkpoint of L{StreamingClientFactory.checkpoint}.
+    @type checkpoint: C{dict}.
+    @return: serialized checkpoint.
+    @rtype: C{string}.
+    """
+    return json.dumps(checkpoint, encoding='latin-1')
+
+def decode_checkpoint(data):
+    """
+    Deserialize a checkpoint saved by L{encode_checkpoint}.
+
+    @param data: serialized checkpoint.
+    @type data: C{string}.
+    @return: checkpoint with byte strings.
+    @rtype: C{dict}.
+    @raise ValueError: when data is not a serialized checkpoint.
+    """
+    return to_bytes(json.loads(data))
+
+def to_bytes(value):
+    """convert the strings of decoded JSON back to latin-1 byte strings."""
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [to_bytes(item) for item in value]
+    if isinstance(value, dict):
+        return dict((to_bytes(key), to_bytes(item))
+                    for key, item in value.iteritems())
+    return value
+
+class KeyFrameParser(object):
+    """
+    Lazily parse a key frame into packets in a single linear pass. Unknown
+    packet types are skipped header by header and counted in skipped.
+    """
+    def __init__(self, keyframe, crypto):
+        self.keyframe = keyframe
+        self.crypto = crypto
+        self.offset = 0
+        self.skipped = 0
+
+    def __iter__(self):
+        keyframe = self.keyframe
+        totlen = len(keyframe)
+        while self.offset < totlen:
+            try:
+                with self.crypto:
+                    packet = packetize(keyframe, self.offset)
+            except Packet.UnknownPacketType as err:
+                log.debug(str(err))
+                self.offset += 2
+                self.skipped += 2
+            except Packet.NeedMoreData:
+                log.info('Truncated key frame at offset {0}'
+                         .format(self.offset))
+                self.skipped += totlen - self.offset
+                self.offset = totlen
+            else:
+                self.offset += len(packet)
+                yield packet
+
 class StreamingClientProtocol(Protocol, TimeoutMixin):
     """streaming client protocol implementation."""
     def __init__(self, factory):
         self.factory = factory
-        self.data = ''
+        self.sink = factory.sink
+        self.crypto = factory.crypto
+        self.state = factory.sink.state
+        self.buffer = ReceiveBuffer()
+        self.poller = PollScheduler(factory.min_poll, factory.max_poll)
+        self.labels = (factory.name,)
 
         # high-level protocol properties
-        self.comment = ''
+        self.in_key_frame = False
+        # skipping packets persisted before reconnecting
+        self.resuming = False
+        self.resumed = 0
+        # sequence of the last packet: key frame id and index after it
+        self.sequence_key_frame = -1
+        self.sequence_index = -1
+        # download of the key of an announced event the stream waits for
+        self.key_pending = None
+        self.key_failed = None
+
+        # packet handlers of this connection; event packets of the live
+        # stream set up the session as well as those of key frames
+        self.dispatcher = factory.dispatcher
+        self.handlers = ((self.init_state, (Packet.SystemKeyFrame,)),
+                         (self.comment_packet, (Packet.SystemCommentary,)),
+                         (self.event_packet, (Packet.SystemEvent,)),
+                         (self.update_state, ()))
+        for handler, packet_types in self.handlers:
+            self.dispatcher.subscribe(handler, *packet_types)
+
+    def connectionMade(self):
+        """resume after the packets persisted by a previous connection."""
+        self.resuming = self.factory.can_resume()
+        if self.resuming:
+            log.info('Resuming from key frame {0}'
+                     .format(self.factory.key_frame_id))
+        if self.crypto.event_id is not None:
+            # the stream starts over with the event packet: have its key
+            # ready before it arrives
+            Crypto.keys.prefetch(self.crypto.event_id,
+                                 self.crypto.get_user_token())
+
+    def connectionLost(self, reason):
+        """stop polling and unsubscribe the handlers of this connection."""
+        self.setTimeout(None)
+        self.key_pending = None
+        for handler, _ in self.handlers:
+            self.dispatcher.unsubscribe(handler)
 
     def init_state(self, packet):
         """initialize state with data from key frame packets."""
+        if self.in_key_frame:
+            return
+        self.factory.stream_key_frame(packet.key_frame_id)
         key_frame_id = '{0:0>5d}'.format(packet.key_frame_id)
         defer = Deferred()
-        defer.addCallback(self.keyframeReceived, key_frame_id)
+        defer.addBoth(self.keyframe_fetched, time.time())
+        defer.addCallbacks(self.keyframeReceived, self.keyframe_failed,
+                           callbackArgs=(key_frame_id,),
+                           errbackArgs=(key_frame_id,))
         http.get_async(defer, 'http://{0}/keyframe_{1}.bin'
-                        .format(http.F1_LIVE_SERVER, key_frame_id))
-        # start polling if no activity after 1 second
-        self.setTimeout(1)
+                        .format(self.factory.get_server(), key_frame_id))
+        # data follows key frames closely: start polling soon
+        self.poller.key_frame()
+        self.schedule_poll()
 
     def update_state(self, packet):
         """update state with data from packet."""
-        if type(packet) == Packet.SystemCommentary:
-            self.comment += packet.comment
-            if packet.last:
-                self.comment_received(self.comment)
-                self.comment = ''
+        if self.state.apply(packet):
+            self.sink.state_changed()
+
+    def comment_packet(self, packet):
+        """collect commentary until the comment is complete."""
+        # collected by the sink: parts may come from different streams
+        sink = self.sink
+        sink.comment += packet.comment
+        if packet.last:
+            self.comment_received(sink.comment)
+            sink.comment = ''
+
+    def event_packet(self, packet):
+        """set up the session of an event."""
+        try:
+            event = packet.get_event_type()
+        except Packet.UnknownEventType as err:
+            log.info(str(err))
+        else:
+            self.state.set_event_type(event)
+            self.sink.create_firebase_ref(event)
 
     def comment_received(self, comment):
         """callback when complete comment is received."""
-        self.factory.comment_finished(comment)
+        self.sink.comment_finished(comment)
 
     def keyframeReceived(self, keyframe, key_frame_id):
         """parse received key frame into packets; a key frame represents
            the current state."""
-        db.save_key_frame(keyframe, key_frame_id)
-        offset = 0
-        totlen = len(keyframe)
-        while offset < totlen:
-            try:
-                packet = Packet.packetize(keyframe[offset:])
-            except Packet.UnknownPacketType as err:
-                log.debug(str(err))
-                offset += 2
-            else:
-                if type(packet) == Packet.SystemEvent:
-                    try:
-                        self.factory.create_firebase_ref(
-                                        packet.get_event_type())
-                    except Packet.UnknownEventType as err:
-                        log.info(str(err))
-                self.update_state(packet)
-                db.save_packet(packet)
-                offset += len(packet)
+        self.save_key_frame(keyframe, key_frame_id)
+        # decrypted on its own: the stream's context is left untouched
+        parser = KeyFrameParser(keyframe, self.crypto.key_frame_context())
+        # the key frame holds the complete state: drop cells it lacks
+        self.state.clear()
+        self.in_key_frame = True
+        try:
+            for packet in parser:
+                self.dispatcher.dispatch(packet)
+        finally:
+            self.in_key_frame = False
+        if parser.skipped:
+            log.debug('Skipped {0} unknown bytes in key frame {1}'
+                      .format(parser.skipped, key_frame_id))
+        self.factory.key_frame_loaded(int(key_frame_id))
+        self.sink.state_initialised()
+
+    def keyframe_failed(self, failure, key_frame_id):
+        """errback when a key frame cannot be downloaded."""
+        log.error('Cannot download key frame {0}: {1}'
+                  .format(key_frame_id, failure.getErrorMessage()))
+
+    def keyframe_fetched(self, result, start):
+        """account the time spent downloading a key frame."""
+        KEY_FRAME_FETCH.observe(time.time() - start, self.labels)
+        return result
 
     def dataReceived(self, data):
-        """parse received data into packets."""
-        log.debug(hexdump(data))
-        self.resetTimeout()
-        self.data += data
+        """parse all complete packets of received data."""
+        if log.isEnabledFor(logging.DEBUG):
+            for line in hexdump(data, result='generator'):
+                log.debug(line)
+        BYTES.inc(self.labels, len(data))
+        latency = self.poller.data_received()
+        if latency is not None:
+            POLL_LATENCY.observe(latency, self.labels)
+        if self.timeOut is not None:
+            self.schedule_poll()
+        self.buffer.append(data)
+        self.buffer.drain(self.parse)
+
+    def parse(self, data):
+        """parse and handle one packet; return the number of bytes used."""
+        if self.key_pending is not None or self.wait_for_key(data):
+            return 0
+        start = time.time()
         try:
-            packet = Packet.packetize(self.data)
+            with self.crypto:
+                packet = Packet.packetize(data)
         except Packet.NeedMoreData:
-            return
+            return 0
         except Packet.UnknownPacketType as err:
             log.debug(str(err))
-            self.data = self.data[2:]
-        else:
+            return 2
+        PARSE_LATENCY.observe(time.time() - start, self.labels)
+        PACKETS.inc((self.factory.name, type(packet).__name__))
+        # skipped packets are numbered too, so the packets after them have
+        # the same sequence as in the other streams
+        sequence = self.sequence(packet)
+        if self.resuming and self.is_persisted(packet):
+            return len(packet)
+        fanin = self.factory.fanin
+        if fanin is None or fanin.accept(self.factory.name, sequence):
             self.handle_packet(packet)
-            db.save_packet(packet)
-            self.data = self.data[len(packet):]
+        elif isinstance(packet, Packet.SystemKeyFrame):
+            # key frames of other streams are not dispatched to init_state
+            self.factory.stream_key_frame(packet.key_frame_id)
+            self.poller.key_frame()
+            self.schedule_poll()
+        self.save_packet(packet)
+        return len(packet)
+
+    def wait_for_key(self, data):
+        """
+        Tell whether to hold back the stream until the key of the event
+        announced at the start of data is downloaded: parsing the event
+        packet loads its key, which must not block the reactor, so keys not
+        cached yet are downloaded first.
+        """
+        event_id = event_id_of(data)
+        if event_id is None or event_id == self.key_failed or \
+           Crypto.keys.get(event_id) is not None:
+            return False
+        defer = self.crypto.load_key_async(event_id)
+        defer.addErrback(self.key_fetch_failed, event_id)
+        if defer.called:
+            return False
+        self.key_pending = defer
+        defer.addCallback(self.key_fetched)
+        return True
+
+    def key_fetched(self, _):
+        """parse the data held back while the key was downloaded."""
+        if self.key_pending is None:
+            # the connection was lost meanwhile
+            return
+        self.key_pending = None
+        self.buffer.drain(self.parse)
+
+    def key_fetch_failed(self, failure, event_id):
+        """parse the event packet anyway, loading its key as it can."""
+        self.key_failed = event_id
+
+    def sequence(self, packet):
+        """
+        Return the sequence of a packet in the stream, the same in every
+        stream of a session: the id of the key frame it follows (-1 before
+        the first one) and its index after the key frame packet.
+        """
+        if isinstance(packet, Packet.SystemKeyFrame):
+            self.sequence_key_frame = packet.key_frame_id
+            self.sequence_index = 0
+        else:
+            self.sequence_index += 1
+        return (self.sequence_key_frame, self.sequence_index)
+
+    def is_persisted(self, packet):
+        """
+        Tell whether a packet was handled and persisted before reconnecting:
+        the stream of a key frame is replayed from its start, so the n-th
+        packet after it is a duplicate if it matches the n-th one persisted.
+        """
+        persisted = self.factory.persisted
+        if self.resumed < len(persisted) and \
+           persisted[self.resumed] == zlib.crc32(packet.raw) & 0xffffffff:
+            self.resumed += 1
+            return True
+        if not self.resumed and isinstance(packet, Packet.SystemEvent):
+            # sent first on every connection: parsing it loaded the key of
+            # the event, which is set up already
+            return True
+        if self.resumed:
+            log.info('Skipped {0} packets already persisted'
+                     .format(self.resumed))
+        self.resuming = False
+        return False
+
+    def save_key_frame(self, keyframe, key_frame_id):
+        """persist a raw key frame; its packets are not saved separately."""
+        self.factory.store.save_key_frame(keyframe, key_frame_id)
+
+    def save_packet(self, packet):
+        """persist a raw packet received from the stream."""
+        # a dropped packet ends what a resumed stream may skip
+        if self.factory.store.save_packet(packet):
+            self.factory.packet_persisted(packet)
 
     def handle_packet(self, packet):
         """handle received packet."""
-        if type(packet) == Packet.SystemKeyFrame:
-            self.init_state(packet)
-        else:
-            self.update_state(packet)
+        self.dispatcher.dispatch(packet)
 
     def timeoutConnection(self):
         """poll for more data from server."""
         self.transport.write(POLL_REQUEST)
-        self.setTimeout(1)
+        POLLS.inc(self.labels)
+        self.poller.polled()
+        self.schedule_poll()
+
+    def schedule_poll(self):
+        """poll when no data arrives within the current poll interval."""
+        interval = self.poller.interval()
+        POLL_INTERVAL.set(interval, self.labels)
+        self.setTimeout(interval)
 
-class StreamingClientFactory(ClientFactory):
-    """streaming client protocol factory."""
-    def __init__(self):
+class StreamingClientFactory(ReconnectingClientFactory):
+    """
+    Streaming client protocol factory. Lost connections are retried with
+    jittered exponential backoff; the user token, decryption context and
+    timing state are kept, so a new connection resumes from the last key
+    frame without logging in or fetching keys again.
+
+    Several factories can record redundant streams of the same session
+    into a L{FanIn}: each stream is decrypted and persisted on its own,
+    while the packets handled and published are the ones of the fan-in's
+    output factory, the sink, first received from any stream.
+    """
+    initialDelay = 0.1
+    maxDelay = 30
+    factor = 2.0
+    jitter = 0.2
+
+    def __init__(self, crypto=None, min_poll=0.1, max_poll=5.0, name='live',
+                 store=None, fanin=None, checkpoint_interval=30.0,
+                 push=None, server=None, timing=False):
+        """
+        @param crypto: decryption context (default: a new context).
+        @type crypto: C{DecryptionContext}.
+        @param min_poll: shortest silence before polling (seconds).
+        @type min_poll: C{float}.
+        @param max_poll: longest silence before polling (seconds).
+        @type max_poll: C{float}.
+        @param name: name of the stream in metrics.
+        @type name: C{string}.
+        @param store: packet store (default: the packet log of L{db}).
+        @type store: C{PacketStore}.
+        @param fanin: fan-in merging this stream with redundant ones.
+        @type fanin: C{FanIn}.
+        @param checkpoint_interval: time between state checkpoints saved
+                                    to the packet store (seconds; 0 saves
+                                    none).
+        @type checkpoint_interval: C{float}.
+        @param push: local push server the state and commentary are
+                     published to, besides Firebase.
+        @type push: C{PushServer}.
+        @param server: http host[:port] of the live timing server key frames
+                       are fetched from (default: L{http.F1_LIVE_SERVER}).
+        @type server: C{string}.
+        @param timing: record the time spent in every packet handler, as
+                       the f1live_handler_seconds metric.
+        @type timing: C{bool}.
+        """
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.name = name
+        self.server = server
+        self.store = store or db
+        self.fanin = fanin
+        # handled packets go to the sink: this factory or the fan-in output
+        self.sink = fanin.output if fanin else self
+        self.comment = ''
         self.comment_ref = None
+        self.firebase_root = None
+        self.publisher = None
+        # each stream decrypts with its own context
+        self.crypto = crypto or DecryptionContext(Crypto.user_token,
+                                                  name=name)
+        # timing state and packet sinks outlive connections
+        self.state = SessionState()
+        self.dispatcher = Dispatcher(timing, name)
+        self.push = push
+        if push:
+            push.attach(self.state)
+        DB_QUEUE.set_function(lambda: self.store.stats().get('queue_depth', 0),
+                              (name,))
+        # key frame the state was initialised from
+        self.key_frame_id = None
+        # key frame streamed last and checksums of the packets persisted
+        # since, to skip them when the stream is replayed after reconnecting
+        self.streamed_key_frame_id = None
+        self.persisted = array('L')
+        self.failed_writes = 0
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointed = time.time()
 
     def startedConnecting(self, connector):
         log.debug('Started connecting...')
 
     def buildProtocol(self, addr):
         log.info('Connected to {0}'.format(addr))
+        self.resetDelay()
+        if self.sink.publisher:
+            self.sink.publisher.snapshot()
         return StreamingClientProtocol(self)
 
     def clientConnectionLost(self, connector, reason):
         log.info('Connection lost. Reason: {0}'.format(reason))
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         log.info('Connection failed. Reason: {0}'.format(reason))
+        ReconnectingClientFactory.clientConnectionFailed(self, connector,
+                                                         reason)
+
+    def stream_key_frame(self, key_frame_id):
+        """
+        Start accounting for the packets persisted after a key frame packet.
+
+        @param key_frame_id: key frame id.
+        @type key_frame_id: C{int}.
+        """
+        self.streamed_key_frame_id = key_frame_id
+        self.persisted = array('L')
+        self.failed_writes = self.store.stats().get('failed', 0)
+
+    def key_frame_loaded(self, key_frame_id):
+        """
+        Remember the key frame the state was initialised from; the state
+        is shared by every stream of a fan-in, so it is for all of them.
+
+        @param key_frame_id: key frame id.
+        @type key_frame_id: C{int}.
+        """
+        for factory in self.fanin.feeds if self.fanin else (self,):
+            factory.key_frame_id = key_frame_id
+
+    def get_server(self):
+        """http host of the live timing server of this stream."""
+        return self.server or http.F1_LIVE_SERVER
+
+    def can_resume(self):
+        """
+        Tell whether a new connection can resume from the last key frame:
+        its state is loaded and packets after it were persisted, with no
+        write error since.
+
+        @rtype: C{bool}.
+        """
+        return bool(self.persisted) and \
+               self.key_frame_id == self.streamed_key_frame_id and \
+               self.store.stats().get('failed', 0) == self.failed_writes
+
+    def packet_persisted(self, packet):
+        """remember the checksum of a persisted packet."""
+        self.persisted.append(zlib.crc32(packet.raw) & 0xffffffff)
+        if self.checkpoint_interval and self.crypto.key is not None and \
+           time.time() - self.checkpointed >= self.checkpoint_interval:
+            self.save_checkpoint()
+
+    def checkpoint(self):
+        """
+        Take a checkpoint of the session after the last persisted packet:
+        the records that follow it in the packet log replay from there.
+
+        @return: timing state, decryption context and partial comment.
+        @rtype: C{dict}.
+        """
+        return {'state': self.sink.state.checkpoint(),
+                'crypto': self.crypto.checkpoint(),
+                'comment': self.sink.comment}
+
+    def save_checkpoint(self):
+        """persist a checkpoint of the session to the packet store."""
+        self.store.save_checkpoint(encode_checkpoint(self.checkpoint()))
+        self.checkpointed = time.time()
 
     def comment_finished(self, comment):
-        """push full comment to firebase reference."""
+        """push full comment to firebase reference and push server."""
+        if self.push:
+            self.push.comment(comment)
         if self.comment_ref:
-            self.comment_ref.push(comment)
+            # failures are logged (and retried) by the firebase batcher
+            self.comment_ref.push(comment).addErrback(lambda failure: None)
 
     def create_firebase_ref(self, event):
         """create our firebase references."""
         url = config.get_firebase()
         if url:
-            root = firebase.Firebase(url)
+            # Firebase drops the trailing slash of its location
+            url = url.rstrip('/')
+            # one root per url, so all writes share its update batcher
+            if self.firebase_root is None or str(self.firebase_root) != url:
+                self.firebase_root = firebase.AsyncFirebase(url)
+                batcher = self.firebase_root.batcher
+                FIREBASE_QUEUE.set_function(lambda: len(batcher.pending),
+                                            (self.name,))
+            root = self.firebase_root
             self.comment_ref = root.child('{0}/commentary'.format(event))
+            timing_ref = root.child('{0}/timing'.format(event))
+            if self.publisher is None or \
+               str(self.publisher.ref) != str(timing_ref):
+                if self.publisher:
+                    self.publisher.cancel()
+                self.publisher = TimingPublisher(timing_ref, self.state)
+
+    def state_initialised(self):
+        """publish a full snapshot of the state set by a key frame."""
+        if self.push:
+            self.push.snapshot()
+        if self.publisher:
+            self.publisher.snapshot()
+
+    def state_changed(self):
+        """publish changes of the state."""
+        if self.push:
+            self.push.changed()
+        if self.publisher:
+            self.publisher.changed()
 
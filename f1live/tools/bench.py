@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""
+A collection of micro-benchmarks.
+
+  - decrypt benchmark compares the table-driven decryption engine against
+    the original byte-at-a-time routine.
+
+    > python -m tools.bench decrypt
+    legacy       1.35 MB/s
+    table       10.28 MB/s (7.6x)
+
+  - receive benchmark replays a capture of saved .packet files through the
+    original string buffer and the receive buffer in TCP sized chunks and
+    reports how many times faster than real time each one drains it;
+    the capture is decrypted with its master key (hexadecimal).
+
+    > python -m tools.bench receive captures/2013-monaco 1460 100 5ec7e7a1
+"""
+import os
+import sys
+import glob
+import time
+import struct
+
+__all__ = ['bench_decrypt', 'bench_receive']
+
+MB = 1024.0 * 1024.0
+
+def measure(func, size, repeat=3):
+    """return best throughput of func in MB/s."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return size / MB / max(best, 1e-9)
+
+def report(name, rate, base=None):
+    """print a throughput line."""
+    if base:
+        print '{0:<8} {1:>8.2f} MB/s ({2:.1f}x)'.format(name, rate, rate / base)
+    else:
+        print '{0:<8} {1:>8.2f} MB/s'.format(name, rate)
+
+def legacy_decrypt(key, salt, data):
+    """original byte-at-a-time decryption routine; return data and salt."""
+    dec = []
+    for byte in data:
+        byte = struct.unpack('B', byte)[0]
+        salt = (salt >> 1) ^ (key if salt & 0x01 else 0)
+        dec.append(struct.pack('B', byte ^ (salt & 0xff)))
+    return ''.join(dec), salt
+
+def bench_decrypt(size=1 << 20, packet=64, key=0xa1b2c3d4):
+    """
+    Benchmark decryption throughput of packet sized chunks.
+
+    @param size: total number of bytes to decrypt.
+    @type size: C{int}.
+    @param packet: size of each decrypted chunk.
+    @type packet: C{int}.
+    @param key: master decryption key.
+    @type key: C{int}.
+    """
+    from crypto import DecryptionContext, CRYPTO_SEED
+    data = os.urandom(size)
+    chunks = [data[i:i+packet] for i in xrange(0, size, packet)]
+
+    def legacy():
+        salt = CRYPTO_SEED
+        for chunk in chunks:
+            salt = legacy_decrypt(key, salt, chunk)[1]
+
+    def table():
+        context.reset()
+        for chunk in chunks:
+            context.decrypt(chunk)
+
+    context = DecryptionContext()
+    context.set_key(key)
+    expected = legacy_decrypt(key, CRYPTO_SEED, data)[0]
+    if ''.join(context.decrypt(chunk) for chunk in chunks) != expected:
+        raise AssertionError('table-driven decryption output differs')
+
+    base = measure(legacy, size, repeat=1)
+    report('legacy', base)
+    report('table', measure(table, size), base)
+
+def read_capture(directory):
+    """return raw packets saved in directory and the capture duration."""
+    files = sorted(glob.glob(os.path.join(directory, '*.packet')))
+    packets = []
+    for name in files:
+        with open(name, 'rb') as _file:
+            packets.append(_file.read())
+    duration = 0
+    if files:
+        duration = os.path.getmtime(files[-1]) - os.path.getmtime(files[0])
+    return packets, duration
+
+def bench_receive(directory='.', chunk=1460, speed=100, key=0xa1b2c3d4):
+    """
+    Benchmark draining a capture through the receive buffer.
+
+    @param directory: directory with saved .packet files.
+    @type directory: C{string}.
+    @param chunk: size of the received TCP chunks.
+    @type chunk: C{int}.
+    @param speed: required speed factor relative to real time.
+    @type speed: C{float}.
+    @param key: master decryption key of the capture.
+    @type key: C{int}.
+    """
+    import Packet
+    from crypto import DecryptionContext
+    from buffer import ReceiveBuffer
+    packets, duration = read_capture(directory)
+    if not packets:
+        print 'No .packet files in {0}'.format(directory)
+        return
+    stream = ''.join(packets)
+    chunks = [stream[i:i+chunk] for i in xrange(0, len(stream), chunk)]
+
+    # packets are decrypted as they are parsed
+    context = DecryptionContext()
+    context.set_key(key)
+
+    def legacy():
+        context.reset()
+        data = ''
+        for received in chunks:
+            data += received
+            while data:
+                try:
+                    packet = Packet.packetize(data)
+                except Packet.NeedMoreData:
+                    break
+                except Packet.UnknownPacketType:
+                    data = data[2:]
+                else:
+                    data = data[len(packet):]
+
+    def parse(data):
+        try:
+            return len(Packet.packetize(data))
+        except Packet.NeedMoreData:
+            return 0
+        except Packet.UnknownPacketType:
+            return 2
+
+    def ring():
+        context.reset()
+        rbuf = ReceiveBuffer()
+        for received in chunks:
+            rbuf.append(received)
+            rbuf.drain(parse)
+        return rbuf
+
+    size = len(stream)
+    with context:
+        base = measure(legacy, size, repeat=1)
+        rate = measure(ring, size)
+        peak = ring().peak
+    report('legacy', base)
+    report('buffer', rate, base)
+    print 'peak backlog: {0} bytes'.format(peak)
+    if duration > 0:
+        realtime = size / MB / duration
+        factor = rate / realtime
+        print 'capture: {0} packets in {1:.0f} s, {2:.0f}x real time ({3})' \
+              .format(len(packets), duration, factor,
+                      'ok' if factor >= speed else
+                      'below {0}x'.format(speed))
+
+def hex_int(value):
+    """parse a hexadecimal integer."""
+    return int(value, 16)
+
+BENCHMARKS = {
+    'decrypt': bench_decrypt,
+    'receive': bench_receive,
+}
+
+# converters of the command line arguments of each benchmark
+ARGUMENTS = {
+    'decrypt': (int, int, hex_int),
+    'receive': (str, int, float, hex_int),
+}
+
+def main(argv=None):
+    """
+    Run the benchmark named on the command line with the remaining
+    arguments, or all benchmarks with their defaults.
+    """
+    args = (argv or sys.argv)[1:]
+    runs = [(args[0], args[1:])] if args else \
+           [(name, []) for name in sorted(BENCHMARKS)]
+    for name, params in runs:
+        print '[{0}]'.format(name)
+        params = [convert(value)
+                  for convert, value in zip(ARGUMENTS[name], params)]
+        BENCHMARKS[name](*params)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+#!/usr/bin/python
 """
 A collection of dump utilities.
 
@@ -15,10 +16,33 @@ A collection of dump utilities.
 
     > binary("\\xfe")
     01111111
+
+Both render data block by block with table lookups, so write_hexdump()
+and write_binary() can dump a window of a large (memory-mapped) file to a
+file-like sink without copying more than a block at a time:
+
+    > python -m tools.dump --offset 4096 --length 256 00000000000000000000.log
 """
+import sys
+import re
+import errno
+import mmap
 import binascii
+import argparse
+
+__all__ = ['hexdump', 'binary', 'write_hexdump', 'write_binary', 'dump_file']
+
+# bytes rendered per block (a multiple of 16, the bytes per hexdump line)
+BLOCK = 1 << 16
+
+# printable column of a hexdump: non-printable bytes are shown as '.'
+PRINTABLE = ''.join(chr(i) if 0x20 <= i <= 0x7E else '.' for i in range(256))
 
-__all__ = ['hexdump', 'binary']
+# binary representation of every octet by endianness
+BITS = {'big': tuple(format(i, '08b') for i in range(256)),
+        'little': tuple(format(i, '08b')[::-1] for i in range(256))}
+
+HEX_WORD = re.compile('.{1,4}')
 
 def dump(data, size=4):
     """dump binary data in chunks of 2 octets."""
@@ -33,28 +57,58 @@ def genchunks(seq, size):
     if rest:
         yield seq[quotient*size:]
 
+def window(data, offset=0, length=None):
+    """return the (start, end) of a window of data."""
+    end = len(data)
+    start = min(max(offset, 0), end)
+    if length is not None:
+        end = min(start + length, end)
+    return start, end
+
+def genblocks(data, offset=0, length=None, block=BLOCK):
+    """yield (address, block) of a window of data as strings."""
+    start, end = window(data, offset, length)
+    for addr in xrange(start, end, block):
+        yield addr, str(data[addr:min(addr + block, end)])
+
+def genhexlines(data, offset=0, length=None, address=None):
+    """yield lists of hexdump lines, one list per block of data."""
+    base = 0 if address is None else address - window(data, offset)[0]
+    for addr, chunk in genblocks(data, offset, length):
+        # 16 octets are 8 words of 4 hex digits and a space: 40 characters
+        words = ' '.join(HEX_WORD.findall(binascii.hexlify(chunk)))
+        text = chunk.translate(PRINTABLE)
+        addr += base
+        yield ['0x%04X: %-39s  %s' % (addr + i, words[i*5/2:i*5/2 + 39],
+                                      text[i:i + 16])
+               for i in xrange(0, len(chunk), 16)]
+
 def genhex(data):
     """yield lines in hex format including address info and printable chars."""
-    line = ''
-    generator = genchunks(data, 16)
-    for addr, dat in enumerate(generator):
-        line = '0x%04X: ' % (addr*16)
-        line += dump(dat)
-        # add padding
-        pad = 2
-        if len(dat) < 16:
-            rest = 16-len(dat)
-            pad += 2*rest + rest/2
-        line += ' '*pad
-
-        for byte in dat:
-            byte = ord(byte)
-            if 0x20 <= byte <= 0x7E:
-                line += chr(byte)
-            else:
-                line += '.'
+    for lines in genhexlines(data):
+        for line in lines:
+            yield line
+
+def write_hexdump(data, sink=None, offset=0, length=None, address=None):
+    """
+    Write a window of data in hexadecimal format to a sink, a block of
+    lines at a time.
 
-        yield line
+    @param data: data to dump (string, buffer, bytearray or mmap).
+    @type data: C{string}.
+    @param sink: file-like object (default: standard output).
+    @type sink: C{file}.
+    @param offset: offset of the window in data.
+    @type offset: C{int}.
+    @param length: length of the window (default: up to the end).
+    @type length: C{int}.
+    @param address: address shown for the first byte (default: offset).
+    @type address: C{int}.
+    """
+    write = (sink or sys.stdout).write
+    for lines in genhexlines(data, offset, length, address):
+        lines.append('')
+        write('\n'.join(lines))
 
 def hexdump(data, result='print'):
     """
@@ -70,29 +124,51 @@ def hexdump(data, result='print'):
     @rtype: C{generator} or None.
     @raise ValueError: when value of 'result' argument is unknown.
     """
-    gen = genhex(data)
     if result == 'print':
-        for line in gen:
-            print line
+        write_hexdump(data)
     elif result == 'generator':
-        return gen
+        return genhex(data)
     else:
         raise ValueError("Unknown value of 'result' argument")
 
+def bit_table(endian):
+    """return the binary representation of every octet."""
+    try:
+        return BITS[endian]
+    except KeyError:
+        raise ValueError("Unknown value of 'endian' argument")
+
 def genbit(data, endian):
     """yield octets in binary format."""
-    generate = genchunks(data, 1)
-    for byte in generate:
-        bits = [0]*8
-        for i in range(8):
-            if ord(byte) & (0x80>>i):
-                bits[i] = 1
-        if endian == 'big':
-            yield ''.join(str(bit) for bit in bits)
-        elif endian == 'little':
-            yield ''.join(str(bit) for bit in reversed(bits))
-        else:
-            raise ValueError("Unknown value of 'endian' argument")
+    bits = bit_table(endian)
+    for _, chunk in genblocks(data):
+        for octet in bytearray(chunk):
+            yield bits[octet]
+
+def write_binary(data, sink=None, endian='little', offset=0, length=None):
+    """
+    Write a window of data in binary format to a sink, a block at a time.
+
+    @param data: data to dump (string, buffer, bytearray or mmap).
+    @type data: C{string}.
+    @param sink: file-like object (default: standard output).
+    @type sink: C{file}.
+    @param endian: endianness: 'little' (default) or 'big'.
+    @type endian: C{string}
+    @param offset: offset of the window in data.
+    @type offset: C{int}.
+    @param length: length of the window (default: up to the end).
+    @type length: C{int}.
+    @raise ValueError: when value of 'endian' argument is unknown.
+    """
+    lookup = bit_table(endian).__getitem__
+    write = (sink or sys.stdout).write
+    separator = ''
+    for _, chunk in genblocks(data, offset, length):
+        write(separator)
+        write(' '.join(map(lookup, bytearray(chunk))))
+        separator = ' '
+    write('\n')
 
 def binary(data, endian='little', result='print'):
     """
@@ -110,12 +186,90 @@ def binary(data, endian='little', result='print'):
     @rtype: C{generator} or None.
     @raise ValueError: when value of 'result' argument is unknown.
    """
-    gen = genbit(data, endian)
-
     if result == 'print':
-        print ' '.join(gen)
+        write_binary(data, endian=endian)
     elif result == 'generator':
-        return gen
+        return genbit(data, endian)
     else:
         raise ValueError("Unknown value of 'result' argument")
 
+def dump_file(path, sink=None, offset=0, length=None, endian=None):
+    """
+    Dump a window of a file, memory-mapped so only the window is read.
+
+    @param path: file to dump.
+    @type path: C{string}.
+    @param sink: file-like object (default: standard output).
+    @type sink: C{file}.
+    @param offset: offset of the window in the file.
+    @type offset: C{int}.
+    @param length: length of the window (default: up to the end).
+    @type length: C{int}.
+    @param endian: dump in binary format with this endianness instead of
+                   hexadecimal format.
+    @type endian: C{string}
+    """
+    with open(path, 'rb') as _file:
+        try:
+            data = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        try:
+            if endian:
+                write_binary(data, sink, endian, offset, length)
+            else:
+                write_hexdump(data, sink, offset, length)
+        finally:
+            data.close()
+
+def dump_records(path, sink=None):
+    """dump the records of a packet log segment with their headers."""
+    # imported here: plain dumps do not need the packet log
+    from packetlog import MmapLogReader
+    from packetlog import HEADER
+    sink = sink or sys.stdout
+    reader = MmapLogReader()
+    try:
+        for offset, header, payload in reader.scan(path):
+            length, sequence, timestamp, kind, key_frame_id, _ = header
+            sink.write('# sequence={0} timestamp={1:.3f} kind={2} '
+                       'key_frame_id={3} length={4}\n'
+                       .format(sequence, timestamp, kind, key_frame_id,
+                               length))
+            write_hexdump(payload, sink, address=offset + HEADER.size)
+    finally:
+        reader.close()
+
+def main(argv=None):
+    """dump files (e.g. packet log segments) in hexadecimal format."""
+    parser = argparse.ArgumentParser(prog='f1live-dump',
+                                     description=main.__doc__)
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='file to dump')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='offset of the first byte (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=None,
+                        help='number of bytes (default: up to the end)')
+    parser.add_argument('--binary', choices=sorted(BITS), default=None,
+                        metavar='ENDIAN',
+                        help="dump in binary format ('little' or 'big')")
+    parser.add_argument('--records', action='store_true',
+                        help='dump packet log records with their headers')
+    args = parser.parse_args(argv)
+    for path in args.files:
+        if len(args.files) > 1:
+            sys.stdout.write('==> {0} <==\n'.format(path))
+        if args.records:
+            dump_records(path)
+        else:
+            dump_file(path, offset=args.offset, length=args.length,
+                      endian=args.binary)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except IOError as err:
+        # e.g. piped into head
+        if err.errno != errno.EPIPE:
+            raise
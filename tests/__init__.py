@@ -0,0 +1,11 @@
+"""
+Tests of f1live. The modules of f1live import each other as top-level
+modules, so its directory is put on the path.
+
+    > python -m unittest discover -s tests -t .
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))), 'f1live'))
@@ -0,0 +1,104 @@
+"""
+Tests of block-compressed packet archives.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import archive
+from packetlog import PacketLogWriter
+from packetlog import PacketLogReader
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+
+def available_codecs():
+    """names of the codecs whose library is installed."""
+    codecs = []
+    for name in archive.CODEC_NAMES:
+        try:
+            archive.get_codec(name)
+        except ImportError:
+            continue
+        codecs.append(name)
+    return codecs
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'log')
+        writer = PacketLogWriter(self.log)
+        for index in xrange(500):
+            if index % 100 == 50:
+                writer.append('frame {0}'.format(index) * 20, KEY_FRAME,
+                              index // 100, 1000.0 + index)
+            else:
+                writer.append('packet {0:04d}'.format(index), PACKET,
+                              timestamp=1000.0 + index)
+        writer.close()
+        self.records = list(PacketLogReader(self.log))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def convert(self, codec=archive.ZLIB):
+        path = os.path.join(self.directory, 'session.' + codec)
+        stats = archive.convert(self.log, path, codec, block_size=1024)
+        self.assertEqual(stats['records'], len(self.records))
+        self.assertTrue(stats['blocks'] > 5)
+        return archive.ArchiveReader(path)
+
+    def test_round_trip(self):
+        for codec in available_codecs():
+            reader = self.convert(codec)
+            try:
+                self.assertEqual(list(reader), self.records, codec)
+            finally:
+                reader.close()
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, archive.get_codec, 'rar')
+
+    def test_random_access(self):
+        reader = self.convert()
+        try:
+            records = list(reader.records(321, 325))
+            self.assertEqual(records, self.records[321:325])
+            # only the blocks holding the records are decompressed
+            self.assertTrue(reader.decompressed <= 2)
+            self.assertEqual(list(reader.between(1100.0, 1103.0)),
+                             self.records[100:103])
+            self.assertEqual(reader.key_frame_before(1249.5),
+                             self.records[150])
+            self.assertIsNone(reader.key_frame_before(1049.0))
+            self.assertEqual([record.key_frame_id
+                              for record in reader.key_frames()],
+                             [0, 1, 2, 3, 4])
+        finally:
+            reader.close()
+
+    def test_not_an_archive(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as _file:
+            _file.write('\0' * 64)
+        self.assertRaises(ValueError, archive.ArchiveReader, path)
+
+    def test_corrupt_block(self):
+        reader = self.convert(archive.NONE)
+        entry = reader.blocks[2]
+        reader.close()
+        with open(reader.path, 'r+b') as _file:
+            _file.seek(entry.offset + entry.length - 1)
+            _file.write('\xff')
+        reader = archive.ArchiveReader(reader.path)
+        try:
+            self.assertEqual(list(reader.records(0, entry.sequence)),
+                             self.records[:entry.sequence])
+            self.assertRaises(ValueError, list, reader)
+            self.assertRaises(ValueError, list,
+                              reader.records(entry.sequence))
+        finally:
+            reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
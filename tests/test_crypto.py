@@ -0,0 +1,119 @@
+"""
+Tests of the table-driven decryption.
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import http
+from crypto import KeyStream
+from crypto import DecryptionContext
+from crypto import CRYPTO_SEED
+from crypto import Crypto
+from crypto import KeyCache
+
+KEY = 0x5ec7e7a1
+
+def reference_decrypt(data, key, salt=CRYPTO_SEED):
+    """decrypt byte by byte, as the stream is specified."""
+    dec = []
+    for byte in data:
+        salt = (salt >> 1) ^ (key if salt & 0x01 else 0)
+        dec.append(chr(ord(byte) ^ (salt & 0xff)))
+    return ''.join(dec), salt
+
+def random_data(size):
+    return ''.join(chr(random.randrange(256)) for _ in xrange(size))
+
+class KeyStreamTest(unittest.TestCase):
+
+    def test_decrypt_matches_reference(self):
+        data = random_data(10000)
+        context = DecryptionContext()
+        context.set_key(KEY)
+        dec = ''.join(context.decrypt(data[start:start + size])
+                      for start, size in ((0, 1), (1, 4095), (4096, 5000),
+                                          (9096, 904)))
+        self.assertEqual(dec, reference_decrypt(data, KEY)[0])
+
+    def test_salt_at(self):
+        stream = KeyStream(KEY)
+        stream.extend(8192)
+        for offset in (0, 1, 4095, 4096, 5000):
+            self.assertEqual(stream.salt_at(offset),
+                             reference_decrypt('\0' * offset, KEY)[1])
+
+    def test_beyond_table(self):
+        stream = KeyStream(KEY)
+        stream.MAX_SIZE = 4096
+        data = random_data(12000)
+        dec = ''.join(stream.decrypt(data[start:start + 1000], start)
+                      for start in xrange(0, len(data), 1000))
+        self.assertEqual(dec, reference_decrypt(data, KEY)[0])
+        # sequential reads beyond the table continue from the last salt
+        self.assertEqual(stream.tail[0], len(data))
+        self.assertEqual(stream.tail[1], reference_decrypt(data, KEY)[1])
+
+    def test_cache_is_bounded(self):
+        streams = [KeyStream.get(key)
+                   for key in xrange(KeyStream.CACHE_SIZE + 3)]
+        self.assertEqual(len(KeyStream._cache), KeyStream.CACHE_SIZE)
+        self.assertIs(KeyStream.get(streams[-1].key), streams[-1])
+        self.assertNotIn(streams[0].key, KeyStream._cache)
+
+class DecryptionContextTest(unittest.TestCase):
+
+    def test_nested_reentry(self):
+        outer = DecryptionContext()
+        inner = DecryptionContext()
+        with outer:
+            with inner:
+                with inner:
+                    self.assertIs(Crypto.context(), inner)
+                self.assertIs(Crypto.context(), inner)
+            self.assertIs(Crypto.context(), outer)
+        self.assertIs(Crypto.context(), Crypto.default)
+
+class KeyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'keys')
+        self.get_async = http.get_async
+
+    def tearDown(self):
+        http.get_async = self.get_async
+        shutil.rmtree(self.directory)
+
+    def test_bad_line_is_skipped(self):
+        with open(self.filename, 'w') as _file:
+            _file.write('00001=0000000a\nbroken\n00002=zz\n00003=0000000c\n')
+        keys = KeyCache(self.filename)
+        self.assertEqual(keys.get('1'), 10)
+        self.assertEqual(keys.get('3'), 12)
+        self.assertIsNone(keys.get('2'))
+
+    def test_put_reads_file_once(self):
+        keys = KeyCache(self.filename)
+        loads = []
+        load = keys.load
+        keys.load = lambda: loads.append(1) or load()
+        for event_id in xrange(10):
+            keys.put(str(event_id), event_id)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(KeyCache(self.filename).get('7'), 7)
+
+    def test_failed_fetch_releases_waiters(self):
+        def get_async(defer, url, **kwargs):
+            raise IOError('unreachable')
+        http.get_async = get_async
+        keys = KeyCache(self.filename)
+        failures = []
+        for _ in xrange(2):
+            keys.fetch_async('5', 'token').addErrback(failures.append)
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(keys.pending, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Tests of the background packet log writer.
+"""
+import threading
+import unittest
+from db import BackgroundWriter
+from db import WRITE_LATENCY
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+
+class SlowWriter(object):
+    """packet log writer that fails or waits on demand."""
+
+    def __init__(self):
+        self.records = []
+        self.release = threading.Event()
+        self.fail = False
+        self.closed = False
+
+    def append(self, payload, kind=PACKET, key_frame_id=0, timestamp=None):
+        self.release.wait()
+        if self.fail:
+            self.fail = False
+            raise ValueError('broken')
+        self.records.append((payload, kind))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class BackgroundWriterTest(unittest.TestCase):
+
+    def test_drop_never_blocks(self):
+        slow = SlowWriter()
+        writer = BackgroundWriter(slow, queue_size=2, batch_size=1)
+        results = [writer.append(str(i)) for i in xrange(10)]
+        # key frames are queued beyond the bound
+        self.assertTrue(writer.append('frame', KEY_FRAME, 1))
+        self.assertIn(False, results)
+        self.assertEqual(writer.stats()['dropped'], results.count(False))
+        slow.release.set()
+        writer.close()
+        written = [payload for payload, _ in slow.records]
+        self.assertEqual(written, [str(i) for i, queued in enumerate(results)
+                                   if queued] + ['frame'])
+
+    def test_thread_survives_errors(self):
+        slow = SlowWriter()
+        slow.fail = True
+        slow.release.set()
+        writer = BackgroundWriter(slow, batch_size=1)
+        writer.append('lost')
+        writer.append('kept')
+        writer.close()
+        self.assertEqual(slow.records, [('kept', PACKET)])
+        self.assertEqual(writer.stats()['failed'], 1)
+        self.assertTrue(slow.closed)
+
+    def test_records_after_close_sentinel(self):
+        slow = SlowWriter()
+        writer = BackgroundWriter(slow)
+        writer.append('first')
+        # a record queued by another thread while closing
+        writer.queue.put(None)
+        writer.append('late')
+        slow.release.set()
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(slow.records, [('first', PACKET), ('late', PACKET)])
+        self.assertTrue(slow.closed)
+        writer.close()
+        self.assertFalse(writer.append('closed'))
+
+    def test_write_latency_observed(self):
+        slow = SlowWriter()
+        slow.release.set()
+        writer = BackgroundWriter(slow, name='latency')
+        for i in xrange(3):
+            writer.append(str(i))
+        writer.close()
+        self.assertEqual(sum(WRITE_LATENCY.values[('latency',)][:-1]), 3)
+
+if __name__ == '__main__':
+    unittest.main()
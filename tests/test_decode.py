@@ -0,0 +1,103 @@
+"""
+Tests of offline decoding: a packet log decodes to the same packets when
+replayed through the streaming client and when decoded chunk by chunk.
+"""
+import shutil
+import tempfile
+import unittest
+from tests import fakepacket
+fakepacket.install()
+from crypto import Crypto
+from decode import decode_session
+from decode import split
+from packetlog import PacketLogReader
+from packetlog import PacketLogWriter
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from replay import Replayer
+from streaming import StreamingClientFactory
+
+KEY = 0x5ec7e7a1
+EVENT_ID = '09999'
+
+# plain packets of the stream, split by key frame packets
+SESSION = [[('event', 1, EVENT_ID), ('key_frame', 1), (1, 4, '1.0'),
+            (2, 4, '2.0')],
+           [('key_frame', 2), (1, 4, '1.5'), (3, 5, '0.3')],
+           [('key_frame', 3), (2, 4, '2.5')]]
+
+# key frames: the complete state at their key frame packet
+KEY_FRAMES = {1: [(1, 3, 'VETTEL'), (2, 3, 'WEBBER')],
+              2: [(1, 3, 'VETTEL'), (2, 4, '2.0'), (1, 4, '1.0')]}
+
+class DecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Crypto.keys.remember(EVENT_ID, KEY)
+        writer = PacketLogWriter(self.directory)
+        packets = [packet for chunk in SESSION for packet in chunk]
+        # plain car cells in log order
+        self.expected = []
+        timestamp = 1000.0
+        for raw, plain in zip(fakepacket.encode(packets, KEY), packets):
+            timestamp += 1
+            writer.append(raw, PACKET, timestamp=timestamp)
+            if plain[0] == 'event':
+                continue
+            if plain[0] != 'key_frame':
+                self.expected.append(plain)
+                continue
+            # the key frame is downloaded and saved after its packet
+            frame = KEY_FRAMES.get(plain[1])
+            if frame:
+                writer.append(''.join(fakepacket.encode(frame, KEY)),
+                              KEY_FRAME, plain[1], timestamp + 0.5)
+                self.expected.extend(frame)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replayed(self):
+        """car cells dispatched when replaying through the client."""
+        factory = StreamingClientFactory(checkpoint_interval=0)
+        factory.create_firebase_ref = lambda event: None
+        cells = []
+        factory.dispatcher.subscribe(lambda packet: cells.append(
+            (packet.car, packet.type, packet.value))
+            if packet.car else None)
+        Replayer(self.directory, factory, speed=0).run()
+        return cells, factory.state.snapshot()
+
+    def decoded(self, **options):
+        """car cells decoded chunk by chunk."""
+        return [(decoded.car, decoded.type, decoded.value)
+                for decoded in decode_session(self.directory,
+                                              key_frames=True, **options)
+                if decoded.car]
+
+    def test_split_at_key_frame_packets(self):
+        reader = PacketLogReader(self.directory)
+        # the event packet, then one chunk per key frame packet
+        self.assertEqual(len(split(reader)), 4)
+
+    def test_decoded_cells(self):
+        self.assertEqual(self.decoded(processes=1), self.expected)
+
+    def test_parallel_decode(self):
+        self.assertEqual(self.decoded(processes=2), self.expected)
+
+    def test_replay_matches_decode(self):
+        replayed, snapshot = self.replayed()
+        self.assertEqual(replayed, self.decoded(processes=1))
+        self.assertEqual(snapshot[1], {'driver': 'VETTEL', 'gap': '1.5'})
+        self.assertEqual(snapshot[2], {'gap': '2.5'})
+        self.assertEqual(snapshot[3], {'interval': '0.3'})
+
+    def test_decode_without_key(self):
+        # the event packet of the first chunk loads the key
+        self.assertEqual(self.decoded(processes=1, key=None), self.expected)
+
+if __name__ == '__main__':
+    unittest.main()
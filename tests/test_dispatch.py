@@ -0,0 +1,51 @@
+"""
+Tests of the packet dispatcher.
+"""
+import unittest
+from dispatch import Dispatcher
+from dispatch import HANDLER_LATENCY
+
+class Car(object):
+    pass
+
+class Commentary(object):
+    pass
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def car(self, packet):
+        self.calls.append(('car', type(packet)))
+
+    def every(self, packet):
+        self.calls.append(('every', type(packet)))
+
+    def test_dispatch(self):
+        dispatcher = Dispatcher()
+        dispatcher.subscribe(self.car, Car)
+        dispatcher.subscribe(self.every)
+        dispatcher.dispatch(Car())
+        dispatcher.dispatch(Commentary())
+        self.assertEqual(self.calls, [('car', Car), ('every', Car),
+                                      ('every', Commentary)])
+        dispatcher.unsubscribe(self.car)
+        dispatcher.dispatch(Car())
+        self.assertEqual(self.calls[-1], ('every', Car))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_timing_opt_in(self):
+        dispatcher = Dispatcher()
+        dispatcher.subscribe(self.car, Car)
+        dispatcher.dispatch(Car())
+        self.assertEqual(dispatcher.stats(), {})
+        dispatcher = Dispatcher(timing=True, name='timed')
+        dispatcher.subscribe(self.car, Car)
+        dispatcher.dispatch(Car())
+        self.assertEqual(dispatcher.stats()['DispatcherTest.car']['calls'], 1)
+        counts = HANDLER_LATENCY.values[('timed', 'DispatcherTest.car')]
+        self.assertEqual(sum(counts[:-1]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests of the columnar export: rows round-trip through every format whose
+library is installed.
+"""
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from tests import fakepacket
+fakepacket.install()
+import export
+from crypto import Crypto
+from packetlog import PacketLogWriter
+
+KEY = 0x5ec7e7a1
+
+ROWS = [(1, 1000.5, 1, 4, '1:23.456', 83.456),
+        (2, 1001.0, 12, 5, '+0.3', 0.3),
+        (3, 1001.5, 24, 3, 'VETTEL', float('nan')),
+        (4, 1002.0, 0, -1, '', float('nan')),
+        (5, 1002.5, 3, 6, '28.1', 28.1)]
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'CarPacket')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer):
+        for row in ROWS:
+            writer.append(row)
+        writer.close()
+        self.assertEqual(writer.count, len(ROWS))
+        self.assertEqual(writer.chunks, 3)
+
+    def check(self, columns):
+        """compare exported columns by name with the rows."""
+        for index, name in enumerate(export.COLUMNS):
+            expected = [row[index] for row in ROWS]
+            values = list(columns[name])
+            if name == 'number':
+                self.assertEqual([math.isnan(value) for value in values],
+                                 [math.isnan(value) for value in expected])
+                values = [value for value in values if not math.isnan(value)]
+                expected = [value for value in expected
+                            if not math.isnan(value)]
+            self.assertEqual(values, expected)
+
+    def test_abstract_writer(self):
+        self.assertRaises(TypeError, export.TableWriter, self.path)
+
+    @unittest.skipIf(export.numpy is None, 'numpy is not installed')
+    def test_npy(self):
+        self.write(export.NumpyTableWriter(self.path, chunk_size=2))
+        self.check(export.load_table(self.directory, 'CarPacket'))
+
+    @unittest.skipIf(export.numpy is None, 'numpy is not installed')
+    def test_npz(self):
+        self.write(export.NumpyTableWriter(self.path, chunk_size=2,
+                                           compress=True))
+        self.assertFalse(os.path.exists(self.path + '.chunks'))
+        self.check(export.numpy.load(self.path + '.npz'))
+
+    @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        self.write(export.ParquetTableWriter(self.path, chunk_size=2))
+        table = export.pyarrow.parquet.read_table(self.path + '.parquet')
+        self.check(table.to_pydict())
+
+    @unittest.skipIf(export.numpy is None, 'numpy is not installed')
+    def test_export_session(self):
+        Crypto.keys.remember('09999', KEY)
+        log = os.path.join(self.directory, 'log')
+        writer = PacketLogWriter(log)
+        for raw in fakepacket.encode([('event', 1, '09999'),
+                                      ('key_frame', 1), (1, 4, '1:30.1'),
+                                      (2, 4, '+1.2')], KEY):
+            writer.append(raw)
+        writer.close()
+        output = os.path.join(self.directory, 'export')
+        counts = export.export_session(log, output, processes=1)
+        self.assertEqual(counts, {'SystemEvent': 1, 'SystemKeyFrame': 1,
+                                  'CarPacket': 2})
+        table = export.load_table(output, 'CarPacket')
+        self.assertEqual(list(table['value']), ['1:30.1', '+1.2'])
+        self.assertEqual(list(table['number']), [90.1, 1.2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests of the fan-in of redundant streams and resuming after reconnects.
+"""
+import shutil
+import tempfile
+import unittest
+from tests import fakepacket
+fakepacket.install()
+import http
+from fanin import FanIn
+from streaming import StreamingClientFactory
+
+KEY = 0x5ec7e7a1
+
+class MemoryStore(object):
+    """packet store keeping nothing, as if every write succeeded."""
+
+    def save_key_frame(self, frame, key_frame_id):
+        return True
+
+    def save_packet(self, packet):
+        return True
+
+    def save_checkpoint(self, checkpoint):
+        return True
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+class FanInAcceptTest(unittest.TestCase):
+
+    def test_accept(self):
+        fanin = FanIn()
+        self.assertTrue(fanin.accept('a', (-1, 0)))
+        self.assertFalse(fanin.accept('b', (-1, 0)))
+        self.assertTrue(fanin.accept('b', (1, 0)))
+        # b skipped this packet before the key frame
+        self.assertTrue(fanin.accept('a', (-1, 1)))
+        self.assertFalse(fanin.accept('a', (1, 0)))
+        # a gap is not handled out of order
+        self.assertFalse(fanin.accept('a', (1, 2)))
+        self.assertTrue(fanin.accept('a', (1, 1)))
+        self.assertEqual(fanin.stats(),
+                         {'a': {'accepted': 3, 'duplicates': 2},
+                          'b': {'accepted': 1, 'duplicates': 1}})
+
+    def test_lagging_feed(self):
+        fanin = FanIn()
+        for index in xrange(3):
+            self.assertTrue(fanin.accept('a', (1, index)))
+        # a reconnects after key frame 2, missing the end of key frame 1
+        self.assertTrue(fanin.accept('a', (2, 0)))
+        self.assertTrue(fanin.accept('a', (2, 1)))
+        # b lags a across the key frame
+        for index in xrange(3):
+            self.assertFalse(fanin.accept('b', (1, index)))
+        self.assertTrue(fanin.accept('b', (1, 3)))
+        self.assertFalse(fanin.accept('b', (2, 0)))
+        self.assertFalse(fanin.accept('b', (2, 1)))
+        self.assertTrue(fanin.accept('b', (2, 2)))
+        self.assertFalse(fanin.accept('a', (2, 2)))
+        self.assertEqual(fanin.stats(),
+                         {'a': {'accepted': 5, 'duplicates': 1},
+                          'b': {'accepted': 2, 'duplicates': 5}})
+
+    def test_window_bounded(self):
+        fanin = FanIn(window=2)
+        for key_frame_id in (1, 2, 3):
+            self.assertTrue(fanin.accept('a', (key_frame_id, 0)))
+        self.assertEqual(sorted(fanin.next_index), [2, 3])
+        # key frame 1 is no longer tracked: its packets are stale
+        self.assertFalse(fanin.accept('b', (1, 1)))
+        self.assertFalse(fanin.accept('b', (1, 0)))
+        self.assertTrue(fanin.accept('b', (2, 1)))
+        self.assertEqual(sorted(fanin.next_index), [2, 3])
+
+class FanInStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fetches = []
+        self.saved = http.get_async
+        http.get_async = lambda defer, url: self.fetches.append((defer, url))
+        self.fanin = FanIn(StreamingClientFactory(name='merged',
+                                                  checkpoint_interval=0))
+        self.feeds = [self.add_feed(name) for name in ('a', 'b')]
+        self.stream = fakepacket.encode([('key_frame', 1), (1, 4, '1.0'),
+                                         (2, 4, '2.0')], KEY)
+
+    def tearDown(self):
+        http.get_async = self.saved
+        shutil.rmtree(self.directory)
+
+    def add_feed(self, name):
+        factory = self.fanin.add_feed(name, directory=self.directory + name,
+                                      server=name + '.example',
+                                      checkpoint_interval=0)
+        factory.store.close()
+        factory.store = MemoryStore()
+        factory.crypto.set_key(KEY)
+        return factory
+
+    def connect(self, factory):
+        protocol = factory.buildProtocol(None)
+        protocol.connectionMade()
+        return protocol
+
+    def load_key_frame(self):
+        """complete the key frame download, with an empty key frame."""
+        defer, url = self.fetches.pop()
+        defer.callback('')
+
+    def test_first_copy_handled(self):
+        first, second = [self.connect(feed) for feed in self.feeds]
+        first.dataReceived(''.join(self.stream))
+        second.dataReceived(''.join(self.stream))
+        self.assertEqual(self.fanin.stats(),
+                         {'a': {'accepted': 3, 'duplicates': 0},
+                          'b': {'accepted': 0, 'duplicates': 3}})
+        self.assertEqual(self.fanin.output.state.get(1, 'gap'), '1.0')
+        self.assertEqual([url for _, url in self.fetches],
+                         ['http://a.example/keyframe_00001.bin'])
+        self.assertEqual(self.feeds[1].streamed_key_frame_id, 1)
+
+    def test_key_frame_recorded_for_every_feed(self):
+        for feed in self.feeds:
+            self.connect(feed).dataReceived(''.join(self.stream))
+        self.load_key_frame()
+        self.assertEqual([feed.key_frame_id for feed in self.feeds], [1, 1])
+        self.assertTrue(all(feed.can_resume() for feed in self.feeds))
+
+    def test_resumed_packets_sequenced(self):
+        feed = self.feeds[0]
+        protocol = self.connect(feed)
+        protocol.dataReceived(''.join(self.stream))
+        self.load_key_frame()
+        protocol.connectionLost(None)
+        # the new connection replays the stream from the key frame packet
+        protocol = self.connect(feed)
+        self.assertTrue(protocol.resuming)
+        stream = fakepacket.encode([('key_frame', 1), (1, 4, '1.0'),
+                                    (2, 4, '2.0'), (1, 4, '1.5')], KEY)
+        protocol.dataReceived(''.join(stream))
+        self.assertEqual(protocol.resumed, 3)
+        self.assertEqual(self.fanin.stats()['a'],
+                         {'accepted': 4, 'duplicates': 0})
+        self.assertEqual(self.fanin.output.state.get(1, 'gap'), '1.5')
+
+if __name__ == '__main__':
+    unittest.main()
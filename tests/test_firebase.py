@@ -0,0 +1,96 @@
+"""
+Tests of the Firebase update batcher.
+"""
+import unittest
+import firebase
+import http
+
+class UpdateBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batcher = firebase.UpdateBatcher('https://f1.firebaseio.com/')
+        self.requests = []
+        self.saved = http.request_async
+        http.request_async = lambda defer, method, url, encode, data: \
+            self.requests.append((method, url, data))
+
+    def tearDown(self):
+        http.request_async = self.saved
+
+    def test_descendants_replaced(self):
+        self.batcher.merge('race/timing/1/2', 'a')
+        self.batcher.merge('race/timing/1/3', 'b')
+        self.batcher.merge('race/timing', {'2': {'1': 'c'}})
+        self.assertEqual(self.batcher.pending,
+                         {'race/timing': {'2': {'1': 'c'}}})
+
+    def test_nested_into_ancestor(self):
+        self.batcher.merge('race/timing', {'1': {'2': 'a'}})
+        self.batcher.merge('race/timing/1/3', 'b')
+        self.batcher.merge('race/timing/4/5', None)
+        self.assertEqual(self.batcher.pending,
+                         {'race/timing': {'1': {'2': 'a', '3': 'b'},
+                                          '4': {'5': None}}})
+
+    def test_value_copied(self):
+        value = {'1': {'2': 'a'}}
+        self.batcher.merge('race/timing', value)
+        self.batcher.merge('race/timing/1/3', 'b')
+        value['1']['2'] = 'changed'
+        self.assertEqual(value, {'1': {'2': 'changed'}})
+        self.assertEqual(self.batcher.pending['race/timing'],
+                         {'1': {'2': 'a', '3': 'b'}})
+
+    def test_root_write(self):
+        self.batcher.merge('race/timing/1', 'a')
+        self.batcher.merge('', {'race': {}})
+        self.batcher.merge('race/commentary/x', 'b')
+        self.assertEqual(self.batcher.pending,
+                         {'': {'race': {'commentary': {'x': 'b'}}}})
+        self.batcher.send(self.batcher.pending, [], 0)
+        self.assertEqual(self.requests,
+                         [('put', 'https://f1.firebaseio.com.json',
+                           {'race': {'commentary': {'x': 'b'}}})])
+
+    def test_root_removed(self):
+        self.batcher.merge('', None)
+        self.batcher.send(self.batcher.pending, [], 0)
+        self.assertEqual(self.requests[0][0], 'delete')
+
+    def test_patch(self):
+        self.batcher.merge('race/timing/1', 'a')
+        self.batcher.send(self.batcher.pending, [], 0)
+        self.assertEqual(self.requests,
+                         [('patch', 'https://f1.firebaseio.com.json',
+                           {'race/timing/1': 'a'})])
+
+    def flush(self):
+        """send the pending writes now instead of on the reactor."""
+        self.batcher.timer.cancel()
+        self.batcher.flush()
+
+    def test_request_error_releases_batcher(self):
+        def request_async(defer, method, url, encode, data):
+            encode(data)
+            self.requests.append((method, url, data))
+        http.request_async = request_async
+        self.batcher.retries = 0
+        failures = []
+        self.batcher.write('race/commentary/x', 'R\xe4ikk\xf6nen') \
+                    .addErrback(failures.append)
+        self.flush()
+        self.assertEqual(len(failures), 1)
+        self.assertFalse(self.batcher.inflight)
+        self.batcher.write('race/timing/1', 'a')
+        self.flush()
+        self.assertEqual(self.requests,
+                         [('patch', 'https://f1.firebaseio.com.json',
+                           {'race/timing/1': 'a'})])
+
+    def test_root_reference_write(self):
+        root = firebase.AsyncFirebase('https://f1.firebaseio.com/')
+        self.assertEqual(root.path(), '')
+        self.assertEqual(root.child('race').path(), '/race')
+
+if __name__ == '__main__':
+    unittest.main()
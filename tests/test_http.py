@@ -0,0 +1,65 @@
+"""
+Tests of the blocking http connection pool.
+"""
+import socket
+import time
+import unittest
+import http
+
+class FakeConnection(object):
+    """connection remembering whether it was closed."""
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeHttp(object):
+    """httplib2 object with one connection, failing on demand."""
+
+    def __init__(self, error=None):
+        self.connections = {'host': FakeConnection()}
+        self.error = error
+
+    def request(self, url, method, data, headers):
+        raise self.error
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_idle_connections_expire_on_timer(self):
+        pool = http.ConnectionPool(idle_timeout=0.05)
+        connection = FakeHttp()
+        pool.release('host', connection)
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.timer.join(1)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertTrue(connection.connections['host'].closed)
+        self.assertIsNone(pool.timer)
+
+    def test_expire_keeps_fresh_connections(self):
+        pool = http.ConnectionPool(idle_timeout=60)
+        old, fresh = FakeHttp(), FakeHttp()
+        pool.idle['host'] = [(old, time.time() - 120), (fresh, time.time())]
+        pool.expire()
+        self.assertEqual(pool.idle['host'][0][0], fresh)
+        self.assertTrue(old.connections['host'].closed)
+        self.assertIsNotNone(pool.timer)
+        pool.timer.cancel()
+
+    def test_connection_released_on_error(self):
+        saved = http.POOL
+        http.POOL = pool = http.ConnectionPool()
+        try:
+            for error in (socket.error('refused'), ValueError('bad')):
+                pool.idle['host'] = [(FakeHttp(error), time.time())]
+                self.assertRaises((http.ConnectionError, ValueError),
+                                  http.request, 'get', 'http://host/')
+                self.assertEqual(pool.stats()['idle'], 1)
+        finally:
+            http.POOL = saved
+            if pool.timer:
+                pool.timer.cancel()
+
+if __name__ == '__main__':
+    unittest.main()
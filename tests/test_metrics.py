@@ -0,0 +1,106 @@
+"""
+Tests of the metrics registry and its Prometheus text format.
+"""
+import unittest
+import metrics
+from crypto import DECRYPT_LATENCY
+from crypto import DecryptionContext
+from metrics import Counter
+from metrics import Gauge
+from metrics import Histogram
+from metrics import MetricsResource
+
+KEY = 0x5ec7e7a1
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.headers = {}
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter(self):
+        counter = Counter('f1live_test_total', 'Test counter.')
+        counter.inc()
+        counter.inc(amount=2)
+        self.assertEqual(counter.render(),
+                         '# HELP f1live_test_total Test counter.\n'
+                         '# TYPE f1live_test_total counter\n'
+                         'f1live_test_total 3')
+
+    def test_labels(self):
+        counter = Counter('f1live_test_total', 'Test counter.',
+                          ('stream', 'type'))
+        # a labelled counter has no samples until incremented
+        self.assertEqual(list(counter.samples()), [])
+        counter.inc(('b', 'Car"Packet'))
+        counter.inc(('a', 'SystemEvent'), 4)
+        self.assertEqual(list(counter.samples()),
+                         ['f1live_test_total{stream="a",type="SystemEvent"} 4',
+                          'f1live_test_total{stream="b",type="Car\\"Packet"}'
+                          ' 1'])
+
+    def test_gauge_functions(self):
+        gauge = Gauge('f1live_test_depth', 'Test gauge.', ('stream',))
+        depth = [3]
+        gauge.set(1, ('set',))
+        gauge.set_function(lambda: depth[0], ('read',))
+        gauge.set_function(lambda: 1 / 0, ('broken',))
+        self.assertEqual(list(gauge.samples()),
+                         ['f1live_test_depth{stream="read"} 3',
+                          'f1live_test_depth{stream="set"} 1'])
+        depth[0] = 5
+        gauge.set_function(None, ('set',))
+        self.assertIn('f1live_test_depth{stream="read"} 5',
+                      list(gauge.samples()))
+        # a failing function has no sample, but is read again next time
+        self.assertIn(('broken',), gauge.functions)
+
+    def test_histogram(self):
+        histogram = Histogram('f1live_test_seconds', 'Test histogram.',
+                              ('stream',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, ('a',))
+        self.assertEqual(list(histogram.samples()),
+                         ['f1live_test_seconds_bucket{stream="a",le="0.1"} 1',
+                          'f1live_test_seconds_bucket{stream="a",le="1.0"} 3',
+                          'f1live_test_seconds_bucket{stream="a",le="+Inf"} 4',
+                          'f1live_test_seconds_sum{stream="a"} 4.25',
+                          'f1live_test_seconds_count{stream="a"} 4'])
+
+    def test_render_registry(self):
+        counter = metrics.counter('f1live_test_registered_total',
+                                  'Registered test counter.')
+        try:
+            counter.inc()
+            text = metrics.render()
+            self.assertTrue(text.endswith('\n'))
+            self.assertIn('# TYPE f1live_test_registered_total counter\n'
+                          'f1live_test_registered_total 1\n', text)
+            request = FakeRequest()
+            self.assertEqual(MetricsResource().render_GET(request),
+                             metrics.render())
+            self.assertEqual(request.headers['content-type'],
+                             'text/plain; version=0.0.4')
+        finally:
+            metrics.REGISTRY.remove(counter)
+
+    def test_serve_locally(self):
+        port = metrics.serve(0)
+        try:
+            self.assertEqual(port.getHost().host, '127.0.0.1')
+        finally:
+            port.stopListening()
+
+    def test_decrypt_latency_by_stream(self):
+        context = DecryptionContext(name='feed-a')
+        context.set_key(KEY)
+        context.decrypt('data')
+        context.key_frame_context().decrypt('data')
+        self.assertEqual(sum(DECRYPT_LATENCY.values[('feed-a',)][:-1]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of the segmented packet log.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from packetlog import PacketLogWriter
+from packetlog import PacketLogReader
+from packetlog import MmapLogReader
+from packetlog import list_segments
+from packetlog import read_index
+from packetlog import INDEX_FILE
+from packetlog import PACKET
+from packetlog import KEY_FRAME
+from packetlog import CHECKPOINT
+
+class PacketLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, count, start=0, **options):
+        """append count records, a key frame every 10 and a second apart."""
+        writer = PacketLogWriter(self.directory, **options)
+        for index in xrange(start, start + count):
+            if index % 10 == 5:
+                writer.append('frame {0}'.format(index), KEY_FRAME,
+                              index // 10, 1000.0 + index)
+            else:
+                writer.append('packet {0}'.format(index),
+                              timestamp=1000.0 + index)
+        return writer
+
+    def payloads(self, records):
+        return [str(record.payload) for record in records]
+
+    def test_round_trip_across_segments(self):
+        self.write(50, segment_size=256).close()
+        self.assertTrue(len(list_segments(self.directory)) > 3)
+        records = list(PacketLogReader(self.directory))
+        self.assertEqual([record.sequence for record in records], range(50))
+        self.assertEqual(records[15].kind, KEY_FRAME)
+        self.assertEqual(records[15].key_frame_id, 1)
+        self.assertEqual(str(records[16].payload), 'packet 16')
+        reader = MmapLogReader(self.directory)
+        try:
+            self.assertEqual(self.payloads(reader), self.payloads(records))
+            self.assertEqual(self.payloads(reader.records(20, 23)),
+                             ['packet 20', 'packet 21', 'packet 22'])
+        finally:
+            reader.close()
+
+    def test_queries_by_time(self):
+        self.write(50, segment_size=256, index_interval=5.0).close()
+        reader = PacketLogReader(self.directory)
+        self.assertEqual(self.payloads(reader.between(1031.0, 1033.0)),
+                         ['packet 31', 'packet 32'])
+        self.assertEqual(reader.key_frame_before(1044.5).key_frame_id, 3)
+        self.assertIsNone(reader.key_frame_before(1004.0))
+        # without the index, the segments are scanned
+        os.remove(os.path.join(self.directory, INDEX_FILE))
+        self.assertEqual(self.payloads(reader.between(1031.0, 1033.0)),
+                         ['packet 31', 'packet 32'])
+        self.assertEqual(reader.key_frame_before(1044.5).key_frame_id, 3)
+
+    def test_checkpoint_before(self):
+        writer = self.write(10)
+        writer.append('state', CHECKPOINT, timestamp=1010.0)
+        writer.close()
+        reader = PacketLogReader(self.directory)
+        self.assertEqual(str(reader.checkpoint_before(1020.0).payload),
+                         'state')
+        self.assertIsNone(reader.checkpoint_before(1009.0))
+
+    def test_torn_tail_recovered(self):
+        self.write(10).close()
+        _, path = list_segments(self.directory)[-1]
+        size = os.path.getsize(path)
+        index_size = os.path.getsize(os.path.join(self.directory, INDEX_FILE))
+        # a crash in the middle of the next record
+        with open(path, 'ab') as _file:
+            _file.write('\x09\0\0\0\x0a\0\0\0')
+        with open(os.path.join(self.directory, INDEX_FILE), 'ab') as _file:
+            _file.write('\0' * 10)
+        self.assertEqual(len(list(PacketLogReader(self.directory))), 10)
+        writer = self.write(5, start=10)
+        self.assertEqual(writer.sequence, 15)
+        writer.close()
+        self.assertTrue(os.path.getsize(path) > size)
+        records = list(PacketLogReader(self.directory))
+        self.assertEqual([record.sequence for record in records], range(15))
+        self.assertEqual(str(records[10].payload), 'packet 10')
+        entries = read_index(os.path.join(self.directory, INDEX_FILE))
+        self.assertTrue(os.path.getsize(os.path.join(self.directory,
+                                                     INDEX_FILE)) >
+                        index_size)
+        self.assertEqual(entries, sorted(entries))
+
+    def test_corrupt_payload_ends_the_log(self):
+        self.write(10).close()
+        _, path = list_segments(self.directory)[-1]
+        with open(path, 'r+b') as _file:
+            data = _file.read()
+            offset = data.index('packet 8')
+            _file.seek(offset)
+            _file.write('PACKET 8')
+        self.assertEqual(len(list(PacketLogReader(self.directory))), 8)
+        reader = MmapLogReader(self.directory)
+        try:
+            self.assertEqual(len(list(reader)), 8)
+        finally:
+            reader.close()
+        # reopening drops the corrupt record and everything after it
+        writer = PacketLogWriter(self.directory)
+        self.assertEqual(writer.sequence, 8)
+        writer.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests of the adaptive poll scheduler.
+"""
+import unittest
+from poll import PollScheduler
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = PollScheduler(min_interval=0.1, max_interval=5.0,
+                                    factor=2.0, backoff=2.0, smoothing=0.5)
+
+    def receive(self, *times):
+        for now in times:
+            self.poller.data_received(now)
+
+    def test_silent_stream_polled_at_maximum(self):
+        self.assertEqual(self.poller.interval(), 5.0)
+
+    def test_interval_follows_arrivals(self):
+        self.receive(100.0, 100.2, 100.4)
+        self.assertAlmostEqual(self.poller.interval(), 0.4)
+        # moving average: half of the latest gap of 1.2 s
+        self.receive(101.6)
+        self.assertAlmostEqual(self.poller.gap, 0.7)
+        self.assertAlmostEqual(self.poller.interval(), 1.4)
+        # bounded by the minimum interval
+        self.receive(101.61, 101.62, 101.63, 101.64, 101.65, 101.66)
+        self.assertEqual(self.poller.interval(), 0.1)
+
+    def test_answered_polls(self):
+        self.receive(100.0, 100.5)
+        self.poller.polled(101.5)
+        self.assertAlmostEqual(self.poller.data_received(101.55), 0.05)
+        # data without a poll answers nothing
+        self.assertIsNone(self.poller.data_received(101.6))
+        self.poller.polled(102.0)
+        self.assertAlmostEqual(self.poller.data_received(102.25), 0.25)
+        stats = self.poller.stats()
+        self.assertEqual((stats['polls'], stats['answered']), (2, 2))
+        self.assertAlmostEqual(stats['latency'], 0.15)
+        self.assertAlmostEqual(stats['max_latency'], 0.25)
+        # answered polls do not back off
+        self.assertEqual(self.poller.idle_polls, 0)
+
+    def test_unanswered_polls_back_off(self):
+        self.receive(100.0, 100.2)
+        self.assertAlmostEqual(self.poller.interval(), 0.4)
+        self.poller.polled(100.6)
+        self.assertAlmostEqual(self.poller.interval(), 0.4)
+        self.poller.polled(101.0)
+        self.assertAlmostEqual(self.poller.interval(), 0.8)
+        self.poller.polled(101.8)
+        self.assertAlmostEqual(self.poller.interval(), 1.6)
+        for now in (103.4, 106.6, 113.0, 125.8):
+            self.poller.polled(now)
+        self.assertEqual(self.poller.interval(), 5.0)
+        self.assertEqual(self.poller.stats()['answered'], 0)
+        # data ends the backoff, though the long silence raised the average
+        self.receive(126.0)
+        self.assertEqual(self.poller.idle_polls, 0)
+        self.assertAlmostEqual(self.poller.gap, 13.0)
+        self.receive(126.1, 126.2, 126.3, 126.4)
+        self.assertAlmostEqual(self.poller.interval(), 1.8125)
+
+    def test_key_frame_resets(self):
+        self.receive(100.0, 102.0)
+        for now in (103.0, 107.0, 112.0):
+            self.poller.polled(now)
+        self.assertEqual(self.poller.interval(), 5.0)
+        self.poller.key_frame()
+        self.assertEqual(self.poller.idle_polls, 0)
+        self.assertAlmostEqual(self.poller.interval(), 0.1)
+        # arrivals after the key frame move the interval up again
+        self.receive(112.5)
+        self.assertAlmostEqual(self.poller.gap, 0.5 * (0.05 + 10.5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+Tests of the Firebase timing publisher.
+"""
+import unittest
+from twisted.internet.defer import succeed
+from publisher import TimingPublisher
+from state import SessionState
+
+class FakeRef(object):
+    """Firebase reference recording its writes."""
+
+    def __init__(self):
+        self.writes = []
+
+    def set(self, data):
+        self.writes.append(('set', data))
+        return succeed(None)
+
+    def update(self, data):
+        self.writes.append(('update', data))
+        return succeed(None)
+
+class TimingPublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ref = FakeRef()
+        self.state = SessionState()
+        self.publisher = TimingPublisher(self.ref, self.state)
+
+    def test_empty_snapshot_skipped(self):
+        self.publisher.snapshot()
+        self.assertEqual(self.ref.writes, [])
+
+    def test_snapshot_then_changes(self):
+        self.state.set(1, 'gap', '1.0')
+        self.publisher.snapshot()
+        self.state.set(1, 'gap', '1.5')
+        self.state.set(2, 'gap', '2.0')
+        self.publisher.publish()
+        self.assertEqual(self.ref.writes,
+                         [('set', {'1': {'gap': '1.0'}}),
+                          ('update', {'1/gap': '1.5', '2/gap': '2.0'})])
+        self.assertEqual(self.publisher.stats()['requests_per_minute'], 2)
+        self.assertTrue(self.publisher.stats()['json_bytes'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""
+Tests of the push server: slow subscribers get coalesced updates or a
+fresh snapshot, and new subscribers get the recent commentary.
+"""
+import json
+import time
+import unittest
+from twisted.internet.defer import Deferred
+import push
+from push import PushServer
+from push import PushResource
+from state import SessionState
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+class FakeRequest(object):
+    """open http request recording what is written to it."""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.written = []
+        self.headers = {}
+        self.producer = None
+        self.finished = Deferred()
+
+    def write(self, data):
+        self.written.append(data)
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def notifyFinish(self):
+        return self.finished
+
+    def messages(self):
+        """decoded (event, data) messages, without heartbeats."""
+        messages = []
+        for data in self.written:
+            if data == push.HEARTBEAT_MESSAGE:
+                continue
+            event, data = data.strip().split('\n')
+            messages.append((event[len('event: '):],
+                             json.loads(data[len('data: '):])))
+        return messages
+
+class PushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = SessionState()
+        self.state.set(1, 'driver', 'VETTEL')
+        self.server = PushServer(max_cells=3, history=2, max_stall=10.0,
+                                 name='test')
+        self.server.attach(self.state)
+
+    def tearDown(self):
+        push.SUBSCRIBERS.set_function(None, ('test',))
+
+    def subscribe(self):
+        request = FakeRequest()
+        self.server.subscribe(request)
+        return request
+
+    def update(self, *cells):
+        for car, column, value in cells:
+            self.state.set(car, column, value)
+        self.server.publish()
+
+    def test_subscribe_sends_snapshot(self):
+        request = self.subscribe()
+        self.assertEqual(request.messages(),
+                         [('snapshot', {
+                             'event': self.state.event_type,
+                             'cars': {'1': {'driver': 'VETTEL'}}})])
+        self.update((1, 'gap', '1.0'))
+        self.assertEqual(request.messages()[1:],
+                         [('timing', {'1/gap': '1.0'})])
+        request.finished.callback(None)
+        self.assertEqual(self.server.subscribers, set())
+
+    def test_paused_updates_coalesced(self):
+        request = self.subscribe()
+        active = self.subscribe()
+        request.producer.pauseProducing()
+        self.update((1, 'gap', '1.0'), (2, 'gap', '2.0'))
+        self.update((1, 'gap', '1.1'))
+        self.assertEqual(len(request.written), 1)
+        self.assertEqual(len(active.written), 3)
+        request.producer.resumeProducing()
+        self.assertEqual(request.messages()[1:],
+                         [('timing', {'1/gap': '1.1', '2/gap': '2.0'})])
+        self.assertEqual(self.server.stats(),
+                         {'subscribers': 2, 'paused': 0})
+
+    def test_resync_after_max_cells(self):
+        request = self.subscribe()
+        request.producer.pauseProducing()
+        self.update((1, 'gap', '1.0'), (2, 'gap', '2.0'))
+        self.update((3, 'gap', '3.0'), (4, 'gap', '4.0'))
+        # stale: further updates are not coalesced
+        self.update((5, 'gap', '5.0'))
+        self.assertEqual(request.producer.cells, {})
+        request.producer.resumeProducing()
+        event, data = request.messages()[-1]
+        self.assertEqual(event, 'snapshot')
+        self.assertEqual(sorted(data['cars']), ['1', '2', '3', '4', '5'])
+        self.update((1, 'gap', '1.5'))
+        self.assertEqual(request.messages()[-1],
+                         ('timing', {'1/gap': '1.5'}))
+
+    def test_resync_after_snapshot(self):
+        request = self.subscribe()
+        request.producer.pauseProducing()
+        self.update((1, 'gap', '1.0'))
+        self.state.set(2, 'driver', 'WEBBER')
+        self.server.snapshot()
+        request.producer.resumeProducing()
+        self.assertEqual(request.messages()[1:],
+                         [('snapshot', {
+                             'event': self.state.event_type,
+                             'cars': {'1': {'driver': 'VETTEL', 'gap': '1.0'},
+                                      '2': {'driver': 'WEBBER'}}})])
+
+    def test_snapshot_cached_by_version(self):
+        message = self.server.snapshot_message()
+        self.assertTrue(self.server.snapshot_message() is message)
+        self.assertTrue(self.subscribe().written[0] is message)
+        self.state.set(1, 'gap', '1.0')
+        self.assertFalse(self.server.snapshot_message() is message)
+        self.assertTrue('1.0' in self.server.snapshot_message())
+
+    def test_comment_history(self):
+        for comment in ['one', 'two', 'three']:
+            self.server.comment(comment)
+        request = self.subscribe()
+        self.assertEqual(request.messages()[1:],
+                         [('commentary', 'two'), ('commentary', 'three')])
+
+    def test_latin1_comment(self):
+        request = self.subscribe()
+        self.server.comment('Kimi R\xe4ikk\xf6nen')
+        self.assertEqual(request.messages()[1:],
+                         [('commentary', u'Kimi R\xe4ikk\xf6nen')])
+        self.assertEqual(self.subscribe().messages()[1:],
+                         [('commentary', u'Kimi R\xe4ikk\xf6nen')])
+
+    def test_paused_comments_bounded(self):
+        request = self.subscribe()
+        request.producer.pauseProducing()
+        for comment in ['one', 'two', 'three']:
+            self.server.comment(comment)
+        self.assertEqual(len(request.written), 1)
+        request.producer.resumeProducing()
+        self.assertEqual(request.messages()[1:],
+                         [('commentary', 'two'), ('commentary', 'three')])
+
+    def test_stalled_subscriber_aborted(self):
+        stalled = self.subscribe()
+        active = self.subscribe()
+        stalled.producer.pauseProducing()
+        self.server.beat()
+        self.assertFalse(stalled.transport.aborted)
+        stalled.producer.paused = time.time() - 11.0
+        self.server.beat()
+        self.assertTrue(stalled.transport.aborted)
+        self.assertFalse(active.transport.aborted)
+        self.assertEqual(active.written[-1], push.HEARTBEAT_MESSAGE)
+        self.assertEqual(self.server.subscribers, set([active.producer]))
+
+    def test_cross_origin_only_when_configured(self):
+        request = FakeRequest()
+        PushResource(self.server).render_GET(request)
+        self.assertFalse('access-control-allow-origin' in request.headers)
+        self.server.origin = 'http://dashboard.example'
+        request = FakeRequest()
+        PushResource(self.server).render_GET(request)
+        self.assertEqual(request.headers['access-control-allow-origin'],
+                         'http://dashboard.example')
+
+    def test_subscribers_gauge_by_server(self):
+        PushServer(name='other')
+        try:
+            self.subscribe()
+            self.assertEqual(push.SUBSCRIBERS.functions[('test',)](), 1)
+            self.assertEqual(push.SUBSCRIBERS.functions[('other',)](), 0)
+        finally:
+            push.SUBSCRIBERS.set_function(None, ('other',))
+
+if __name__ == '__main__':
+    unittest.main()
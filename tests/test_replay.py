@@ -0,0 +1,155 @@
+"""
+Tests of state checkpoints and seeking in saved sessions.
+"""
+import cPickle
+import shutil
+import tempfile
+import unittest
+from tests import fakepacket
+fakepacket.install()
+from crypto import Crypto
+from crypto import DecryptionContext
+from packetlog import PacketLogWriter
+from packetlog import CHECKPOINT
+from packetlog import KEY_FRAME
+from replay import Replayer
+from replay import SeekFactory
+from replay import state_at
+from streaming import StreamingClientFactory
+from streaming import decode_checkpoint
+from streaming import encode_checkpoint
+
+KEY = 0x5ec7e7a1
+EVENT_ID = '09999'
+
+STREAM = [('event', 1, EVENT_ID), ('key_frame', 1), (1, 4, '1.0'),
+          (2, 4, '2.0'), (1, 4, '1.1'), (3, 4, '3.0')]
+
+COMMENT = 'Kimi R\xe4ikk\xf6nen '
+
+def checkpoint():
+    """checkpoint of a session after the fourth packet of STREAM."""
+    factory = StreamingClientFactory(checkpoint_interval=0)
+    factory.state.set(1, 'gap', '1.0')
+    factory.state.set(2, 'gap', '2.0')
+    # only found in the checkpoint, not in the packets
+    factory.state.set(5, 'driver', 'MARKER')
+    # bytes decrypted since the key frame packet
+    factory.crypto.restore([EVENT_ID, KEY, 6])
+    factory.comment = COMMENT
+    return factory.checkpoint()
+
+class CheckpointTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        saved = checkpoint()
+        restored = decode_checkpoint(encode_checkpoint(saved))
+        self.assertEqual(restored, saved)
+        self.assertTrue(isinstance(restored['comment'], str))
+
+    def test_pickle_rejected(self):
+        self.assertRaises(ValueError, decode_checkpoint,
+                          cPickle.dumps(checkpoint()))
+
+class SeekTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Crypto.keys.remember(EVENT_ID, KEY)
+        writer = PacketLogWriter(self.directory)
+        for index, raw in enumerate(fakepacket.encode(STREAM, KEY)):
+            writer.append(raw, timestamp=1001.0 + index)
+            if index == 3:
+                writer.append(encode_checkpoint(checkpoint()), CHECKPOINT,
+                              timestamp=1004.5)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_seek_from_checkpoint(self):
+        factory = SeekFactory(DecryptionContext(), name='seek',
+                              checkpoint_interval=0)
+        replayer = Replayer(self.directory, factory, speed=0)
+        try:
+            replayer.seek(1005.5)
+        finally:
+            replayer.reader.close()
+        self.assertEqual(replayer.replayed, 1)
+        self.assertEqual(factory.state.snapshot(),
+                         {1: {'gap': '1.1'}, 2: {'gap': '2.0'},
+                          5: {'driver': 'MARKER'}})
+        self.assertEqual(factory.comment, COMMENT)
+
+    def test_seek_before_checkpoint(self):
+        self.assertEqual(state_at(self.directory, 1003.5).snapshot(),
+                         {1: {'gap': '1.0'}})
+
+    def test_relative_time(self):
+        self.assertEqual(state_at(self.directory, 5.5, relative=True)
+                         .snapshot(),
+                         state_at(self.directory, 1006.5).snapshot())
+        self.assertEqual(state_at(self.directory, 1006.5).get(3, 'gap'),
+                         '3.0')
+
+class StartTest(unittest.TestCase):
+    """replay from the key frame before a start time."""
+
+    # key frame 1 is downloaded after a packet following its key frame
+    # packet, key frame 2 has no record
+    STREAM = [(1001.0, ('event', 1, EVENT_ID)), (1002.0, ('key_frame', 1)),
+              (1003.0, (1, 4, '1.0')), (1004.0, (2, 4, '2.0')),
+              (1005.0, (1, 4, '1.1')), (1006.0, ('key_frame', 2)),
+              (1007.0, (3, 4, '3.0'))]
+    KEY_FRAME = [(1, 3, 'VETTEL'), (2, 3, 'WEBBER')]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Crypto.keys.remember(EVENT_ID, KEY)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, keyframe, checkpoint=None):
+        writer = PacketLogWriter(self.directory)
+        if checkpoint is not None:
+            writer.append(encode_checkpoint(checkpoint), CHECKPOINT,
+                          timestamp=1001.5)
+        packets = [packet for _, packet in self.STREAM]
+        for (timestamp, _), raw in zip(self.STREAM,
+                                       fakepacket.encode(packets, KEY)):
+            writer.append(raw, timestamp=timestamp)
+            if timestamp == 1003.0:
+                writer.append(''.join(fakepacket.encode(keyframe, KEY)),
+                              KEY_FRAME, 1, 1003.5)
+        writer.close()
+
+    def replayed(self, start=None):
+        """car cells dispatched when replaying from start."""
+        factory = SeekFactory(DecryptionContext(), name='seek',
+                              checkpoint_interval=0)
+        cells = []
+        factory.dispatcher.subscribe(lambda packet: cells.append(
+            (packet.car, packet.type, packet.value))
+            if packet.car else None)
+        Replayer(self.directory, factory, speed=0, start=start).run()
+        return cells, factory.state.snapshot()
+
+    def test_key_from_key_frame(self):
+        self.write([('event', 1, EVENT_ID)] + self.KEY_FRAME)
+        cells, snapshot = self.replayed(1004.5)
+        self.assertEqual(cells, [(1, 4, '1.0'), (1, 3, 'VETTEL'),
+                                 (2, 3, 'WEBBER'), (2, 4, '2.0'),
+                                 (1, 4, '1.1'), (3, 4, '3.0')])
+        self.assertEqual((cells, snapshot), self.replayed())
+
+    def test_key_from_checkpoint(self):
+        factory = StreamingClientFactory(checkpoint_interval=0)
+        factory.crypto.restore([EVENT_ID, KEY, 0])
+        self.write(self.KEY_FRAME, factory.checkpoint())
+        cells, snapshot = self.replayed(1006.5)
+        self.assertEqual(cells[0], (1, 4, '1.0'))
+        self.assertEqual((cells, snapshot), self.replayed())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Smoke test of the stand-in live timing server: every load test client
+receives and measures every packet streamed.
+"""
+import unittest
+from tests import fakepacket
+fakepacket.install()
+import http
+from crypto import Crypto
+from server import LiveTimingServer
+from server import LoadTest
+from server import synthetic_packets
+from server import EVENT_ID
+from server import KEY
+
+class Pipe(object):
+    """transport of the server side, delivering to a client at once."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, data):
+        self.client.dataReceived(data)
+
+class LoadTestSmokeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = []
+        self.saved = http.get_async
+        http.get_async = lambda defer, url, **kwargs: \
+                         self.fetches.append((defer, url))
+        Crypto.keys.remember(EVENT_ID, KEY)
+
+    def tearDown(self):
+        http.get_async = self.saved
+
+    def test_every_client_measures_every_packet(self):
+        keyframes = {}
+        server = LiveTimingServer(synthetic_packets(keyframes,
+                                                    keyframe_interval=20),
+                                  keyframes, burst=25)
+        test = LoadTest(server, clients=3, http_port=8123)
+        for client in xrange(test.clients):
+            factory = test.make_factory(client)
+            test.factories.append(factory)
+            protocol = factory.buildProtocol(None)
+            protocol.connectionMade()
+            stream = server.buildProtocol(None)
+            stream.transport = Pipe(protocol)
+            stream.connectionMade()
+        for _ in xrange(4):
+            server.tick()
+            # answer the key frame downloads of the clients
+            while self.fetches:
+                defer, url = self.fetches.pop(0)
+                self.assertTrue(url.startswith('http://127.0.0.1:8123/'))
+                keyframe_id = int(url[-len('00000.bin'):-len('.bin')])
+                defer.callback(keyframes[keyframe_id])
+        self.assertEqual(server.count, 100)
+        for factory in test.factories:
+            self.assertEqual(len(factory.latencies), server.count)
+            self.assertEqual(factory.key_frame_id, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests of the in-memory session timing state.
+"""
+import unittest
+from state import SessionState
+
+class SessionStateTest(unittest.TestCase):
+
+    def test_changed_since(self):
+        state = SessionState()
+        state.set(1, 'driver', 'VETTEL')
+        version = state.version
+        state.set(1, 'gap', '1.0')
+        state.set(2, 'gap', '2.0')
+        state.set(1, 'gap', '1.5')
+        self.assertEqual(sorted(state.changed_since(version)),
+                         [(1, 'gap', '1.5'), (2, 'gap', '2.0')])
+        self.assertEqual(state.changed_since(state.version), [])
+        self.assertEqual(len(state.changed_since(0)), 3)
+
+    def test_unchanged_value_not_logged(self):
+        state = SessionState()
+        state.set(1, 'gap', '1.0')
+        self.assertFalse(state.set(1, 'gap', '1.0'))
+        self.assertEqual(state.version, 1)
+
+    def test_trimmed_log(self):
+        state = SessionState(max_log=4)
+        for i in xrange(20):
+            state.set(i % 3 + 1, 'gap', str(i))
+        self.assertTrue(len(state.log) <= 8)
+        self.assertEqual(sorted(state.changed_since(0)),
+                         [(1, 'gap', '18'), (2, 'gap', '19'),
+                          (3, 'gap', '17')])
+        self.assertEqual(state.changed_since(19), [(2, 'gap', '19')])
+
+    def test_clear(self):
+        state = SessionState()
+        state.set(1, 'gap', '1.0')
+        state.set(2, 'gap', '2.0')
+        version = state.version
+        state.clear()
+        self.assertTrue(state.version > version)
+        self.assertEqual(state.snapshot(), {})
+        state.set(2, 'gap', '2.0')
+        self.assertEqual(state.snapshot(), {2: {'gap': '2.0'}})
+        self.assertEqual(state.changed_since(version), [(2, 'gap', '2.0')])
+
+    def test_checkpoint(self):
+        state = SessionState()
+        state.set(1, 'gap', '1.0')
+        restored = SessionState()
+        restored.restore(state.checkpoint())
+        self.assertEqual(restored.snapshot(), state.snapshot())
+        restored.set(1, 'gap', '2.0')
+        self.assertEqual(restored.changed_since(state.version),
+                         [(1, 'gap', '2.0')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""
+Tests of the streaming client: loading event keys without blocking,
+resuming after reconnects and timing packet handlers.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from tests import fakepacket
+fakepacket.install()
+import http
+from crypto import Crypto
+from crypto import KeyCache
+from dispatch import HANDLER_LATENCY
+from streaming import StreamingClientFactory
+from streaming import event_id_of
+from tests.test_fanin import MemoryStore
+
+KEY = 0x5ec7e7a1
+EVENT_ID = '09998'
+
+STREAM = [('event', 1, EVENT_ID), ('key_frame', 1), (1, 4, '1.0'),
+          (2, 4, '2.0')]
+
+class StreamTestCase(unittest.TestCase):
+    """stream fed to a client, with http requests captured."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.keys = Crypto.keys
+        Crypto.keys = KeyCache(os.path.join(self.directory, 'keys'))
+        self.saved = http.get, http.get_async
+        self.fetches = []
+        http.get_async = lambda defer, url, **kwargs: \
+                         self.fetches.append((defer, url))
+        http.get = self.blocking_get
+        self.factory = StreamingClientFactory(store=MemoryStore(),
+                                              checkpoint_interval=0)
+        self.factory.create_firebase_ref = lambda event: None
+
+    def tearDown(self):
+        Crypto.keys = self.keys
+        http.get, http.get_async = self.saved
+        shutil.rmtree(self.directory)
+
+    def blocking_get(self, url, **kwargs):
+        self.fail('blocking request of {0}'.format(url))
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        protocol.connectionMade()
+        return protocol
+
+    def fetched(self, suffix, content):
+        """complete the pending download of a url ending with suffix."""
+        for fetch in self.fetches:
+            defer, url = fetch
+            if url.endswith(suffix):
+                self.fetches.remove(fetch)
+                defer.callback(content)
+                return
+        self.fail('{0} was not requested'.format(suffix))
+
+class KeyLoadTest(StreamTestCase):
+
+    def test_event_id_of(self):
+        raw = fakepacket.encode(STREAM, KEY)
+        self.assertEqual(event_id_of(raw[0]), EVENT_ID)
+        self.assertIsNone(event_id_of(raw[0][:-1]))
+        self.assertIsNone(event_id_of(raw[1]))
+
+    def test_cold_key_does_not_block(self):
+        protocol = self.connect()
+        data = ''.join(fakepacket.encode(STREAM, KEY))
+        protocol.dataReceived(data[:10])
+        protocol.dataReceived(data[10:])
+        # held back until the key is downloaded
+        self.assertEqual(protocol.buffer.buffered, len(data))
+        self.assertEqual(self.factory.state.snapshot(), {})
+        self.fetched('/getkey/09998.asp', '{0:08x}'.format(KEY))
+        self.assertEqual(protocol.buffer.buffered, 0)
+        self.assertEqual(self.factory.crypto.key, KEY)
+        self.assertEqual(self.factory.state.get(2, 'gap'), '2.0')
+        self.assertEqual(Crypto.keys.get(EVENT_ID), KEY)
+
+    def test_cached_key_parsed_at_once(self):
+        Crypto.keys.put(EVENT_ID, KEY)
+        self.connect().dataReceived(''.join(fakepacket.encode(STREAM, KEY)))
+        self.assertEqual(self.factory.state.get(1, 'gap'), '1.0')
+        self.assertEqual([url for _, url in self.fetches],
+                         ['http://{0}/keyframe_00001.bin'
+                          .format(http.F1_LIVE_SERVER)])
+
+    def test_reconnect_prefetches_key(self):
+        self.factory.crypto.event_id = EVENT_ID
+        protocol = self.connect()
+        self.assertEqual(len(self.fetches), 1)
+        self.fetched('/getkey/09998.asp', '{0:08x}'.format(KEY))
+        protocol.dataReceived(''.join(fakepacket.encode(STREAM, KEY)))
+        self.assertEqual(self.factory.state.get(1, 'gap'), '1.0')
+
+class RecordingStore(MemoryStore):
+    """packet store keeping the raw packets saved."""
+
+    def __init__(self):
+        self.packets = []
+
+    def save_packet(self, packet):
+        self.packets.append(packet.raw)
+        return True
+
+class ResumeTest(StreamTestCase):
+
+    PACKETS = [(1, 4, '1.0'), (2, 4, '2.0'), (1, 4, '1.1'), (3, 4, '3.0')]
+
+    def setUp(self):
+        StreamTestCase.setUp(self)
+        Crypto.keys.put(EVENT_ID, KEY)
+        self.factory.store = RecordingStore()
+        self.cells = []
+        self.factory.dispatcher.subscribe(lambda packet: self.cells.append(
+            (packet.car, packet.type, packet.value))
+            if packet.car else None)
+        self.stream = fakepacket.encode(STREAM[:2] + self.PACKETS, KEY)
+
+    def test_resume_after_connection_lost(self):
+        protocol = self.connect()
+        # the connection drops in the middle of the fifth packet
+        data = ''.join(self.stream[:4]) + self.stream[4][:3]
+        protocol.dataReceived(data)
+        self.fetched('/keyframe_00001.bin', '')
+        protocol.connectionLost(None)
+        # the server sends the event and replays the stream of key frame 1
+        protocol = self.connect()
+        self.assertTrue(protocol.resuming)
+        protocol.dataReceived(''.join(self.stream))
+        self.assertEqual(protocol.resumed, 3)
+        self.assertFalse(protocol.resuming)
+        self.assertEqual(self.cells, self.PACKETS)
+        self.assertEqual(self.factory.store.packets, self.stream)
+        self.assertEqual((protocol.sequence_key_frame,
+                          protocol.sequence_index), (1, 4))
+        self.assertEqual(self.factory.state.get(1, 'gap'), '1.1')
+
+    def test_no_resume_before_key_frame(self):
+        protocol = self.connect()
+        protocol.dataReceived(''.join(self.stream[:4]))
+        protocol.connectionLost(None)
+        # the key frame never arrived: the state is rebuilt from scratch
+        protocol = self.connect()
+        self.assertFalse(protocol.resuming)
+        protocol.dataReceived(''.join(self.stream))
+        self.assertEqual(self.cells, self.PACKETS[:2] + self.PACKETS)
+
+class TimingTest(StreamTestCase):
+
+    def test_handlers_timed_when_enabled(self):
+        Crypto.keys.put(EVENT_ID, KEY)
+        for name, timing in (('untimed', False), ('timed', True)):
+            self.factory = StreamingClientFactory(store=MemoryStore(),
+                                                  checkpoint_interval=0,
+                                                  name=name, timing=timing)
+            self.factory.create_firebase_ref = lambda event: None
+            self.connect().dataReceived(''.join(fakepacket.encode(STREAM,
+                                                                  KEY)))
+        labels = ('timed', 'StreamingClientProtocol.update_state')
+        self.assertEqual(sum(HANDLER_LATENCY.values[labels][:-1]), 4)
+        self.assertFalse(any(name == 'untimed'
+                             for name, _ in HANDLER_LATENCY.values))
+
+if __name__ == '__main__':
+    unittest.main()